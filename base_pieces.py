@@ -20,19 +20,43 @@ LICENSE for details.
 from OpenGL.GL import *
 from OpenGL.GLE import *
 from OpenGL.GLU import *
-from OpenGL.GLUT import *
+from OpenGL.GL import shaders
+from OpenGL import contextdata
+from OpenGL.raw.GL.VERSION import GL_1_5 as raw_GL_1_5
+from OpenGL.error import GLError
 
 import numpy as np # The opengl number-crunching module is called np
 
+import os
+import re
 import math
+import ast
 import vector_math
 import string
 import copy
+import bisect
+import cStringIO
+import hashlib
+import glob
+import zipfile
+import ctypes
 
 # Global Variables
 draw_outline = 0 # 0/1
+draw_batches = 1 # 0/1 draw modelling parts by type (see part_batches)
+batch_rows = 64 # parts placed by each display list of a part_batch
+background_fbo = 1 # 0/1 keep the background in a framebuffer object, if possible
+outline_shader = 0 # 0/1 draw outlines with a GLSL pass, if possible
+id_picking = 1 # 0/1 pick the part or port drawn under the pointer, if possible
+cache_shapes = 1 # 0/1 draw shapes from captured triangles, if possible (see tessellation_cache)
+cull_parts = 1 # 0/1 skip drawing parts outside the view (see bounds_tree)
+auto_detail = 0 # 0/1 draw parts small on the screen with less detail (see part_detail)
+proxy_pixels = 12.0 # parts smaller on the screen are drawn as proxies
+solid_pixels = 60.0 # parts smaller on the screen aren't rendered
 draw_future_parts = 1 # 0/1 used in instructions
 generate_pdf = 0 # 0/1
+window_fbo = 0 # framebuffer drawn in; nonzero when drawing offscreen
+window_buffer = GL_BACK # color buffer of window_fbo read from
 depth_scale = 1.0 # Used in draw_part_outlines
 dim_scale = 1.0 # Multiplier for lines/text for print display
 pixperunit = 10.0 # Set by cbmodel.py later
@@ -59,6 +83,124 @@ colors = {'total': (1.0, 1.0, 1.0),
           'region4': (0.8, 0.4, 0.8),
           'region5': (0.4, 0.8, 0.8)}
 
+# Binary model files.  A header of section sizes is followed by the
+# sections, each padded to 8 bytes: piece names ('\n' separated),
+# uint16 name index per part, float32 (N,16) matrices, configure names
+# ('\n' separated), uint16 (N,config_width) configure indices (0xffff
+# for none), end types, float32 (M,9) ends, instruction records, uint32
+# new_parts, and the remaining instruction keys as a literal list of
+# (key, value) pairs per instruction.
+binary_extension = '.cbb'
+binary_magic = 'CBMB'
+binary_version = 1
+binary_header = np.dtype([('magic', 'S4'), ('version', '<u4'),
+                          ('name_bytes', '<u4'), ('parts', '<u4'),
+                          ('config_bytes', '<u4'), ('config_width', '<u4'),
+                          ('ends', '<u4'), ('instructions', '<u4'),
+                          ('new_parts', '<u4'), ('extra_bytes', '<u4')])
+binary_instruction = np.dtype([('type', 'S1'), ('size', 'S1'), ('pad', 'S6'),
+                               ('vcenter', '<f8', (3,)), ('vout', '<f8', (3,)),
+                               ('vup', '<f8', (3,)), ('pixperunit', '<f8'),
+                               ('new_parts', '<u4'), ('extra_bytes', '<u4')])
+no_configure = 0xffff
+
+# Text model files
+instruction_sizes = {'f': 'full', 'r': 'fullr', 'q': 'quarter', 'h': 'halfh'}
+instruction_line = re.compile(r'^[ig] +((?:\S+ +){9}\S+)((?: +\d+)*) +([frqh])(?: +(.*))?$')
+instruction_key = re.compile(r'(?:^|\s)(\w+): ')
+
+def new_piece(name):
+    """
+    Returns a new piece of the class called name.  Raises KeyError if
+    there is none.
+    """
+    return pieces.registry[name]()
+
+def parse_instruction_keys(text):
+    """
+    Returns the (key, value) pairs of 'key1: value1 key2: value2 ...'
+    text.  Values may only be Python literals.  Each value runs to the
+    first following key that leaves it a complete literal, so strings
+    may contain colons.
+    """
+    keys = list(instruction_key.finditer(text))
+    if len(keys) == 0 or keys[0].start() != 0:
+        raise ValueError('bad instruction options: ' + text)
+    pairs = []
+    key_index = 0
+    while key_index < len(keys):
+        value_start = keys[key_index].end()
+        next_index = key_index + 1
+        while 1:
+            if next_index < len(keys):
+                value_end = keys[next_index].start()
+            else:
+                value_end = len(text)
+            try:
+                value = ast.literal_eval(text[value_start:value_end].strip())
+                break
+            except (SyntaxError, ValueError):
+                if next_index >= len(keys):
+                    raise
+                next_index = next_index + 1
+        pairs.append((keys[key_index].group(1), value))
+        key_index = next_index
+    return pairs
+
+def parse_instruction(line):
+    """
+    Returns the instruction in an 'i' or 'g' text line
+    """
+    match = instruction_line.match(line.strip())
+    if not match:
+        raise ValueError('bad instruction: ' + line)
+    floats, new_parts, size, defaults = match.groups()
+    floats = np.fromstring(floats, sep=' ')
+    inst = {'vcenter': floats[0:3],
+            'vout': floats[3:6],
+            'vup': floats[6:9],
+            'pixperunit': float(floats[9])}
+    inst['new_parts'] = map(lambda x: int(x), new_parts.split())
+    inst['size'] = instruction_sizes[size]
+    # Parse defaults
+    if defaults:
+        for key, value in parse_instruction_keys(defaults):
+            inst[key] = value
+    # Convert draw_old_parts_from to submodel
+    if inst.has_key('draw_old_parts_from'):
+        if inst['draw_old_parts_from'] == 0: # a pop
+            inst['submodel'] = -1
+        else:
+            inst['submodel'] = 1
+        del inst['draw_old_parts_from']
+    return inst
+
+def is_binary(filename):
+    """
+    Returns whether filename names a binary model file
+    """
+    return os.path.splitext(filename)[1].lower() == binary_extension
+
+def binary_section(data, offset, dtype, count):
+    """
+    Returns an array of count dtypes viewing data at offset and the
+    offset of the next section
+    """
+    dtype = np.dtype(dtype)
+    count = int(count)
+    section = np.frombuffer(data, dtype, count, offset)
+    offset = offset + dtype.itemsize*count
+    return section, offset + (-offset % 8)
+
+def write_section(fp, section):
+    """
+    Writes an array or string to fp, padded to 8 bytes
+    """
+    if isinstance(section, np.ndarray):
+        section = section.tostring()
+    fp.write(section)
+    fp.write('\0'*(-len(section) % 8))
+
 def absinvert(x):
     """
     Returns the number if >= 0.  Otherwise, returns the inversion of
@@ -69,6 +211,1255 @@ def absinvert(x):
     else:
         return ~x
 
+def ends_match(end1, end2, same_dir = 0):
+    """
+    Compares two ends whose tips are known to coincide.
+    Returns 1 if they are aligned with a good angle
+    Returns -1 if they are aligned with a bad angle
+    Returns 0 if they are not aligned
+    """
+    if ((same_dir == 0 and np.allclose(end1[0]-end1[1], end2[1]-end2[0], atol=xabstol, rtol=0.0)) or (same_dir == 1 and np.allclose(end1[0]-end1[1], end2[0]-end2[1], atol=xabstol, rtol=0.0))):
+        dp = np.dot(end1[0]-end1[2], end2[0]-end2[2])
+        if (-1.0 - xabstol < dp < -1.0 + xabstol) or \
+                (-xabstol < dp < xabstol) or \
+                (1.0 - xabstol < dp < 1.0 + xabstol):
+            return 1
+        else:
+            return -1
+    return 0
+
+def tip_pairs(tips):
+    """
+    Returns index arrays (a, b) of every ordered pair of distinct tips
+    closer than xabstol.  Tips are bucketed on a grid and each bucket
+    is matched against its neighbors by sorted search, so this is
+    O(n log n) rather than O(n**2).
+    """
+    if len(tips) == 0:
+        return np.zeros(0, np.intp), np.zeros(0, np.intp)
+    cell_size = 2.0*xabstol
+    cells = np.floor(tips/cell_size).astype(np.int64)
+    cells = cells - cells.min(0)
+    span = cells.max(0) + 3 # room for the neighbor offsets
+    keys = ((cells[:,0] + 1)*span[1] + cells[:,1] + 1)*span[2] + cells[:,2] + 1
+    order = np.argsort(keys, kind='mergesort')
+    sorted_keys = keys[order]
+    a_list = []
+    b_list = []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            for dz in (-1, 0, 1):
+                neighbor_keys = keys + (dx*span[1] + dy)*span[2] + dz
+                lo = np.searchsorted(sorted_keys, neighbor_keys, 'left')
+                hi = np.searchsorted(sorted_keys, neighbor_keys, 'right')
+                counts = hi - lo
+                total = counts.sum()
+                if total == 0:
+                    continue
+                a = np.repeat(np.arange(len(tips)), counts)
+                starts = np.repeat(lo - np.cumsum(counts) + counts, counts)
+                b = order[starts + np.arange(total)]
+                a_list.append(a)
+                b_list.append(b)
+    a = np.concatenate(a_list)
+    b = np.concatenate(b_list)
+    near = (a != b) & (vector_math.mag(tips[a] - tips[b]) < xabstol)
+    return a[near], b[near]
+
+def calc_parts_ends(parts):
+    """
+    Calculates the absolute ends and center of every part in parts,
+    as piece.calc_ends does for one.  The matrices are stacked into an
+    (N,4,4) array, the unaligned ends and center into a padded
+    (N,E+1,3,4) array, and all are transformed by a single einsum.
+    """
+    len_parts = len(parts)
+    if len_parts == 0:
+        return
+    groups = {} # id(unaligned_ends): (part, part indices)
+    for index, part in enumerate(parts):
+        key = id(part.unaligned_ends)
+        if groups.has_key(key):
+            groups[key][1].append(index)
+        else:
+            groups[key] = (part, [index])
+    len_ends = max(map(lambda x: len(x[0].unaligned_ends), groups.values()))
+    points = np.zeros((len_parts, len_ends + 1, 3, 4))
+    points[:,:,:,3] = 1.0
+    for part, indices in groups.values():
+        points[indices,:len(part.unaligned_ends),:,:3] = part.unaligned_ends
+        points[indices,len_ends,:,:3] = part.unaligned_center
+    matrices = np.array(map(lambda x: x.matrix, parts), np.float64)
+    ends = np.einsum('nki,nejk->neji', matrices[:,:,:3], points)
+    for index, part in enumerate(parts):
+        part.ends = ends[index,:len(part.unaligned_ends)]
+        part.center = ends[index,len_ends,0]
+        part.center_save = part.center[:]
+
+bound_radii = {} # part name: radius of its bounding sphere, made by part_bounds
+
+def part_bounds(parts, matrices = None):
+    """
+    Returns the (N,3) centers and (N,) radii of spheres holding parts
+    as drawn.  Centers come from the matrices, not part.center, so
+    parts moved but not yet written are bounded where they are drawn.
+    Other matrices (say, from before a move) may be given instead.
+    """
+    if len(parts) == 0:
+        return np.zeros((0, 3)), np.zeros(0)
+    if matrices is None:
+        matrices = map(lambda x: x.matrix, parts)
+    matrices = np.array(matrices, np.float64)
+    local_centers = np.array(map(lambda x: x.unaligned_center, parts), np.float64)
+    centers = np.einsum('nj,nji->ni', local_centers, matrices[:,:3,:3]) + matrices[:,3,:3]
+    radii = []
+    for part in parts:
+        if not bound_radii.has_key(part.name):
+            bound_radii[part.name] = part.bound_radius()
+        radii.append(bound_radii[part.name])
+    return centers, np.array(radii)
+
+def part_detail(part):
+    """
+    Returns the detail to draw part with.  That is pieces.detail,
+    unless auto_detail is set and the part is small on the screen.
+    Then it is 1 (solid) or 0 (a proxy; see piece.draw_proxy).  The
+    view is orthographic, so the size on the screen depends only on
+    the part's bounds and pixperunit, not on its distance.
+    """
+    if not auto_detail or generate_pdf:
+        return pieces.detail
+    if not bound_radii.has_key(part.name):
+        bound_radii[part.name] = part.bound_radius()
+    pixels = 2.0*bound_radii[part.name]*pixperunit
+    if pixels < proxy_pixels:
+        return 0
+    elif pixels < solid_pixels:
+        return min(pieces.detail, 1)
+    return pieces.detail
+
+def make_shape_lists(part):
+    """
+    Makes the display lists part.draw_shape calls, which can't be made
+    while another list is.  Color and depth writes are off, so nothing
+    is drawn, and the matrix is restored, since some shapes rotate it.
+    """
+    pieces.list_drawings = 1
+    glPushAttrib(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+    glColorMask(GL_FALSE, GL_FALSE, GL_FALSE, GL_FALSE)
+    glDepthMask(GL_FALSE)
+    glPushMatrix()
+    try:
+        part.draw_shape()
+    finally:
+        glPopMatrix()
+        glPopAttrib()
+        pieces.list_drawings = 0
+
+def round_tenths(values):
+    """
+    Returns values rounded to one decimal place the way round(x, 1)
+    does: half away from zero, on the exact binary value.  Values too
+    near a tie to decide after scaling are passed to round.
+    """
+    values = np.asarray(values, np.float64)
+    scaled = 10.0*values
+    magnitudes = np.abs(scaled)
+    rounded = np.copysign(np.floor(magnitudes + 0.5), scaled)/10.0
+    near_ties = np.abs(magnitudes - np.floor(magnitudes) - 0.5) < 1e-6
+    for index in zip(*np.nonzero(near_ties)):
+        rounded[index] = round(values[index], 1)
+    return rounded
+
+def string_table(strings):
+    """
+    Returns strings as a NUL padded (len(strings), width) uint8 array
+    """
+    width = max(map(len, strings))
+    return np.frombuffer(''.join(map(lambda x: x.ljust(width, '\0'), strings)), np.uint8).reshape((len(strings), width))
+
+def format_tenths(prefixes, rows):
+    """
+    Returns lines of each prefix followed by its row of values rounded
+    to tenths, written as str would write them.  Each distinct prefix
+    and value is formatted once; the lines are assembled as a byte
+    array.
+    """
+    if len(prefixes) == 0:
+        return ''
+    rows = round_tenths(rows)
+    values = rows.ravel()
+    codes = 2*np.rint(10.0*values).astype(np.int64) + np.signbit(values) # keeps -0.0
+    low = codes.min()
+    span = codes.max() - low + 1
+    if span <= 2*len(codes) + 1024: # Count off the codes directly
+        present = np.zeros(span, np.bool_)
+        present[codes - low] = True
+        uniques = np.nonzero(present)[0] + low
+        inverse = (np.cumsum(present) - 1)[codes - low]
+    else:
+        uniques, inverse = np.unique(codes, return_inverse=True)
+    strings = []
+    for code in uniques.tolist():
+        value = (code >> 1)/10.0
+        if code == 1:
+            value = -0.0
+        strings.append(str(value) + ' ')
+    fields = string_table(strings)[inverse]
+    fields = fields.reshape((rows.shape[0], rows.shape[1], -1))
+    last = fields[:,-1]
+    last[last == ord(' ')] = ord('\n')
+    prefix_indices = {}
+    for prefix in prefixes:
+        prefix_indices.setdefault(prefix, len(prefix_indices))
+    prefix_fields = string_table(sorted(prefix_indices.keys(), key = lambda x: prefix_indices[x]))
+    prefix_fields = prefix_fields[map(lambda x: prefix_indices[x], prefixes)]
+    lines = np.concatenate((prefix_fields, fields.reshape((rows.shape[0], -1))), 1).ravel()
+    return lines[lines != 0].tostring()
+
+def part_state(part):
+    """
+    Returns what moving a part changes, for the history
+    """
+    return (part.matrix, part.ends, part.center, part.center_save)
+
+def set_part_state(part, state):
+    part.matrix, part.ends, part.center, part.center_save = state
+
+class end_index(object):
+    """
+    A spatial hash of end tips.  Each tip is filed under the grid
+    cell it falls in, so finding the ends at a tip only looks at one
+    cell (or a few, when the tip is within xabstol of a cell wall)
+    rather than at every end.  Ends are known by ids, which only
+    increase, so a list of ids kept in end order is always sorted.
+    """
+
+    def __init__(self):
+        self.cell_size = pieces.lenp5/4.0 # A quarter of the model lattice
+        self.cells = {} # cell key: list of end ids
+        self.keys = {} # end id: cell key
+        self.last_id = -1
+
+    def clear(self):
+        self.cells = {}
+        self.keys = {}
+
+    def add(self, tip, end_id = None):
+        """
+        Files a tip and returns its end id.  A new id is issued
+        unless one is passed.
+        """
+        if end_id is None:
+            self.last_id = self.last_id + 1
+            end_id = self.last_id
+        else:
+            self.last_id = max(self.last_id, end_id)
+        key = (int(math.floor(tip[0]/self.cell_size)),
+               int(math.floor(tip[1]/self.cell_size)),
+               int(math.floor(tip[2]/self.cell_size)))
+        if self.cells.has_key(key):
+            self.cells[key].append(end_id)
+        else:
+            self.cells[key] = [end_id]
+        self.keys[end_id] = key
+        return end_id
+
+    def remove(self, end_id):
+        key = self.keys.pop(end_id)
+        cell = self.cells[key]
+        cell.remove(end_id)
+        if len(cell) == 0:
+            del self.cells[key]
+
+    def query(self, tip):
+        """
+        Returns the ids of every end whose tip may be within xabstol
+        of tip.  The caller must still check the distance.
+        """
+        ranges = []
+        for x in tip[:3]:
+            ranges.append(range(int(math.floor((x - xabstol)/self.cell_size)),
+                                int(math.floor((x + xabstol)/self.cell_size)) + 1))
+        end_ids = []
+        for i in ranges[0]:
+            for j in ranges[1]:
+                for k in ranges[2]:
+                    end_ids.extend(self.cells.get((i, j, k), []))
+        return end_ids
+
+class bounds_tree(object):
+    """
+    A bounding volume hierarchy over part bounding spheres.  Each node
+    is a box around its parts, split at the median of its longest
+    side, down to LEAF parts.  Finding the parts in the view only
+    visits the nodes crossing its edges: nodes wholly outside are
+    dropped, and nodes wholly inside are taken, without looking at
+    their parts.  A level of nodes is tested at a time.
+    """
+
+    LEAF = 32 # parts in a leaf node
+
+    def __init__(self, centers, radii):
+        self.count = len(centers)
+        self.centers = centers
+        self.radii = radii
+        self.order = np.arange(self.count) # parts, grouped by node
+        self.lows = [] # node box corners
+        self.highs = []
+        self.starts = [] # node parts are self.order[start:stop]
+        self.stops = []
+        self.lefts = [] # node children, or -1 for leaves
+        self.rights = []
+        if self.count > 0:
+            self.build(0, self.count)
+        self.lows = np.array(self.lows)
+        self.highs = np.array(self.highs)
+        self.starts = np.array(self.starts, np.intp)
+        self.stops = np.array(self.stops, np.intp)
+        self.lefts = np.array(self.lefts, np.intp)
+        self.rights = np.array(self.rights, np.intp)
+
+    def build(self, start, stop):
+        """
+        Adds the node for self.order[start:stop] and returns its index
+        """
+        indices = self.order[start:stop]
+        low = np.min(self.centers[indices] - self.radii[indices,np.newaxis], 0)
+        high = np.max(self.centers[indices] + self.radii[indices,np.newaxis], 0)
+        node = len(self.starts)
+        self.lows.append(low)
+        self.highs.append(high)
+        self.starts.append(start)
+        self.stops.append(stop)
+        self.lefts.append(-1)
+        self.rights.append(-1)
+        if stop - start > self.LEAF:
+            axis = np.argmax(high - low)
+            middle = (stop - start)//2
+            split = np.argpartition(self.centers[indices,axis], middle)
+            self.order[start:stop] = indices[split]
+            self.lefts[node] = self.build(start, start + middle)
+            self.rights[node] = self.build(start + middle, stop)
+        return node
+
+    def visible(self, planes):
+        """
+        Returns a boolean mask of the parts at least partly inside
+        planes, from vector_math.frustum_planes
+        """
+        mask = np.zeros(self.count, bool)
+        if self.count == 0:
+            return mask
+        normals = np.transpose(planes[:,:3])
+        nodes = np.array([0])
+        while len(nodes) > 0:
+            # Distances of the box centers, and the box half widths
+            # along each normal
+            distances = np.dot((self.lows[nodes] + self.highs[nodes])/2.0, normals) + planes[:,3]
+            spans = np.dot((self.highs[nodes] - self.lows[nodes])/2.0, np.abs(normals))
+            crossing = np.all(distances >= -spans, 1) # Not wholly outside
+            inside = np.all(distances[crossing] >= spans[crossing], 1)
+            nodes = nodes[crossing]
+            for node in nodes[inside]:
+                mask[self.order[self.starts[node]:self.stops[node]]] = True
+            nodes = nodes[~inside]
+            leaves = nodes[self.lefts[nodes] < 0]
+            if len(leaves) > 0:
+                indices = self.order[np.concatenate(map(lambda x: np.arange(self.starts[x], self.stops[x]), leaves))]
+                mask[indices] = vector_math.spheres_visible(planes, self.centers[indices], self.radii[indices])
+            nodes = nodes[self.lefts[nodes] >= 0]
+            nodes = np.concatenate((self.lefts[nodes], self.rights[nodes]))
+        return mask
+
+class region_sets(object):
+    """
+    A disjoint-set forest of region keys (part indices, or inverted
+    part indices for the rotated side of joinrots).  Each region is a
+    numbered slot; merged slots point to their survivor, and lookups
+    compress the path.  Members are kept as linked lists so a merge
+    appends one region to another in constant time.
+    """
+
+    def __init__(self):
+        self.parents = [] # slot: parent slot; a root is its own parent
+        self.firsts = [] # slot: first key
+        self.lasts = [] # slot: last key
+        self.nexts = {} # key: next key in the region
+        self.slots = {} # key: slot where it was added
+
+    def has_key(self, key):
+        return self.slots.has_key(key)
+
+    def add(self, key, slot = None):
+        """
+        Adds key to the region at slot, or to a new region if slot is
+        None.  Returns the slot.
+        """
+        if slot is None:
+            slot = len(self.parents)
+            self.parents.append(slot)
+            self.firsts.append(key)
+            self.lasts.append(key)
+        else:
+            self.nexts[self.lasts[slot]] = key
+            self.lasts[slot] = key
+        self.slots[key] = slot
+        return slot
+
+    def find(self, key):
+        """
+        Returns the slot of the region holding key
+        """
+        slot = self.slots[key]
+        root = slot
+        while self.parents[root] != root:
+            root = self.parents[root]
+        while self.parents[slot] != root:
+            self.parents[slot], slot = root, self.parents[slot]
+        return root
+
+    def union(self, slot1, slot2):
+        """
+        Appends the members of the region at root slot2 to the region
+        at root slot1
+        """
+        self.parents[slot2] = slot1
+        self.nexts[self.lasts[slot1]] = self.firsts[slot2]
+        self.lasts[slot1] = self.lasts[slot2]
+
+    def regions(self):
+        """
+        Returns a list of the regions, in slot order, each a list of keys
+        """
+        regions = []
+        for slot, parent in enumerate(self.parents):
+            if parent == slot:
+                region = [self.firsts[slot]]
+                last = self.lasts[slot]
+                while region[-1] != last:
+                    region.append(self.nexts[region[-1]])
+                regions.append(region)
+        return regions
+
+class part_batch(object):
+    """
+    The parts of one type.  Their matrices are kept in an instance
+    buffer.  One display list draws the shape, and each of the others
+    places it at batch_rows rows of the buffer, so a part added,
+    removed, or moved remakes only the lists holding its rows.
+    """
+
+    def __init__(self):
+        self.parts = []
+        self.rows = {} # id(part): row in self.parts and self.matrices
+        self.matrices = np.zeros((16, 4, 4), np.float32)
+        self.shape_gllist = 0
+        self.gllists = [] # display list placing each batch_rows rows
+        self.changed = set() # indices of self.gllists to remake
+        self.detail = None # part_detail when self.shape_gllist was made
+
+    def add(self, part):
+        row = len(self.parts)
+        if row >= len(self.matrices):
+            self.matrices = np.concatenate((self.matrices, np.zeros_like(self.matrices)))
+        self.matrices[row] = part.matrix
+        self.rows[id(part)] = row
+        self.parts.append(part)
+        self.changed.add(row/batch_rows)
+
+    def remove(self, part):
+        """
+        Removes a part by moving the last part into its row
+        """
+        row = self.rows.pop(id(part))
+        last = self.parts.pop()
+        if last is not part:
+            self.parts[row] = last
+            self.matrices[row] = self.matrices[len(self.parts)]
+            self.rows[id(last)] = row
+        self.changed.add(row/batch_rows)
+        self.changed.add(len(self.parts)/batch_rows)
+
+    def move(self, part):
+        row = self.rows[id(part)]
+        self.matrices[row] = part.matrix
+        self.changed.add(row/batch_rows)
+
+    def delete_list(self):
+        if self.shape_gllist:
+            glDeleteLists(self.shape_gllist, 1)
+            self.shape_gllist = 0
+        for gllist in self.gllists:
+            if gllist:
+                glDeleteLists(gllist, 1)
+        self.gllists = []
+        self.changed = set()
+        self.detail = None
+
+    def place_rows(self, index):
+        """
+        Draws the shape at each matrix in the rows of self.gllists[index]
+        """
+        for matrix in self.matrices[index*batch_rows:min(len(self.parts), (index + 1)*batch_rows)]:
+            glPushMatrix()
+            glMultMatrixf(matrix)
+            glCallList(self.shape_gllist)
+            glPopMatrix()
+
+    def draw(self):
+        """
+        Draws every part of the type, first remaking the shape list if
+        the detail changed and the lists of rows that changed.  The
+        lists of rows call the shape list, so they stay valid when
+        only the detail changes.
+        """
+        detail = part_detail(self.parts[0])
+        if self.detail != detail:
+            make_shape_lists(self.parts[0])
+            if self.shape_gllist == 0:
+                self.shape_gllist = glGenLists(1)
+            if self.shape_gllist == 0: # Out of lists; draw one at a time
+                for part in self.parts:
+                    part.draw()
+                return
+            glNewList(self.shape_gllist, GL_COMPILE)
+            self.parts[0].draw_shape()
+            glEndList()
+            self.detail = detail
+
+        count = (len(self.parts) + batch_rows - 1)/batch_rows
+        while len(self.gllists) > count:
+            gllist = self.gllists.pop()
+            if gllist:
+                glDeleteLists(gllist, 1)
+        while len(self.gllists) < count:
+            self.changed.add(len(self.gllists))
+            self.gllists.append(glGenLists(1)) # 0 if out of lists
+        for index in self.changed:
+            if index < count and self.gllists[index]:
+                glNewList(self.gllists[index], GL_COMPILE)
+                self.place_rows(index)
+                glEndList()
+        self.changed = set()
+
+        for index, gllist in enumerate(self.gllists):
+            if gllist:
+                glCallList(gllist)
+            else:
+                self.place_rows(index)
+
+class part_batches(object):
+    """
+    The parts of a module batched by type (name and configure), so
+    drawing the module takes one display list call per type instead
+    of several GL calls per part.  Only the lists holding the rows of
+    parts added, removed, or moved are remade.
+    """
+
+    def __init__(self):
+        self.batches = {} # (name, configure): part_batch
+        self.keys = {} # id(part): (name, configure)
+        self.changed = 1 # Set when parts are added, removed, or moved
+
+    def clear(self):
+        for batch in self.batches.values():
+            batch.delete_list()
+        self.batches = {}
+        self.keys = {}
+        self.changed = 1
+
+    def add(self, part):
+        key = (part.name, tuple(part.configure))
+        if not self.batches.has_key(key):
+            self.batches[key] = part_batch()
+        self.batches[key].add(part)
+        self.keys[id(part)] = key
+        self.changed = 1
+
+    def remove(self, part):
+        self.changed = 1
+        key = self.keys.pop(id(part))
+        batch = self.batches[key]
+        batch.remove(part)
+        if len(batch.parts) == 0:
+            batch.delete_list()
+            del self.batches[key]
+
+    def move(self, part):
+        self.changed = 1
+        if self.keys.has_key(id(part)):
+            self.batches[self.keys[id(part)]].move(part)
+
+    def reconfigure(self, part):
+        """
+        Files part under its type again, after its configure changed
+        """
+        if self.keys.has_key(id(part)) and self.keys[id(part)] != (part.name, tuple(part.configure)):
+            self.remove(part)
+            self.add(part)
+
+    def splice(self, removed, added):
+        for part in removed:
+            self.remove(part)
+        for part in added:
+            self.add(part)
+
+    def draw(self):
+        for batch in self.batches.values():
+            batch.draw()
+
+class point_array(object):
+    """
+    Points kept in order in one contiguous (N,3) array, which grows by
+    doubling, so NumPy can use them without collecting them from
+    objects first
+    """
+
+    def __init__(self):
+        self.buffer = np.zeros((16, 3))
+        self.count = 0
+
+    def points(self):
+        return self.buffer[:self.count]
+
+    def splice(self, index, count, points):
+        """
+        Replaces the count points from index with points
+        """
+        points = np.reshape(np.asarray(points, np.float64), (-1, 3))
+        new_count = self.count - count + len(points)
+        if new_count > len(self.buffer):
+            size = len(self.buffer)
+            while size < new_count:
+                size = 2*size
+            buffer = np.zeros((size, 3))
+            buffer[:self.count] = self.buffer[:self.count]
+            self.buffer = buffer
+        if len(points) != count:
+            self.buffer[index+len(points):new_count] = self.buffer[index+count:self.count].copy()
+        self.buffer[index:index+len(points)] = points
+        self.count = new_count
+
+    def reset(self, points):
+        self.splice(0, self.count, points)
+
+def delete_framebuffer(fbo, renderbuffers):
+    """
+    Deletes a framebuffer object and its renderbuffers.  PyOpenGL's
+    glDeleteFramebuffers takes the count as well as the list, and
+    raises ValueError without it.
+    """
+    glDeleteFramebuffers(1, [fbo])
+    glDeleteRenderbuffers(len(renderbuffers), renderbuffers)
+
+class background_cache(object):
+    """
+    The drawn module, color and depth, kept on the graphics card in a
+    framebuffer object.  Copying it to and from the window with
+    glBlitFramebuffer takes the same time for any module, unlike
+    reading the pixels back with glReadPixels.
+    """
+
+    def __init__(self):
+        self.fbo = 0
+        self.renderbuffers = []
+        self.size = None # (width, height) of self.fbo
+        self.context = None # GL context self.fbo belongs to
+        self.failed = 0 # Set once a framebuffer object doesn't work
+
+    def available(self):
+        return background_fbo and not self.failed and bool(glGenFramebuffers) and bool(glBlitFramebuffer)
+
+    def delete(self):
+        if self.fbo and self.context == contextdata.getContext():
+            delete_framebuffer(self.fbo, self.renderbuffers)
+        self.fbo = 0
+        self.renderbuffers = []
+        self.size = None
+
+    def allocate(self, width, height):
+        """
+        Makes a framebuffer object the size of the window, with a
+        depth buffer like the window's, so depth can be blitted
+        """
+        self.delete()
+        if glGetIntegerv(GL_STENCIL_BITS) > 0:
+            depth_format = GL_DEPTH24_STENCIL8
+            depth_attachment = GL_DEPTH_STENCIL_ATTACHMENT
+        else:
+            depth_format = {16: GL_DEPTH_COMPONENT16, 32: GL_DEPTH_COMPONENT32}.get(int(glGetIntegerv(GL_DEPTH_BITS)), GL_DEPTH_COMPONENT24)
+            depth_attachment = GL_DEPTH_ATTACHMENT
+        self.context = contextdata.getContext()
+        self.fbo = glGenFramebuffers(1)
+        self.renderbuffers = glGenRenderbuffers(2)
+        glBindFramebuffer(GL_FRAMEBUFFER, self.fbo)
+        for renderbuffer, internal_format, attachment in zip(self.renderbuffers,
+                                                             (GL_RGBA8, depth_format),
+                                                             (GL_COLOR_ATTACHMENT0, depth_attachment)):
+            glBindRenderbuffer(GL_RENDERBUFFER, renderbuffer)
+            glRenderbufferStorage(GL_RENDERBUFFER, internal_format, width, height)
+            glFramebufferRenderbuffer(GL_FRAMEBUFFER, attachment, GL_RENDERBUFFER, renderbuffer)
+        glBindRenderbuffer(GL_RENDERBUFFER, 0)
+        if glCheckFramebufferStatus(GL_FRAMEBUFFER) != GL_FRAMEBUFFER_COMPLETE:
+            glBindFramebuffer(GL_FRAMEBUFFER, window_fbo)
+            raise GLError(err = 0, description = 'incomplete background framebuffer')
+        glBindFramebuffer(GL_FRAMEBUFFER, window_fbo)
+        self.size = (width, height)
+
+    def blit(self, viewport, capture, mask):
+        """
+        Copies the window to (capture = 1) or from (capture = 0)
+        self.fbo.  Returns 1 if it worked.  After a failure, the
+        framebuffer object isn't used again.
+        """
+        if not self.available():
+            return 0
+        x, y, width, height = viewport
+        try:
+            if self.size != (width, height) or self.context != contextdata.getContext():
+                if capture:
+                    self.allocate(width, height)
+                else:
+                    return 0
+            if capture:
+                glBindFramebuffer(GL_READ_FRAMEBUFFER, window_fbo)
+                glReadBuffer(window_buffer)
+                glBindFramebuffer(GL_DRAW_FRAMEBUFFER, self.fbo)
+                glBlitFramebuffer(x, y, x+width, y+height, 0, 0, width, height, mask, GL_NEAREST)
+            else:
+                glBindFramebuffer(GL_READ_FRAMEBUFFER, self.fbo)
+                glBindFramebuffer(GL_DRAW_FRAMEBUFFER, window_fbo)
+                glBlitFramebuffer(0, 0, width, height, x, y, x+width, y+height, mask, GL_NEAREST)
+            glBindFramebuffer(GL_FRAMEBUFFER, window_fbo)
+        except GLError, error:
+            print 'Warning: background framebuffer failed (' + str(error.description) + '), using glReadPixels'
+            self.failed = 1
+            try:
+                glBindFramebuffer(GL_FRAMEBUFFER, window_fbo)
+            except GLError:
+                pass
+            return 0
+        return 1
+
+    def read_depth(self):
+        """
+        Returns the captured depth
+        """
+        width, height = self.size
+        glBindFramebuffer(GL_READ_FRAMEBUFFER, self.fbo)
+        depth = glReadPixelsf(0, 0, width, height, GL_DEPTH_COMPONENT)
+        glBindFramebuffer(GL_READ_FRAMEBUFFER, window_fbo)
+        glReadBuffer(window_buffer)
+        return depth
+
+# Outlines the pixels that the ring of offsets from
+# vector_math.offsets(radius, radius - 1) reaches in front of by more
+# than shadow, like vector_math.outline_mask.  Loops must have constant
+# bounds, so radius is limited to 8.
+outline_fragment_shader = """
+#version 110
+uniform sampler2D depth;
+uniform vec2 size;
+uniform float radius;
+uniform float shadow;
+uniform vec3 color;
+
+void main()
+{
+    vec2 here = gl_TexCoord[0].st;
+    float inner = max(radius - 1.0, 0.0);
+    float nearest = 2.0;
+    for (int y = -8; y <= 8; y++) {
+        for (int x = -8; x <= 8; x++) {
+            float distance2 = float(x*x + y*y);
+            vec2 there = here + vec2(float(x), float(y))/size;
+            if (distance2 > inner*inner && distance2 <= radius*radius &&
+                all(greaterThanEqual(there, vec2(0.0))) && all(lessThan(there, vec2(1.0))))
+                nearest = min(nearest, texture2D(depth, there).r);
+        }
+    }
+    if (nearest + shadow < texture2D(depth, here).r)
+        gl_FragColor = vec4(color, 1.0);
+    else
+        discard;
+}
+"""
+
+class outline_pass(object):
+    """
+    Draws part outlines on the graphics card.  The depth buffer is
+    copied to a texture, and a fragment shader over the whole window
+    finds the outline, so nothing is read back or sent as a bitmap.
+    """
+
+    def __init__(self):
+        self.program = 0
+        self.texture = 0
+        self.size = None # (width, height) of self.texture
+        self.context = None # GL context self.program belongs to
+        self.failed = 0 # Set once the shader doesn't work
+
+    def available(self):
+        return outline_shader and not self.failed and bool(glCreateShader)
+
+    def delete(self):
+        if self.context == contextdata.getContext():
+            if self.program:
+                glDeleteProgram(self.program)
+            if self.texture:
+                glDeleteTextures([self.texture])
+        self.program = 0
+        self.texture = 0
+        self.size = None
+
+    def allocate(self, width, height):
+        if self.context != contextdata.getContext():
+            self.program = 0
+            self.texture = 0
+            self.context = contextdata.getContext()
+        if not self.program:
+            self.program = shaders.compileProgram(shaders.compileShader(outline_fragment_shader, GL_FRAGMENT_SHADER))
+        if not self.texture:
+            self.texture = glGenTextures(1)
+            self.size = None
+        glBindTexture(GL_TEXTURE_2D, self.texture)
+        if self.size != (width, height):
+            glTexImage2D(GL_TEXTURE_2D, 0, GL_DEPTH_COMPONENT, width, height, 0, GL_DEPTH_COMPONENT, GL_FLOAT, None)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
+            glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_COMPARE_MODE, GL_NONE)
+            glTexParameteri(GL_TEXTURE_2D, GL_DEPTH_TEXTURE_MODE, GL_LUMINANCE)
+            self.size = (width, height)
+
+    def draw(self, viewport, radius, shadow, color):
+        """
+        Outlines the drawn module, leaving the depth buffer alone.
+        Returns 1 if it worked.  After a failure, the shader isn't
+        used again.
+        """
+        if not self.available():
+            return 0
+        x, y, width, height = viewport
+        try:
+            self.allocate(width, height)
+            glCopyTexSubImage2D(GL_TEXTURE_2D, 0, 0, 0, x, y, width, height)
+
+            glPushAttrib(GL_ENABLE_BIT | GL_DEPTH_BUFFER_BIT | GL_TEXTURE_BIT)
+            glDisable(GL_LIGHTING)
+            glDisable(GL_DEPTH_TEST)
+            glDepthMask(GL_FALSE)
+            glUseProgram(self.program)
+            glUniform1i(glGetUniformLocation(self.program, 'depth'), 0)
+            glUniform2f(glGetUniformLocation(self.program, 'size'), width, height)
+            glUniform1f(glGetUniformLocation(self.program, 'radius'), min(radius, 8))
+            glUniform1f(glGetUniformLocation(self.program, 'shadow'), shadow)
+            glUniform3f(glGetUniformLocation(self.program, 'color'), color[0], color[1], color[2])
+            glMatrixMode(GL_PROJECTION)
+            glPushMatrix()
+            glLoadIdentity()
+            glMatrixMode(GL_MODELVIEW)
+            glPushMatrix()
+            glLoadIdentity()
+            glBegin(GL_QUADS)
+            for corner in [(0.0, 0.0), (1.0, 0.0), (1.0, 1.0), (0.0, 1.0)]:
+                glTexCoord2f(corner[0], corner[1])
+                glVertex2f(2.0*corner[0] - 1.0, 2.0*corner[1] - 1.0)
+            glEnd()
+            glPopMatrix()
+            glMatrixMode(GL_PROJECTION)
+            glPopMatrix()
+            glMatrixMode(GL_MODELVIEW)
+            glUseProgram(0)
+            glBindTexture(GL_TEXTURE_2D, 0)
+            glPopAttrib()
+        except (GLError, RuntimeError), error:
+            print 'Warning: outline shader failed (' + str(error).strip().split('\n')[0] + '), drawing outlines with NumPy'
+            self.failed = 1
+            try:
+                glUseProgram(0)
+            except GLError:
+                pass
+            return 0
+        return 1
+
+id_fragment_shader = """
+#version 110
+uniform vec3 id;
+
+void main()
+{
+    gl_FragColor = vec4(id, 1.0);
+}
+"""
+
+class id_picker(object):
+    """
+    Picks what is drawn under the pointer.  Each pickable thing is
+    drawn in a color encoding its id into a small framebuffer object
+    covering only the pixels around the pointer, and those pixels are
+    read back.  Depth testing hides what is behind.  Callers draw
+    only what lies in the picked pixels' frustum (see
+    module.pick_parts), so the drawing grows with what is under the
+    pointer, not with the module.
+    """
+
+    SIZE = 7 # pixels on a side picked from, so small ends can be hit
+
+    def __init__(self):
+        self.fbo = 0
+        self.renderbuffers = []
+        self.program = 0
+        self.location = -1 # of the id uniform
+        self.context = None # GL context self.fbo belongs to
+        self.failed = 0 # Set once picking doesn't work
+
+    def available(self):
+        return id_picking and not self.failed and bool(glGenFramebuffers) and bool(glCreateShader)
+
+    def delete(self):
+        if self.context == contextdata.getContext():
+            if self.fbo:
+                delete_framebuffer(self.fbo, self.renderbuffers)
+            if self.program:
+                glDeleteProgram(self.program)
+        self.fbo = 0
+        self.renderbuffers = []
+        self.program = 0
+
+    def allocate(self):
+        """
+        Makes the framebuffer object and the shader drawing ids
+        """
+        self.delete()
+        self.context = contextdata.getContext()
+        self.program = shaders.compileProgram(shaders.compileShader(id_fragment_shader, GL_FRAGMENT_SHADER))
+        self.location = glGetUniformLocation(self.program, 'id')
+        self.fbo = glGenFramebuffers(1)
+        self.renderbuffers = glGenRenderbuffers(2)
+        glBindFramebuffer(GL_FRAMEBUFFER, self.fbo)
+        for renderbuffer, internal_format, attachment in zip(self.renderbuffers,
+                                                             (GL_RGBA8, GL_DEPTH_COMPONENT24),
+                                                             (GL_COLOR_ATTACHMENT0, GL_DEPTH_ATTACHMENT)):
+            glBindRenderbuffer(GL_RENDERBUFFER, renderbuffer)
+            glRenderbufferStorage(GL_RENDERBUFFER, internal_format, self.SIZE, self.SIZE)
+            glFramebufferRenderbuffer(GL_FRAMEBUFFER, attachment, GL_RENDERBUFFER, renderbuffer)
+        glBindRenderbuffer(GL_RENDERBUFFER, 0)
+        if glCheckFramebufferStatus(GL_FRAMEBUFFER) != GL_FRAMEBUFFER_COMPLETE:
+            glBindFramebuffer(GL_FRAMEBUFFER, window_fbo)
+            raise GLError(err = 0, description = 'incomplete picking framebuffer')
+        glBindFramebuffer(GL_FRAMEBUFFER, window_fbo)
+
+    def identify(self, id):
+        """
+        Draws what follows as id (0 hides, but isn't picked)
+        """
+        glUniform3f(self.location, (id & 0xff)/255.0, ((id >> 8) & 0xff)/255.0, ((id >> 16) & 0xff)/255.0)
+
+    def pick(self, x, y, draw):
+        """
+        Calls draw(identify) to draw around window x, y, with the
+        current matrices.  Returns the id drawn nearest x, y, 0 if
+        none is, or None if picking isn't possible.  After a failure,
+        picking isn't used again.
+        """
+        if not self.available():
+            return None
+        size = self.SIZE
+        try:
+            if not self.fbo or self.context != contextdata.getContext():
+                self.allocate()
+            viewport = glGetIntegerv(GL_VIEWPORT)
+            projection = glGetDoublev(GL_PROJECTION_MATRIX)
+
+            glBindFramebuffer(GL_FRAMEBUFFER, self.fbo)
+            glPushAttrib(GL_ENABLE_BIT | GL_VIEWPORT_BIT | GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+            glViewport(0, 0, size, size)
+            glDisable(GL_LIGHTING)
+            glDisable(GL_BLEND)
+            glDisable(GL_DITHER)
+            glEnable(GL_DEPTH_TEST)
+            glDepthMask(GL_TRUE)
+            glColorMask(GL_TRUE, GL_TRUE, GL_TRUE, GL_TRUE)
+            glClearColor(0.0, 0.0, 0.0, 0.0)
+            glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+            glMatrixMode(GL_PROJECTION)
+            glPushMatrix()
+            glLoadIdentity()
+            gluPickMatrix(x, y, size, size, viewport)
+            glMultMatrixd(projection)
+            glMatrixMode(GL_MODELVIEW)
+            glUseProgram(self.program)
+            draw(self.identify)
+            glUseProgram(0)
+            glMatrixMode(GL_PROJECTION)
+            glPopMatrix()
+            glMatrixMode(GL_MODELVIEW)
+
+            glReadBuffer(GL_COLOR_ATTACHMENT0)
+            pixels = glReadPixels(0, 0, size, size, GL_RGB, GL_UNSIGNED_BYTE) # A string on some PyOpenGL
+            pixels = np.reshape(np.frombuffer(pixels, np.uint8), (size, size, 3)).astype(np.int32)
+            glPopAttrib()
+            glBindFramebuffer(GL_FRAMEBUFFER, window_fbo)
+            glReadBuffer(window_buffer)
+        except (GLError, RuntimeError), error:
+            print 'Warning: picking failed (' + str(error).strip().split('\n')[0] + '), picking by center'
+            self.failed = 1
+            try:
+                glUseProgram(0)
+                glBindFramebuffer(GL_FRAMEBUFFER, window_fbo)
+            except GLError:
+                pass
+            return None
+
+        ids = pixels[:,:,0] + (pixels[:,:,1] << 8) + (pixels[:,:,2] << 16)
+        if not ids.any():
+            return 0
+        offset = np.arange(size) - size//2
+        distances = offset[:,np.newaxis]**2 + offset**2
+        distances[ids == 0] = size*size
+        return int(ids.flat[np.argmin(distances)])
+
+# Passes vertices on, in eye space, for transform feedback
+capture_vertex_shader = """
+#version 120
+varying vec3 position;
+varying vec3 normal;
+varying vec3 color;
+
+void main()
+{
+    position = (gl_ModelViewMatrix*gl_Vertex).xyz;
+    normal = gl_NormalMatrix*gl_Normal;
+    color = gl_Color.rgb;
+    gl_Position = ftransform();
+}
+"""
+
+class tessellation_cache(object):
+    """
+    The triangles of piece shapes, by (name, configure, detail).  GLE
+    extrudes a shape anew each session, which is most of the time
+    spent before a large module first appears.  Instead, a shape is
+    drawn once with transform feedback capturing its triangles into
+    arrays, which are saved to a directory and read at the next
+    start.
+
+    Shapes are captured in a placeholder color.  Vertices left in it
+    take the piece color when drawn; the rest (tires, gears) keep the
+    color the shape gave them.
+    """
+
+    PLACEHOLDER = np.array([1.0, 0.0, 1.0], np.float32)
+
+    def __init__(self):
+        self.meshes = {} # key: (vertices, normals, painted vertices, painted normals, painted colors)
+        self.directory = '' # where meshes are saved, if anywhere
+        self.program = 0
+        self.buffer = 0
+        self.capacity = 0 # vertices self.buffer holds
+        self.queries = []
+        self.context = None # GL context self.program belongs to
+        self.failed = 0 # Set once capturing doesn't work
+
+    def available(self):
+        return cache_shapes and not self.failed and bool(glTransformFeedbackVaryings)
+
+    def signature(self):
+        """
+        Returns a digest of what shapes depend on, so saved meshes
+        aren't used once pieces.py or the piece colors change
+        """
+        digest = hashlib.md5()
+        source = os.path.splitext(pieces.__file__)[0] + '.py'
+        if os.path.exists(source):
+            digest.update(open(source, 'rb').read())
+        digest.update(repr(sorted(colors.items())))
+        return digest.hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.directory, hashlib.md5(repr(key)).hexdigest() + '.npz')
+
+    def load(self, directory):
+        """
+        Reads the meshes saved under directory, and saves new ones there
+        """
+        self.directory = os.path.join(directory, self.signature())
+        for filename in glob.glob(os.path.join(self.directory, '*.npz')):
+            try:
+                data = np.load(filename)
+                key = (str(data['name']), tuple(map(str, data['configure'])), int(data['detail']))
+                self.meshes[key] = tuple(map(lambda x: data[x], ('vertices', 'normals', 'painted_vertices', 'painted_normals', 'painted_colors')))
+                data.close()
+            except (IOError, KeyError, ValueError, zipfile.BadZipfile), error:
+                print 'Warning: skipping', filename, '(' + str(error) + ')'
+
+    def save(self, key, mesh):
+        """
+        Writes a mesh to the directory.  It is written under another
+        name first, so a mesh is never read half written.
+        """
+        if not self.directory:
+            return
+        filename = self.filename(key)
+        try:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+            fp = open(filename + '.tmp', 'wb')
+            np.savez(fp, name = key[0], configure = np.array(key[1], str), detail = key[2],
+                     vertices = mesh[0], normals = mesh[1], painted_vertices = mesh[2],
+                     painted_normals = mesh[3], painted_colors = mesh[4])
+            fp.close()
+            if os.path.exists(filename):
+                os.remove(filename)
+            os.rename(filename + '.tmp', filename)
+        except (IOError, OSError), error:
+            print 'Warning: couldn\'t save shape', key[0], '(' + str(error) + ')'
+            self.directory = ''
+
+    def delete(self):
+        if self.context == contextdata.getContext():
+            if self.program:
+                glDeleteProgram(self.program)
+            if self.buffer:
+                glDeleteBuffers(1, [self.buffer])
+            if self.queries:
+                glDeleteQueries(len(self.queries), self.queries)
+        self.program = 0
+        self.buffer = 0
+        self.capacity = 0
+        self.queries = []
+
+    def allocate(self):
+        """
+        Makes the capturing shader, its buffer and queries.  The
+        varyings have to be named before linking, so the program is
+        linked here rather than by shaders.compileProgram.
+        """
+        self.delete()
+        self.context = contextdata.getContext()
+        shader = shaders.compileShader(capture_vertex_shader, GL_VERTEX_SHADER)
+        self.program = glCreateProgram()
+        glAttachShader(self.program, shader)
+        names = (ctypes.c_char_p*3)('position', 'normal', 'color')
+        glTransformFeedbackVaryings(self.program, 3, ctypes.cast(names, ctypes.POINTER(ctypes.POINTER(GLchar))), GL_INTERLEAVED_ATTRIBS)
+        glLinkProgram(self.program)
+        glDeleteShader(shader)
+        if glGetProgramiv(self.program, GL_LINK_STATUS) != GL_TRUE:
+            raise GLError(err = 0, description = 'capture shader: ' + str(glGetProgramInfoLog(self.program)))
+        self.buffer = glGenBuffers(1)
+        self.queries = glGenQueries(2)
+
+    def reserve(self, vertices):
+        """
+        Makes the buffer hold at least vertices
+        """
+        if vertices <= self.capacity:
+            return
+        self.capacity = max(vertices, 2*self.capacity, 3*1024)
+        glBindBuffer(GL_TRANSFORM_FEEDBACK_BUFFER, self.buffer)
+        glBufferData(GL_TRANSFORM_FEEDBACK_BUFFER, self.capacity*9*4, None, GL_STATIC_READ)
+        glBindBuffer(GL_TRANSFORM_FEEDBACK_BUFFER, 0)
+
+    def capture(self, part):
+        """
+        Returns the (N,9) float32 position, normal and color of each
+        triangle vertex part.shape() draws at pieces.detail, unplaced
+        """
+        if not self.program or self.context != contextdata.getContext():
+            self.allocate()
+        self.reserve(0)
+        while 1:
+            previous = glGetIntegerv(GL_CURRENT_PROGRAM)
+            glPushAttrib(GL_ENABLE_BIT | GL_CURRENT_BIT)
+            glMatrixMode(GL_MODELVIEW)
+            glPushMatrix()
+            glLoadIdentity()
+            glEnable(GL_RASTERIZER_DISCARD)
+            glUseProgram(self.program)
+            glBindBufferBase(GL_TRANSFORM_FEEDBACK_BUFFER, 0, self.buffer)
+            glBeginQuery(GL_PRIMITIVES_GENERATED, self.queries[0])
+            glBeginQuery(GL_TRANSFORM_FEEDBACK_PRIMITIVES_WRITTEN, self.queries[1])
+            glBeginTransformFeedback(GL_TRIANGLES)
+            glColor3fv(self.PLACEHOLDER)
+            try:
+                part.shape()
+            finally:
+                glEndTransformFeedback()
+                glEndQuery(GL_TRANSFORM_FEEDBACK_PRIMITIVES_WRITTEN)
+                glEndQuery(GL_PRIMITIVES_GENERATED)
+                glBindBufferBase(GL_TRANSFORM_FEEDBACK_BUFFER, 0, 0)
+                glUseProgram(int(previous))
+                glPopMatrix()
+                glPopAttrib()
+            generated = int(glGetQueryObjectuiv(self.queries[0], GL_QUERY_RESULT))
+            written = int(glGetQueryObjectuiv(self.queries[1], GL_QUERY_RESULT))
+            if written >= generated:
+                break
+            self.reserve(3*generated) # Ran out of room; try again
+        data = np.empty((3*written, 9), np.float32)
+        if written:
+            glBindBuffer(GL_TRANSFORM_FEEDBACK_BUFFER, self.buffer)
+            # PyOpenGL's wrapper neither fills data nor leaves the heap
+            # intact, so the unwrapped function is given its address
+            raw_GL_1_5.glGetBufferSubData(GL_TRANSFORM_FEEDBACK_BUFFER, 0, data.nbytes, data.ctypes.data_as(ctypes.c_void_p))
+            glBindBuffer(GL_TRANSFORM_FEEDBACK_BUFFER, 0)
+        return data
+
+    def mesh(self, part):
+        """
+        Returns the mesh of part at pieces.detail, capturing it if it
+        isn't cached, or None if it can't be captured.  Call it
+        outside glNewList.
+        """
+        key = (part.name, tuple(part.configure), pieces.detail)
+        if self.meshes.has_key(key):
+            return self.meshes[key]
+        if not self.available():
+            return None
+        try:
+            data = self.capture(part)
+        except (GLError, RuntimeError), error:
+            print 'Warning: capturing shapes failed (' + str(error).strip().split('\n')[0] + '), extruding them each time'
+            self.failed = 1
+            try:
+                glUseProgram(0)
+                glDisable(GL_RASTERIZER_DISCARD)
+            except GLError:
+                pass
+            return None
+        plain = np.all(np.abs(data[:,6:9] - self.PLACEHOLDER) < 1.0/512, 1)
+        painted = ~plain
+        mesh = tuple(map(np.ascontiguousarray, (data[plain,0:3], data[plain,3:6],
+                                                data[painted,0:3], data[painted,3:6], data[painted,6:9])))
+        self.meshes[key] = mesh
+        self.save(key, mesh)
+        return mesh
+
+    def draw(self, mesh):
+        """
+        Draws a mesh from mesh(), the plain part in the current color
+        """
+        vertices, normals, painted_vertices, painted_normals, painted_colors = mesh
+        glPushClientAttrib(GL_CLIENT_VERTEX_ARRAY_BIT)
+        glEnableClientState(GL_VERTEX_ARRAY)
+        glEnableClientState(GL_NORMAL_ARRAY)
+        if len(vertices):
+            glVertexPointerf(vertices)
+            glNormalPointerf(normals)
+            glDrawArrays(GL_TRIANGLES, 0, len(vertices))
+        if len(painted_vertices):
+            glEnableClientState(GL_COLOR_ARRAY)
+            glVertexPointerf(painted_vertices)
+            glNormalPointerf(painted_normals)
+            glColorPointerf(painted_colors)
+            glDrawArrays(GL_TRIANGLES, 0, len(painted_vertices))
+        glPopClientAttrib()
+
+tessellations = tessellation_cache()
+
 class piece(object):
     """
     A base class for every piece
@@ -81,6 +1472,7 @@ class piece(object):
     ends_types = [] # 's'/'j' (stick or joint)
     combination = [] # a piece which is a combination of pieces
     axis = [] # indicates which ends are on a rotating axis
+    bound_reach = 0.0 # how far the drawn piece reaches past its ends
 
     def __init__(self):
         self.port = 0 #port is an index
@@ -95,6 +1487,16 @@ class piece(object):
         for query_option in self.query_options:
             self.configure.append(query_option[1][0])
 
+    def bound_radius(self):
+        """
+        Returns the radius of a sphere about the center holding the
+        drawn piece
+        """
+        reach = 0.0
+        if len(self.unaligned_ends) > 0:
+            reach = np.max(vector_math.mag(np.asarray(self.unaligned_ends)[:,0] - self.unaligned_center))
+        return reach + self.bound_reach
+
     def configure_name(self, configure):
         """
         Some configures are prefixed or postfixed with special
@@ -169,30 +1571,80 @@ class piece(object):
         """
         glPushMatrix()
         glMultMatrixf(self.matrix)
+        self.draw_shape(color)
+        glPopMatrix()
+
+    def draw_shape(self, color = None):
+        """
+        Draws the piece, unplaced, with the detail part_detail gives
+        """
+        detail = part_detail(self)
+        if detail != pieces.detail:
+            save_detail = pieces.detail
+            pieces.detail = detail
+            try:
+                self.draw_shape(color)
+            finally:
+                pieces.detail = save_detail
+            return
+
         self.shape_color(color)
-        if pieces.detail == 2:
+        if pieces.detail == 0:
+            self.draw_proxy()
+        elif pieces.detail == 2:
             self.shape(color)
         else: # pieces.detail == 1
-            if pieces.detail1_gllists.has_key(self.name):
-                glCallList(pieces.detail1_gllists[self.name])
-            else:
-                if self.detail1 != 'Separate':
-                    gllist = glGenLists(1)
-                else:
-                    gllist = 0
-
+            if self.detail1 == 'Separate' and color:
+                self.shape(color) # The color reaches parts the list would paint
+                return
+            key = (self.name, tuple(self.configure))
+            if not pieces.detail1_gllists.has_key(key):
+                mesh = tessellations.mesh(self)
+                gllist = glGenLists(1)
                 if gllist != 0:
                     glNewList(gllist, GL_COMPILE)
-                    
-                self.shape(color)
-                #for end, end_type in zip(self.unaligned_ends, self.ends_types):
-                #    pieces.draw_end(end, end_type)
 
-                if gllist != 0:
-                    glEndList()
-                    pieces.detail1_gllists[self.name] = gllist
-                    glCallList(gllist)
-        glPopMatrix()
+                if mesh is None:
+                    self.shape(color)
+                else:
+                    tessellations.draw(mesh)
+
+                if gllist == 0:
+                    return
+                glEndList()
+                pieces.detail1_gllists[key] = gllist
+            glCallList(pieces.detail1_gllists[key])
+
+    def draw_proxy(self):
+        """
+        Draws a stand-in for the piece when it is too small on the
+        screen to show more: a capsule between the ends of a stick, or
+        a ball for a joint
+        """
+        if pieces.proxy_gllists.has_key(self.name):
+            glCallList(pieces.proxy_gllists[self.name])
+            return
+        gllist = glGenLists(1)
+        if gllist != 0:
+            glNewList(gllist, GL_COMPILE)
+
+        tips = map(lambda x: np.asarray(x[0], np.float64), self.unaligned_ends)
+        if self.ends_types == ['s']: # An axle
+            pieces.draw_capsule(tips[0], 2*np.asarray(self.unaligned_center) - tips[0], pieces.base_rad)
+        elif self.ends_types == ['s', 's']:
+            pieces.draw_capsule(tips[0], tips[1], pieces.base_rad)
+        else:
+            glPushMatrix()
+            glTranslatef(self.unaligned_center[0], self.unaligned_center[1], self.unaligned_center[2])
+            quadric = gluNewQuadric()
+            gluSphere(quadric, pieces.rot_rad, 8, 6)
+            gluDeleteQuadric(quadric)
+            glPopMatrix()
+
+        if gllist != 0:
+            glEndList()
+            pieces.proxy_gllists[self.name] = gllist
+            glCallList(gllist)
 
     def calc_draw(self, color):
         """
@@ -215,11 +1667,7 @@ class piece(object):
                 vrot = vector_math.cross(vfrom, vto)
                 angle = 180.0 + math.degrees(vector_math.acos_care(np.dot(vto, vfrom)))
             #print 'angle = ' + repr(angle) + ' vrot = ' + repr(vrot)
-            glPushMatrix()
-            glLoadIdentity()
-            glRotatef(angle, vrot[0], vrot[1], vrot[2])
-            m = glGetFloatv(GL_MODELVIEW_MATRIX)[:3,:3]
-            glPopMatrix()
+            m = vector_math.rotation_matrix(angle, vrot)[:3,:3]
             rot_end = (np.dot(m, from_end[0]),
                        np.dot(m, from_end[1]),
                        np.dot(m, from_end[2]))
@@ -244,18 +1692,14 @@ class piece(object):
             else: angle2 = angle2 + float(self.flip)
 
         # Do the transformation
-        glPushMatrix()
-        glLoadIdentity()
-        glTranslatef(to_end[0][0], to_end[0][1], to_end[0][2])
-        glRotatef(angle2, vrot2[0], vrot2[1], vrot2[2])
-        glRotatef(angle, vrot[0], vrot[1], vrot[2])
-        glTranslatef(-from_end[0][0], -from_end[0][1], -from_end[0][2])
         # I need the 4x4 matrix, because translations are stored in
         # the extra column
-        self.matrix = glGetFloatv(GL_MODELVIEW_MATRIX)
+        self.matrix = vector_math.compose(vector_math.translation_matrix(to_end[0]),
+                                          vector_math.rotation_matrix(angle2, vrot2),
+                                          vector_math.rotation_matrix(angle, vrot),
+                                          vector_math.translation_matrix(-from_end[0]))
         #print 'self.matrix', self.matrix
         self.calc_ends()
-        glPopMatrix()
 
         # Calculate new ends
         self.draw(color)
@@ -285,13 +1729,27 @@ class module(object):
     A base class for a collection of pieces, called a module.
     """
 
-    HISTORY_LENGTH = 10
+    HISTORY_LENGTH = 1000 # model changes that can be undone
 
     def __init__(self):
         self.netlist = []
         self.port = 0
         self.ends = []
         self.ends_types = []
+        self.end_ids = [] # parallel to self.ends for self.end_index
+        self.end_index = end_index()
+        self.center_points = point_array() # parallel to self.netlist
+        self.tip_points = point_array() # parallel to self.ends
+        self.batches = part_batches()
+        self.background = background_cache()
+        self.outliner = outline_pass()
+        self.picker = id_picker()
+        self.total_bmd = None # background depth, if read
+        self.total_rgb = None # background colors, if read
+        self.bounds = None # bounds_tree of the netlist, made when needed
+        self.dirty = None # [(centers, radii)] of parts changed since the modelling background was captured; None if unknown
+        self.parts_drawn = 0 # by the last redraw or draw
+        self.parts_culled = 0 # outside the view, by the last redraw or draw
         self.selected = []
         
         # Instructions 
@@ -316,47 +1774,217 @@ class module(object):
         self.groups = [1]
 
         # History
-        # Currently a crude form of undo/redo.  Stores the module
-        # after every module change
-        self.history = []
-        self.history_index = -1
+        # Undo/redo.  Every change to the parts, open ends, or
+        # instructions is logged in self.changes as it is made, and
+        # history_push files them as one history entry.  Entries
+        # hold only what changed, so undo and redo cost the size of
+        # the change, not the size of the module.
+        self.history = [] # (changes, port before, port after)
+        self.history_index = 0 # number of entries applied
+        self.history_port = 0 # self.port at the last history_push
+        self.changes = []
+        self.logged = {} # id(part) or 'instructions': its entry in self.changes
+
+        self.statistics = None # (count, mass, price, dims) strings saved with the instructions
 
         self.redraw_called = 0 # Signals redraw started and finished
 
+    @property
+    def centers(self):
+        """
+        The (N,3) part centers, in netlist order
+        """
+        return self.center_points.points()
+
+    @property
+    def end_tips(self):
+        """
+        The (M,3) open end tips (end[0]), in self.ends order
+        """
+        return self.tip_points.points()
+
+    def index_centers(self, start = 0):
+        """
+        Rebuilds self.centers from part start on, after the parts'
+        centers change or the netlist changes outside connect and
+        remove_part
+        """
+        self.center_points.splice(start, self.center_points.count - start, map(lambda x: x.center, self.netlist[start:]))
+
     def history_push(self):
         """
-        Saves the module onto the stack
+        Files the changes since the last push as a history entry
         """
 
         # disallow redos after a push
-        for count in range(self.history_index, -1):
-            del self.history[-1]
-        self.history_index = -1
-            
-        if len(self.history) >= self.HISTORY_LENGTH:
+        del self.history[self.history_index:]
+
+        changes = []
+        for change in self.changes:
+            # Parts and instructions are logged before they change.
+            # Now that they're done, record what they became.
+            if change[0] == 'parts':
+                self.mark_dirty(change[2] + change[3])
+            elif change[0] == 'part':
+                self.mark_dirty([change[1]], [change[2][0]])
+                self.mark_dirty([change[1]])
+                change = ('part', change[1], change[2], part_state(change[1]))
+            elif change[0] == 'instructions':
+                change = ('instructions', change[1], self.instructions_state())
+            changes.append(change)
+        self.history.append((changes, self.history_port, self.port))
+        self.history_index = self.history_index + 1
+        if len(self.history) > self.HISTORY_LENGTH + 1:
             del self.history[0]
-        self.history.append((copy.deepcopy(self.netlist), self.port, self.ends[:], self.ends_types[:], copy.deepcopy(self.individual_instructions), copy.deepcopy(self.group_instructions)))
+            self.history_index = self.history_index - 1
+        self.changes = []
+        self.logged = {}
+        self.history_port = self.port
+        self.statistics = None
 
     def history_undo(self):
         """
-        Use the last module store
-        """
-        new_index = self.history_index - 1
-        if len(self.history) >= -new_index:
-            self.history_index = new_index
-            self.netlist, self.port, self.ends, self.ends_types, self.individual_instructions, self.group_instructions = self.history[self.history_index]
+        Undo the last history entry.  The first entry, which started
+        the module, can't be undone.
+        """
+        if self.history_index > 1:
+            self.revert_changes(self.changes)
+            self.history_index = self.history_index - 1
+            changes, port, new_port = self.history[self.history_index]
+            self.revert_changes(changes)
+            self.port = port
+            self.history_port = port
+            self.statistics = None
             self.selected = []
 
     def history_redo(self):
         """
-        Use the next module store
+        Redo the next history entry
         """
-        new_index = min(self.history_index + 1, -1)
-        if len(self.history) >= -new_index:
-            self.history_index = new_index
-            self.netlist, self.port, self.ends, self.ends_types, self.individual_instructions, self.group_instructions = self.history[self.history_index]
+        if self.history_index < len(self.history):
+            self.revert_changes(self.changes)
+            changes, old_port, port = self.history[self.history_index]
+            self.history_index = self.history_index + 1
+            self.apply_changes(changes)
+            self.port = port
+            self.history_port = port
+            self.statistics = None
             self.selected = []
 
+    def apply_changes(self, changes):
+        """
+        Makes the logged changes again, without logging them
+        """
+        moved = 0 # A part's center changed
+        for change in changes:
+            kind = change[0]
+            if kind == 'parts':
+                kind, index, removed, added = change
+                self.mark_dirty(removed + added)
+                self.netlist[index:index+len(removed)] = added
+                self.batches.splice(removed, added)
+                self.center_points.splice(index, len(removed), map(lambda x: x.center, added))
+            elif kind == 'end':
+                kind, added, position, end, end_type, end_id = change
+                if added:
+                    self.insert_end(position, end, end_type, end_id)
+                else:
+                    self.pop_end(position)
+            elif kind == 'ends':
+                self.set_ends(change[2])
+            elif kind == 'part':
+                self.mark_dirty([change[1]])
+                set_part_state(change[1], change[3])
+                self.mark_dirty([change[1]])
+                self.batches.move(change[1])
+                moved = 1
+            elif kind == 'instructions':
+                self.set_instructions(change[2])
+        if moved:
+            self.index_centers()
+
+    def revert_changes(self, changes):
+        """
+        Undoes the logged changes, latest first, without logging them.
+        Pending (unpushed) changes are forgotten.
+        """
+        moved = 0 # A part's center changed
+        for change in changes[::-1]:
+            kind = change[0]
+            if kind == 'parts':
+                kind, index, removed, added = change
+                self.mark_dirty(removed + added)
+                self.netlist[index:index+len(added)] = removed
+                self.batches.splice(added, removed)
+                self.center_points.splice(index, len(added), map(lambda x: x.center, removed))
+            elif kind == 'end':
+                kind, added, position, end, end_type, end_id = change
+                if added:
+                    self.pop_end(position)
+                else:
+                    self.insert_end(position, end, end_type, end_id)
+            elif kind == 'ends':
+                self.set_ends(change[1])
+            elif kind == 'part':
+                self.mark_dirty([change[1]])
+                set_part_state(change[1], change[2])
+                self.mark_dirty([change[1]])
+                self.batches.move(change[1])
+                moved = 1
+            elif kind == 'instructions':
+                self.set_instructions(change[1])
+        if moved:
+            self.index_centers()
+        if changes is self.changes:
+            self.changes = []
+            self.logged = {}
+
+    def mark_dirty(self, parts, matrices = None):
+        """
+        Notes where parts are drawn (or were, with their old matrices),
+        so update can redraw there
+        """
+        if self.dirty is not None and len(parts) > 0:
+            self.dirty.append(part_bounds(parts, matrices))
+
+    def log_part(self, part):
+        """
+        Logs a part whose placement is about to change
+        """
+        if not self.logged.has_key(id(part)):
+            self.logged[id(part)] = len(self.changes)
+            self.changes.append(('part', part, part_state(part)))
+
+    def log_instructions(self):
+        """
+        Logs the instructions before they change
+        """
+        if not self.logged.has_key('instructions'):
+            self.logged['instructions'] = len(self.changes)
+            self.changes.append(('instructions', self.instructions_state()))
+
+    def instructions_state(self):
+        return copy.deepcopy((self.individual_instructions, self.group_instructions))
+
+    def set_instructions(self, state):
+        """
+        Restores the instructions in place, so self.instructions still
+        refers to the same list
+        """
+        individual_instructions, group_instructions = copy.deepcopy(state)
+        self.individual_instructions[:] = individual_instructions
+        self.group_instructions[:] = group_instructions
+
+    def log_load(self, len_netlist, ends_state):
+        """
+        Logs a load, which adds parts, replaces the open ends, and
+        replaces the instructions
+        """
+        self.changes.append(('parts', len_netlist, [], self.netlist[len_netlist:]))
+        self.batches.splice([], self.netlist[len_netlist:])
+        self.index_centers(len_netlist)
+        self.changes.append(('ends', ends_state, self.ends_state()))
+
     def start_ends(self, end_type):
         """
         The positions of the invisible cross hair before any piece
@@ -364,25 +1992,292 @@ class module(object):
         """
         e0 = pieces.join_len
         if end_type == 's':
-            self.ends = [(np.array([e0, 0.0, 0.0]), np.array([e0-1.0, 0.0, 0.0]), np.array([e0, 0.0, -1.0])),
+            ends = [(np.array([e0, 0.0, 0.0]), np.array([e0-1.0, 0.0, 0.0]), np.array([e0, 0.0, -1.0])),
                          (np.array([0.0, e0, 0.0]), np.array([0.0, e0-1.0, 0.0]), np.array([0.0, e0, -1.0])),
                          (np.array([0.0, 0.0, e0]), np.array([0.0, 0.0, e0-1.0]), np.array([-1.0, 0.0, e0])),
                          (np.array([-e0, 0.0, 0.0]), np.array([-(e0-1.0), 0.0, 0.0]), np.array([-e0, 0.0, -1.0])),
                          (np.array([0.0, -e0, 0.0]), np.array([0.0, -(e0-1.0), 0.0]), np.array([0.0, -e0, -1.0])),
                          (np.array([0.0, 0.0, -e0]), np.array([0.0, 0.0, -(e0-1.0)]), np.array([-1.0, 0.0, -e0]))]
         else: # 'j'
-            self.ends = [(np.array([e0, 0.0, 0.0]), np.array([e0+1.0, 0.0, 0.0]), np.array([e0, 0.0, -1.0])),
+            ends = [(np.array([e0, 0.0, 0.0]), np.array([e0+1.0, 0.0, 0.0]), np.array([e0, 0.0, -1.0])),
                          (np.array([0.0, e0, 0.0]), np.array([0.0, e0+1.0, 0.0]), np.array([0.0, e0, -1.0])),
                          (np.array([0.0, 0.0, e0]), np.array([0.0, 0.0, e0+1.0]), np.array([-1.0, 0.0, e0])),
                          (np.array([-e0, 0.0, 0.0]), np.array([-(e0+1.0), 0.0, 0.0]), np.array([-e0, 0.0, -1.0])),
                          (np.array([0.0, -e0, 0.0]), np.array([0.0, -(e0+1.0), 0.0]), np.array([0.0, -e0, -1.0])),
                          (np.array([0.0, 0.0, -e0]), np.array([0.0, 0.0, -(e0+1.0)]), np.array([-1.0, 0.0, -e0]))]
+        self.replace_ends(ends, self.ends_types)
+
+    def index_ends(self, end_ids = None):
+        """
+        Rebuilds the end index after self.ends is replaced wholesale.
+        New end ids are issued unless end_ids are passed.
+        """
+        if end_ids is None:
+            end_ids = [None]*len(self.ends)
+        self.end_index.clear()
+        self.end_ids = []
+        for end, end_id in zip(self.ends, end_ids):
+            self.end_ids.append(self.end_index.add(end[0], end_id))
+        self.tip_points.reset(map(lambda x: x[0], self.ends))
+
+    def ends_state(self):
+        return (self.ends[:], self.ends_types[:], self.end_ids[:])
+
+    def set_ends(self, state):
+        """
+        Restores the open ends, with their end ids, from ends_state
+        """
+        ends, ends_types, end_ids = state
+        self.ends = ends[:]
+        self.ends_types = ends_types[:]
+        self.index_ends(end_ids)
+
+    def replace_ends(self, ends, ends_types):
+        """
+        Replaces all the open ends of the module
+        """
+        old_state = self.ends_state()
+        self.ends = ends
+        self.ends_types = ends_types
+        self.index_ends()
+        self.changes.append(('ends', old_state, self.ends_state()))
+
+    def append_end(self, end, end_type):
+        """
+        Adds an open end to the module
+        """
+        position = len(self.ends)
+        self.insert_end(position, end, end_type)
+        self.changes.append(('end', 1, position, end, end_type, self.end_ids[position]))
+
+    def delete_end(self, position):
+        """
+        Removes the open end at position from the module
+        """
+        end, end_type, end_id = self.pop_end(position)
+        self.changes.append(('end', 0, position, end, end_type, end_id))
+
+    def insert_end(self, position, end, end_type, end_id = None):
+        """
+        Puts an open end at position without logging it.  A new end
+        id is issued unless one is passed.
+        """
+        self.ends.insert(position, end)
+        self.ends_types.insert(position, end_type)
+        self.end_ids.insert(position, self.end_index.add(end[0], end_id))
+        self.tip_points.splice(position, 0, end[0])
+
+    def pop_end(self, position):
+        """
+        Removes the open end at position without logging it.  Returns
+        (end, end_type, end_id).
+        """
+        end_id = self.end_ids.pop(position)
+        self.end_index.remove(end_id)
+        self.tip_points.splice(position, 1, [])
+        return self.ends.pop(position), self.ends_types.pop(position), end_id
+
+    def find_end(self, end1, same_dir = 0, start = 0):
+        """
+        Like ends_aligned on self.ends, but uses the end index.  Only
+        ends at position start or later are considered.
+        Returns the position+1 of only one of the ends that are aligned
+        Returns 0 if none are aligned
+        Returns -1 if there is an error
+        """
+        positions = []
+        for end_id in self.end_index.query(end1[0]):
+            position = bisect.bisect_left(self.end_ids, end_id)
+            if position >= start:
+                positions.append(position)
+        positions.sort()
+        for position in positions:
+            end2 = self.ends[position]
+            if vector_math.mag(end1[0] - end2[0]) < xabstol:
+                aligned = ends_match(end1, end2, same_dir)
+                if aligned > 0:
+                    return position+1
+                elif aligned < 0:
+                    print 'bad_angle', end1, end2
+                    return -1 # aligned but bad angle
+        return 0
+
+    def part_tree(self):
+        """
+        Returns the bounds_tree of the netlist, remade if parts changed
+        """
+        if self.bounds is None or self.batches.changed or self.bounds.count != len(self.netlist):
+            self.bounds = bounds_tree(*part_bounds(self.netlist))
+            self.batches.changed = 0
+        return self.bounds
+
+    def visible_parts(self):
+        """
+        Returns a boolean mask of the parts in the view, or None if
+        every part is or culling is off.  Counts the parts drawn and
+        culled.
+        """
+        len_netlist = len(self.netlist)
+        visible = None
+        if cull_parts and len_netlist > 0:
+            planes = vector_math.frustum_planes(glGetDoublev(GL_MODELVIEW_MATRIX), glGetDoublev(GL_PROJECTION_MATRIX))
+            if np.all(np.isfinite(planes)):
+                visible = self.part_tree().visible(planes)
+                if np.all(visible):
+                    visible = None
+        if visible is None:
+            self.parts_drawn = self.parts_drawn + len_netlist
+        else:
+            drawn = int(np.count_nonzero(visible))
+            self.parts_drawn = self.parts_drawn + drawn
+            self.parts_culled = self.parts_culled + len_netlist - drawn
+        return visible
+
+    def draw_parts(self):
+        """
+        Draws every part in the view in its own color.  When most are
+        in the view, drawing all the batches is faster than drawing
+        just those parts one at a time.
+        """
+        visible = self.visible_parts()
+        if visible is not None and draw_batches and 2*self.parts_drawn > len(self.netlist):
+            self.parts_drawn = len(self.netlist)
+            self.parts_culled = 0
+            visible = None
+        if visible is None:
+            if draw_batches:
+                self.batches.draw()
+            else:
+                for part in self.netlist:
+                    part.draw()
+        else:
+            for part_index in np.nonzero(visible)[0]:
+                self.netlist[part_index].draw()
+
+    def pick_view(self, x, y):
+        """
+        Returns the model and projection matrices (OpenGL layout) the
+        picker draws with around window x, y
+        """
+        size = self.picker.SIZE
+        box = (x - size/2.0, y - size/2.0, size, size)
+        projection = np.dot(glGetDoublev(GL_PROJECTION_MATRIX), vector_math.pick_matrix(box, glGetIntegerv(GL_VIEWPORT)))
+        return glGetDoublev(GL_MODELVIEW_MATRIX), projection
+
+    def pick_parts(self, model, projection, posed = 0):
+        """
+        Returns the indices of the parts that may be drawn in the view
+        of model and projection, from the bounds tree.  Posed parts
+        are found region by region, in each region's frame.
+        """
+        len_netlist = len(self.netlist)
+        if not cull_parts or len_netlist == 0:
+            return range(len_netlist)
+        tree = self.part_tree()
+        if not posed:
+            planes = vector_math.frustum_planes(model, projection)
+            if not np.all(np.isfinite(planes)):
+                return range(len_netlist)
+            return np.nonzero(tree.visible(planes))[0]
+        indices = []
+        for region, matrix in enumerate(self.region_matrices):
+            planes = vector_math.frustum_planes(np.dot(np.asarray(matrix, np.float64), model), projection)
+            if not np.all(np.isfinite(planes)):
+                return range(len_netlist)
+            visible = np.nonzero(tree.visible(planes))[0]
+            indices.extend(filter(lambda x: self.region_lookups[x] == region, visible))
+        indices.sort()
+        return indices
+
+    def pick_part(self, x, y, creationmode, unselectable = []):
+        """
+        Returns the index of the part drawn at window x, y, or None if
+        none is or picking isn't possible.  Unselectable parts hide
+        the parts behind them but aren't picked.  Only the parts in
+        the picked pixels are drawn.
+        """
+        if not self.picker.available():
+            return None
+        unselectable = set(unselectable)
+        instructions = creationmode != 'modelling'
+        posed = instructions and self.hold_pose
+        model, projection = self.pick_view(x, y)
+        part_indices = self.pick_parts(model, projection, posed)
+
+        def draw(identify):
+            for part_index in part_indices:
+                part = self.netlist[part_index]
+                if instructions: # as redraw
+                    flag = self.part_flags[part_index]
+                    if flag == 3 or (flag == 2 and draw_future_parts == 0):
+                        continue
+                if part_index in unselectable:
+                    identify(0)
+                else:
+                    identify(part_index + 1)
+                if posed:
+                    glPushMatrix()
+                    glMultMatrixf(self.region_matrices[self.region_lookups[part_index]])
+                    part.draw()
+                    glPopMatrix()
+                else:
+                    part.draw()
+
+        picked = self.picker.pick(x, y, draw)
+        if picked:
+            return picked - 1
+        return None
+
+    def pick_end(self, x, y):
+        """
+        Returns the index of the open end drawn at window x, y, or
+        None if none is or picking isn't possible.  Parts hide the
+        ends behind them.  Only the ends and parts in the picked
+        pixels are drawn.
+        """
+        if not self.picker.available():
+            return None
+        model, projection = self.pick_view(x, y)
+        part_indices = self.pick_parts(model, projection)
+        end_indices = range(len(self.ends))
+        planes = vector_math.frustum_planes(model, projection)
+        if cull_parts and len(self.ends) > 0 and np.all(np.isfinite(planes)):
+            end_indices = np.nonzero(vector_math.spheres_visible(planes, self.end_tips, np.repeat(pieces.end_radius, len(self.ends))))[0]
+
+        def draw(identify):
+            pieces.draw_ends(map(lambda x: self.ends[x], end_indices),
+                             map(lambda x: self.ends_types[x], end_indices),
+                             lambda x: identify(end_indices[x] + 1))
+            identify(0)
+            glEnable(GL_POLYGON_OFFSET_FILL) # An end's own part is behind it
+            glPolygonOffset(1.0, 1.0)
+            for part_index in part_indices:
+                self.netlist[part_index].draw()
+            glDisable(GL_POLYGON_OFFSET_FILL)
+
+        picked = self.picker.pick(x, y, draw)
+        if picked:
+            return picked - 1
+        return None
+
+    def release(self):
+        """
+        Frees the module's GL objects
+        """
+        self.batches.clear()
+        self.background.delete()
+        self.outliner.delete()
+        self.picker.delete()
 
     def draw_base(self):
         """
         Draws the module by copying pixels from the back buffer to the
         front buffer.  Used in conjuction with capture_background.
         """
+        if self.total_rgb is None: # Captured in self.background
+            viewport = glGetIntegerv(GL_VIEWPORT)
+            self.background.blit(viewport, 0, GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+            return
 
         glColorMask(GL_FALSE, GL_FALSE, GL_FALSE, GL_FALSE)
         glDepthMask(GL_TRUE)
@@ -400,14 +2295,26 @@ class module(object):
         conjuction with draw_base.
 
         glReadPixels seems to be quite slow on many graphics hardware,
-        so this is probably a poor way to do things.  Many claim
-        textures are better.
+        so the background is kept in a framebuffer object instead
+        where possible.  glReadPixels is the fallback.
         """
         viewport = glGetIntegerv(GL_VIEWPORT)
-        glReadBuffer(GL_BACK)
+        if self.background.blit(viewport, 1, GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT):
+            self.total_bmd = None
+            self.total_rgb = None
+            return
+        glReadBuffer(window_buffer)
         self.total_bmd = glReadPixelsf(viewport[0], viewport[1], viewport[2], viewport[3], GL_DEPTH_COMPONENT)
         self.total_rgb = glReadPixelsf(viewport[0], viewport[1], viewport[2], viewport[3], GL_RGBA)
 
+    def background_depth(self):
+        """
+        Returns the depth of the captured background
+        """
+        if self.total_bmd is None:
+            self.total_bmd = self.background.read_depth()
+        return self.total_bmd
+
     def draw_selected(self, vout, vup, creationmode):
         """
         Draws selected pieces a different color by redrawing the piece
@@ -420,11 +2327,26 @@ class module(object):
         #glDepthFunc(GL_EQUAL) # fine, but z-fighting for def draw()
         # When all parts are selected, doubles redraw time ***
 
+        posed = self.hold_pose and (creationmode == 'instructions' or creationmode == 'group') and self.frame >= self.instruction_start
+        visible = None
+        if cull_parts and not posed and len(self.selected) > 0:
+            planes = vector_math.frustum_planes(glGetDoublev(GL_MODELVIEW_MATRIX), glGetDoublev(GL_PROJECTION_MATRIX))
+            if np.all(np.isfinite(planes)):
+                visible = vector_math.spheres_visible(planes, *part_bounds(map(lambda x: self.netlist[x], self.selected)))
+        if visible is None:
+            self.parts_drawn = self.parts_drawn + len(self.selected)
+        else:
+            culled = len(self.selected) - int(np.count_nonzero(visible))
+            self.parts_culled = self.parts_culled + culled
+            self.parts_drawn = self.parts_drawn + len(self.selected) - culled
+
         voffset = vout*0.1
         glPushMatrix()
         glTranslatef(voffset[0], voffset[1], voffset[2])
-        for count in self.selected:
-            if self.hold_pose and (creationmode == 'instructions' or creationmode == 'group') and self.frame >= self.instruction_start:
+        for selected_index, count in enumerate(self.selected):
+            if visible is not None and not visible[selected_index]:
+                continue
+            if posed:
                 matrix = self.region_matrices[self.region_lookups[count]]
                 glPushMatrix()
                 glMultMatrixf(matrix)
@@ -505,31 +2427,21 @@ class module(object):
         projection = glGetDoublev(GL_PROJECTION_MATRIX)
         viewport = glGetIntegerv(GL_VIEWPORT)
 
-        # reshape needed to circumvent pyopengl bug ***
-        total_bmd = np.reshape(self.total_bmd, (viewport[3], viewport[2]))
-
-        binary_depth = (total_bmd < 1.0).astype(np.uint8)
         #iterations = 2*dim_scale # Increase for thicker outlines
         #iterations = max(2, int(round(2*dim_scale*pixperunit/10.0))) # Increase for thicker outlines
         iterations = min(int(2*dim_scale), max(2, int(round(2*dim_scale*pixperunit/10.0)))) # Increase for thicker outlines
-        outline = binary_depth.copy()
-        shadow_bmd = total_bmd.copy()+2*pieces.base_rad*depth_scale # The second term defines the shadow offset.
-        offsets = vector_math.offsets(iterations, iterations - 1) # outline pattern possible as long as distance is less than the minimum thickness of any feature
-        ol = np.zeros(outline.shape, np.uint8)
-        sh = np.ones(outline.shape, np.float32)
-        ymax, xmax = outline.shape
-        for x, y in offsets:
-            y1 = max(0, y)
-            y2 = min(ymax, ymax + y)
-            x1 = max(0, x)
-            x2 = min(xmax, xmax + x)
-            y3 = max(0, -y)
-            y4 = min(ymax, ymax - y)
-            x3 = max(0, -x)
-            x4 = min(xmax, xmax - x)
-            ol[y1:y2,x1:x2] = ol[y1:y2,x1:x2] | outline[y3:y4,x3:x4]
-            sh[y1:y2,x1:x2] = np.minimum(sh[y1:y2,x1:x2], shadow_bmd[y3:y4,x3:x4])
-        outline = ol & (sh < total_bmd) # Remove this check and all shadow_bmd lines if I only want background highlighted
+        shadow = 2*pieces.base_rad*depth_scale # The shadow offset
+        if self.outliner.draw(viewport, iterations, shadow, colors['outline']):
+            return
+
+        # reshape needed to circumvent pyopengl bug ***
+        total_bmd = np.reshape(self.background_depth(), (viewport[3], viewport[2]))
+
+        # The outline pattern is a ring of radius iterations, possible
+        # as long as it is less than the minimum thickness of any
+        # feature.  A pixel is outlined if the ring reaches in front
+        # of it by more than the shadow offset.
+        outline = vector_math.outline_mask(total_bmd, iterations, shadow)
         column_adds = viewport[2] % 8
         if column_adds > 0:
             column_adds = 8 - column_adds
@@ -562,8 +2474,81 @@ class module(object):
         Draws the module by using previous draws.  Faster than redraw.
         """
         #print 'draw'
+        self.parts_drawn = 0
+        self.parts_culled = 0
+        self.draw_base()
+        self.draw_selected(vout, vup, creationmode)
+
+    def dirty_boxes(self, viewport):
+        """
+        Returns the window boxes (x, y, width, height) holding the
+        dirty parts, with a pixel to spare.  Many are joined into one.
+        """
+        centers = np.concatenate(map(lambda x: x[0], self.dirty))
+        radii = np.concatenate(map(lambda x: x[1], self.dirty))
+        model = glGetDoublev(GL_MODELVIEW_MATRIX)
+        projection = glGetDoublev(GL_PROJECTION_MATRIX)
+        window = vector_math.project(centers, model, projection, viewport)
+        # The view is orthographic, so a radius is the same size anywhere
+        scale = max(abs(projection[0][0])*viewport[2], abs(projection[1][1])*viewport[3])/2.0
+        pixels = radii*scale + 1.0
+        lows = np.floor(window[:,:2] - pixels[:,np.newaxis])
+        highs = np.ceil(window[:,:2] + pixels[:,np.newaxis])
+        if len(lows) > 8:
+            lows = lows.min(0)[np.newaxis]
+            highs = highs.max(0)[np.newaxis]
+        lows = np.maximum(lows, viewport[:2])
+        highs = np.minimum(highs, np.add(viewport[:2], viewport[2:]))
+        boxes = []
+        for low, high in zip(lows, highs):
+            if np.all(high > low):
+                boxes.append((int(low[0]), int(low[1]), int(high[0] - low[0]), int(high[1] - low[1])))
+        return boxes
+
+    def update(self, vout, vup, creationmode):
+        """
+        Draws the module by redrawing only the window boxes where parts
+        changed since the background was captured, then capturing it
+        again.  Only the parts reaching into the boxes are drawn, so
+        the time follows the change, not the module.  Falls back to
+        redraw when the boxes are unknown or cover much of the window.
+        """
+        if creationmode != 'modelling' or self.dirty is None:
+            self.redraw(vout, vup, creationmode)
+            return
+        viewport = glGetIntegerv(GL_VIEWPORT)
+        boxes = []
+        if len(self.dirty) > 0:
+            boxes = self.dirty_boxes(viewport)
+        if 2*sum(map(lambda x: x[2]*x[3], boxes)) > viewport[2]*viewport[3]:
+            self.redraw(vout, vup, creationmode)
+            return
+
+        self.parts_drawn = 0
+        self.parts_culled = 0
         self.draw_base()
+        if len(boxes) > 0 and len(self.netlist) > 0:
+            model = glGetDoublev(GL_MODELVIEW_MATRIX)
+            projection = glGetDoublev(GL_PROJECTION_MATRIX)
+            tree = self.part_tree()
+            glEnable(GL_SCISSOR_TEST)
+            for box in boxes:
+                glScissor(*box)
+                glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+                planes = vector_math.frustum_planes(model, np.dot(projection, vector_math.pick_matrix(box, viewport)))
+                visible = tree.visible(planes)
+                for part_index in np.nonzero(visible)[0]:
+                    self.netlist[part_index].draw()
+                self.parts_drawn = self.parts_drawn + int(np.count_nonzero(visible))
+            glDisable(GL_SCISSOR_TEST)
+            self.capture_background()
+        self.dirty = []
+        self.parts_culled = len(self.netlist) - min(self.parts_drawn, len(self.netlist))
+
+        if draw_outline:
+            self.draw_part_outlines()
         self.draw_selected(vout, vup, creationmode)
+        self.redraw_called = 1
 
     def generate_submodel_stack(self):
         """
@@ -625,11 +2610,19 @@ class module(object):
         self.group_pieces = group_pieces
 
     def pose_transform(self, path, axes, rotates):
+        """
+        Applies the transformation for a region
+        """
+        matrix = self.pose_matrix(path, axes, rotates)
+        glMultMatrixf(matrix)
+
+        return matrix
+
+    def pose_matrix(self, path, axes, rotates):
         """
         Determines a transformation for a region
         """
-        glPushMatrix()
-        glLoadIdentity()
+        matrices = []
 
         # Determine the transformation
         last_region = path[0]
@@ -642,30 +2635,21 @@ class module(object):
             about = end[0] - end[1]
             angle = rotates[connecting_region]
 
-            glTranslatef(end[0][0], end[0][1], end[0][2])
-            glRotatef(angle, about[0], about[1], about[2])
-            glTranslatef(-end[0][0], -end[0][1], -end[0][2])
+            matrices.append(vector_math.translation_matrix(end[0]))
+            matrices.append(vector_math.rotation_matrix(angle, about))
+            matrices.append(vector_math.translation_matrix(-end[0]))
 
             last_region = connecting_region
 
         # Calculate new matrix
-        matrix = glGetFloatv(GL_MODELVIEW_MATRIX)
-        glPopMatrix()
-        glMultMatrixf(matrix)
-
-        return matrix
+        return vector_math.compose(*matrices)
 
     def hold_pose_matrices(self):
         self.region_matrices = []
         for region_index, region in enumerate(self.regions):
-
-            glPushMatrix()
-
-            matrix = self.pose_transform(self.region_paths[region_index], self.region_axes, self.instructions[0]['rotates']) # Pose fixed at frame 0
+            matrix = self.pose_matrix(self.region_paths[region_index], self.region_axes, self.instructions[0]['rotates']) # Pose fixed at frame 0
             self.region_matrices.append(matrix)
 
-            glPopMatrix()
-
     def pose_centers(self):
         for matrix, region in zip(self.region_matrices, self.regions):
             for part_index in region:
@@ -673,10 +2657,12 @@ class module(object):
                     center = self.netlist[part_index].center_save
                     new_center = np.dot(np.transpose(matrix), np.concatenate((center, [1.0])))[:3]
                     self.netlist[part_index].center = new_center
+        self.index_centers()
 
     def restore_centers(self):
         for part in self.netlist:
             part.center = part.center_save
+        self.index_centers()
 
     def redraw(self, vout, vup, creationmode):
         """
@@ -686,11 +2672,14 @@ class module(object):
         #print 'redraw'
 
         glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+        self.parts_drawn = 0
+        self.parts_culled = 0
+        self.dirty = None
         if creationmode == 'modelling':
-            for p in self.netlist:
-                p.draw()
+            self.draw_parts()
 
             self.capture_background()
+            self.dirty = []
                 
             if draw_outline:
                 self.draw_part_outlines()
@@ -768,9 +2757,16 @@ class module(object):
                 self.part_flags[self.hidden_parts] = 3
 
             local_colors = [None, colors['newpart'], colors['futurepart']]
+            visible = None
+            if not self.hold_pose:
+                visible = self.visible_parts()
+            else:
+                self.parts_drawn = self.parts_drawn + len_self_netlist
             for part_index in range(len_self_netlist):
                 if self.part_flags[part_index] == 3:
                     pass
+                elif visible is not None and not visible[part_index]:
+                    pass
                 elif self.part_flags[part_index] == 2 and draw_future_parts == 0:
                     pass
                 else:
@@ -812,76 +2808,293 @@ class module(object):
         sametip_indices = np.nonzero(sametips)[0]
         for sametip_index in sametip_indices:
             end2 = ends[sametip_index]
-            if ((same_dir == 0 and np.allclose(end1[0]-end1[1], end2[1]-end2[0], atol=xabstol, rtol=0.0)) or (same_dir == 1 and np.allclose(end1[0]-end1[1], end2[0]-end2[1], atol=xabstol, rtol=0.0))):
-                dp = np.dot(end1[0]-end1[2], end2[0]-end2[2])
-                if (-1.0 - xabstol < dp < -1.0 + xabstol) or \
-                        (-xabstol < dp < xabstol) or \
-                        (1.0 - xabstol < dp < 1.0 + xabstol):
-                    return sametip_index+1
-                else:
-                    print 'bad_angle', end1, end2
-                    return -1 # aligned but bad angle
+            aligned = ends_match(end1, end2, same_dir)
+            if aligned > 0:
+                return sametip_index+1
+            elif aligned < 0:
+                print 'bad_angle', end1, end2
+                return -1 # aligned but bad angle
         return 0
 
-    def write_netlist(self):
+    def update_statistics(self):
+        """
+        Adds mass, price, dimensions to the first instruction for easy
+        read-out later
+        """
+        if len(self.individual_instructions) > 0:
+            if self.statistics is None:
+                self.statistics = ('%d' % self.total_inventory(),
+                                   '%.0f' % self.mass(),
+                                   '%.2f' % self.price(),
+                                   '%.1f,%.1f,%.1f' % self.dimensions())
+            inst = self.individual_instructions[0]
+            inst['count'], inst['mass'], inst['price'], inst['dims'] = self.statistics
+
+    def write_netlist(self, fp = None):
         """
-        Returns a string representation of the module
+        Writes a string representation of the module to the file
+        object fp.  Returns the string if fp is None.
         """
         netlist_version = 1.0
         sf = 1.0/pieces.sf
+        if fp is None:
+            written = cStringIO.StringIO()
+        else:
+            written = fp
         # Write version
-        written = 'v' + str(netlist_version) + '\n'
+        written.write('v' + str(netlist_version) + '\n')
         # Write parts
+        prefixes = []
         for part in self.netlist:
             if len(part.configure) > 0:
-                configs = reduce(lambda x, y: str(x) + ' ' + str(y), part.configure) + ' '
+                prefixes.append(part.name + ' ' + ' '.join(map(str, part.configure)) + ' ')
             else:
-                configs = ''
-            # May want to change the round in the future depending on parts
-            written = written + part.name + ' ' + configs + reduce(lambda x, y: str(x) + ' ' + str(y), map(lambda z: round(z, 1), (sf*part.matrix.reshape(16)).tolist())) + '\n'
+                prefixes.append(part.name + ' ')
+        # May want to change the round in the future depending on parts
+        written.write(format_tenths(prefixes, sf*np.reshape(map(lambda x: x.matrix, self.netlist), (-1, 16)).astype(np.float64)))
         # Write ends
-        for end, end_type in zip(self.ends, self.ends_types):
-            # May want to change the round in the future depending on parts
-            written = written + 'end ' + end_type + ' ' + reduce(lambda x, y: str(x) + ' ' + str(y), map(lambda z: round(z, 1), (sf*np.reshape(end, (1, 9))[0]).tolist())) + '\n'
+        prefixes = map(lambda x: 'end ' + x + ' ', self.ends_types[:len(self.ends)])
+        # May want to change the round in the future depending on parts
+        written.write(format_tenths(prefixes, sf*np.reshape(self.ends[:len(prefixes)], (-1, 9))))
 
         # Write instructions
         sizes = {'fullr': 'r', 'full': 'f', 'quarter': 'q', 'halfh': 'h'}
-        # Add mass, price, dimensions for easy read-out later
-        if len(self.individual_instructions) > 0:
-            self.individual_instructions[0]['count'] = '%d' % self.total_inventory()
-            self.individual_instructions[0]['mass'] = '%.0f' % self.mass()
-            self.individual_instructions[0]['price'] = '%.2f' % self.price()
-            self.individual_instructions[0]['dims'] = '%.1f,%.1f,%.1f' % self.dimensions()
+        self.update_statistics()
         for c, itype in (('i', self.individual_instructions),
                          ('g', self.group_instructions)):
             for count, inst in enumerate(itype):
-                written = written + c + ' %.6e %.6e %.6e %.6e %.6e %.6e %.6e %.6e %.6e %.6e' % (inst['vcenter'][0], inst['vcenter'][1], inst['vcenter'][2], inst['vout'][0], inst['vout'][1], inst['vout'][2], inst['vup'][0], inst['vup'][1], inst['vup'][2], inst['pixperunit'])
-                if len(inst['new_parts']) > 1:
-                    written = written + ' ' + reduce(lambda x, y: str(x) + ' ' + str(y), inst['new_parts'])
-                elif len(inst['new_parts']) == 1: # Some numpy bug couldn't reduce a len == 1 list
-                    written = written + ' ' + str(inst['new_parts'][0])
-                written = written + ' ' + sizes[inst['size']]
-                remaining_keys = filter(lambda x: x not in ['vcenter', 'vout', 'vup', 'pixperunit', 'new_parts', 'size'], inst.keys())
+                line = [c + ' %.6e %.6e %.6e %.6e %.6e %.6e %.6e %.6e %.6e %.6e' % (inst['vcenter'][0], inst['vcenter'][1], inst['vcenter'][2], inst['vout'][0], inst['vout'][1], inst['vout'][2], inst['vup'][0], inst['vup'][1], inst['vup'][2], inst['pixperunit'])]
+                line.extend(map(str, inst['new_parts']))
+                line.append(sizes[inst['size']])
+                remaining_keys = filter(lambda x: x not in ['vcenter', 'vout', 'vup', 'pixperunit', 'new_parts', 'size'], sorted(inst.keys()))
                 for key in remaining_keys:
-                    written = written + ' ' + key + ': ' + repr(inst[key])
-                written = written + '\n'
+                    line.append(key + ': ' + repr(inst[key]))
+                written.write(' '.join(line) + '\n')
                 
-        return written
+        if fp is None:
+            return written.getvalue()
+
+    def write_binary(self, fp):
+        """
+        Writes the module to the file object fp in the binary format
+        """
+        sizes = {'fullr': 'r', 'full': 'f', 'quarter': 'q', 'halfh': 'h'}
+        self.update_statistics()
+
+        # Parts
+        names = []
+        name_lookups = {}
+        configs = []
+        config_lookups = {}
+        config_width = max([0] + map(lambda x: len(x.configure), self.netlist))
+        name_indices = np.zeros(len(self.netlist), '<u2')
+        config_indices = np.zeros((len(self.netlist), config_width), '<u2') + no_configure
+        for part_index, part in enumerate(self.netlist):
+            if not name_lookups.has_key(part.name):
+                name_lookups[part.name] = len(names)
+                names.append(part.name)
+            name_indices[part_index] = name_lookups[part.name]
+            for config_index, config in enumerate(part.configure):
+                config = str(config)
+                if not config_lookups.has_key(config):
+                    config_lookups[config] = len(configs)
+                    configs.append(config)
+                config_indices[part_index, config_index] = config_lookups[config]
+        matrices = np.reshape(map(lambda x: x.matrix, self.netlist), (-1, 16)).astype('<f4')
+        names = '\n'.join(names)
+        configs = '\n'.join(configs)
+
+        # Ends
+        len_ends = min(len(self.ends), len(self.ends_types))
+        ends_types = np.array(self.ends_types[:len_ends], 'S1')
+        ends = np.reshape(self.ends[:len_ends], (-1, 9)).astype('<f4')
+
+        # Instructions
+        instructions = self.individual_instructions + self.group_instructions
+        records = np.zeros(len(instructions), binary_instruction)
+        new_parts = []
+        extras = []
+        for count, inst in enumerate(instructions):
+            record = records[count]
+            if count < len(self.individual_instructions):
+                record['type'] = 'i'
+            else:
+                record['type'] = 'g'
+            record['size'] = sizes[inst['size']]
+            record['vcenter'] = inst['vcenter']
+            record['vout'] = inst['vout']
+            record['vup'] = inst['vup']
+            record['pixperunit'] = inst['pixperunit']
+            record['new_parts'] = len(inst['new_parts'])
+            new_parts.extend(inst['new_parts'])
+            remaining_keys = filter(lambda x: x not in ['vcenter', 'vout', 'vup', 'pixperunit', 'new_parts', 'size'], sorted(inst.keys()))
+            extra = repr(map(lambda x: (x, inst[x]), remaining_keys))
+            record['extra_bytes'] = len(extra)
+            extras.append(extra)
+        new_parts = np.array(new_parts, '<u4')
+        extras = ''.join(extras)
+
+        header = np.zeros(1, binary_header)
+        header['magic'] = binary_magic
+        header['version'] = binary_version
+        header['name_bytes'] = len(names)
+        header['parts'] = len(self.netlist)
+        header['config_bytes'] = len(configs)
+        header['config_width'] = config_width
+        header['ends'] = len_ends
+        header['instructions'] = len(instructions)
+        header['new_parts'] = len(new_parts)
+        header['extra_bytes'] = len(extras)
+        for section in (header, names, name_indices, matrices,
+                        configs, config_indices, ends_types, ends,
+                        records, new_parts, extras):
+            write_section(fp, section)
+
+    def load_binary(self, data):
+        """
+        Converts a binary module, in a string or memmap, into a module
+        without drawing it.
+        """
+        header, offset = binary_section(data, 0, binary_header, 1)
+        header = header[0]
+        if header['magic'] != binary_magic or header['version'] > binary_version:
+            raise ValueError('not a version ' + str(binary_version) + ' binary model')
+        names, offset = binary_section(data, offset, 'S1', header['name_bytes'])
+        name_indices, offset = binary_section(data, offset, '<u2', header['parts'])
+        matrices, offset = binary_section(data, offset, '<f4', 16*header['parts'])
+        configs, offset = binary_section(data, offset, 'S1', header['config_bytes'])
+        config_indices, offset = binary_section(data, offset, '<u2', header['parts']*header['config_width'])
+        ends_types, offset = binary_section(data, offset, 'S1', header['ends'])
+        ends, offset = binary_section(data, offset, '<f4', 9*header['ends'])
+        records, offset = binary_section(data, offset, binary_instruction, header['instructions'])
+        new_parts, offset = binary_section(data, offset, '<u4', header['new_parts'])
+        extras, offset = binary_section(data, offset, 'S1', header['extra_bytes'])
+
+        # Parts
+        names = names.tostring().split('\n')
+        configs = configs.tostring().split('\n')
+        matrices = np.array(matrices.reshape((-1, 4, 4)))
+        config_indices = config_indices.reshape((header['parts'], header['config_width'])).tolist()
+        len_netlist = len(self.netlist)
+        ends_state = self.ends_state()
+        self.log_instructions()
+        for name_index, matrix, part_configs in zip(name_indices.tolist(), matrices, config_indices):
+            name = names[name_index]
+            try:
+                part = new_piece(name)
+            except KeyError:
+                print 'Warning: ' + name + ' missing'
+                continue
+            part.name = name
+            for config_index, config in enumerate(part_configs):
+                if config != no_configure:
+                    part.configure[config_index] = configs[config]
+            part.matrix = matrix
+            self.netlist.append(part)
+        calc_parts_ends(self.netlist[len_netlist:])
+
+        # Ends
+        self.ends_types = list(ends_types.tostring())
+        self.ends = list(np.array(ends, np.float64).reshape((-1, 3, 3)))
+
+        # Instructions
+        new_parts = new_parts.tolist()
+        extras = extras.tostring()
+        new_parts_start = 0
+        extras_start = 0
+        for record in records:
+            inst = {'vcenter': np.array(record['vcenter']),
+                    'vout': np.array(record['vout']),
+                    'vup': np.array(record['vup']),
+                    'pixperunit': float(record['pixperunit'])}
+            new_parts_end = new_parts_start + record['new_parts']
+            inst['new_parts'] = new_parts[new_parts_start:new_parts_end]
+            new_parts_start = new_parts_end
+            inst['size'] = instruction_sizes[record['size']]
+            extras_end = extras_start + record['extra_bytes']
+            for key, value in ast.literal_eval(extras[extras_start:extras_end]):
+                inst[key] = value
+            extras_start = extras_end
+            if record['type'] == 'i':
+                self.individual_instructions.append(inst)
+            else:
+                self.group_instructions.append(inst)
+        if len(self.individual_instructions) > 0 and self.individual_instructions[0].has_key('hold_pose'):
+            self.hold_pose = 1
+
+        self.index_ends()
+        self.log_load(len_netlist, ends_state)
+        self.instructions = self.individual_instructions
+        self.generate_instruction_start()
+
+    def write_file(self, filename):
+        """
+        Writes the module to filename, in the binary format if
+        filename ends in binary_extension and as text otherwise
+        """
+        if is_binary(filename):
+            fp = open(filename, 'wb')
+            self.write_binary(fp)
+        else:
+            fp = open(filename, 'w')
+            self.write_netlist(fp)
+        fp.close()
+
+    def load_file(self, filename):
+        """
+        Reads a text or binary module file into a module without
+        drawing it
+        """
+        if is_binary(filename):
+            self.load_binary(np.memmap(filename, np.uint8, 'r'))
+        else:
+            fp = open(filename, 'r')
+            self.load_netlist(fp.readlines())
+            fp.close()
+
+    def read_file(self, filename):
+        """
+        Reads a text or binary module file into a module and draws it
+        """
+        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+        self.load_file(filename)
+        self.draw_loaded()
 
     def read_netlist(self, netlist):
+        """
+        Reads a string representation of a module, converts it into
+        a module, and draws it.
+        """
+        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+        self.load_netlist(netlist)
+        self.draw_loaded()
+
+    def draw_loaded(self):
+        """
+        Draws a newly loaded module and starts its history
+        """
+        self.draw_parts()
+
+        self.capture_background()
+
+        self.history_push()
+
+    def load_netlist(self, netlist):
         """
         Reads a string representation of a module and converts it into
-        a module.
+        a module without drawing it.
         """
         # This newer version takes a few more lines, but it makes
         # files about half-size.
         global colors, xabstol
-        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+        len_netlist = len(self.netlist)
+        ends_state = self.ends_state()
+        self.log_instructions()
 
         if netlist[0][0] == '[': # Prior to version 0.4 style netlist
-            netlist = eval(netlist[0]) # Convert to list
+            netlist = ast.literal_eval(netlist[0]) # Convert to list
             for part_line in netlist[0]:
-                part = eval('pieces.' + part_line[0] + '()')
+                part = new_piece(part_line[0])
                 part.name, angle, vrot, angle2, vrot2, delta, flip, part.ends, part.center = part_line
                 angle = float(angle)
                 vrot = np.array(vrot)/10.0
@@ -891,14 +3104,9 @@ class module(object):
                 flip = float(flip)
                 part.ends = map(lambda x: (np.array(x[0])/10.0, np.array(x[1])/10.0, np.array(x[2])/10.0), part.ends)
                 part.center = np.array(part.center)/10.0
-                glPushMatrix()
-                glLoadIdentity()
-                glRotatef(angle, vrot[0], vrot[1], vrot[2])
-                glRotatef(angle2, vrot2[0], vrot2[1], vrot2[2])
-                glTranslatef(-delta[0], -delta[1], -delta[2])
-                part.matrix = glGetFloatv(GL_MODELVIEW_MATRIX)
-                glPopMatrix()
-                part.draw()
+                part.matrix = vector_math.compose(vector_math.rotation_matrix(angle, vrot),
+                                                  vector_math.rotation_matrix(angle2, vrot2),
+                                                  vector_math.translation_matrix(-delta))
                 self.netlist.append(part)
             self.ends = copy.copy(netlist[1])
             if len(netlist) > 2:
@@ -918,82 +3126,19 @@ class module(object):
                         if done == 1:
                             break
 
-        elif netlist[0].strip() == 'v0.4': # prior to version 1.0 style netlist
-            #lines = netlist.split('\n')
+        elif netlist[0].strip() in ['v0.4', 'v1.0']:
+            if netlist[0].strip() == 'v0.4': # prior to version 1.0 style netlist
+                sf = 10.0
+            else: # Latest style netlist
+                sf = 1.0/pieces.sf
             line_number = 1
             # Pieces
-            while line_number < len(netlist) and netlist[line_number][0:3] != 'end' and netlist[line_number][0:2] != 'i ':
-                part_line = netlist[line_number].split()
-                part = eval('pieces.' + part_line[0] + '()')
-                part.name = part_line[0]
-                len_configs = len(part_line) - 17 # 17 = name + 16 pos matrix
-                if len_configs > 0:
-                    for config_index in range(len_configs):
-                        part.configure[config_index] = part_line[1+config_index]
-                part.matrix = (np.array(map(lambda x: float(x), part_line[1+len_configs:]))/10.0).reshape((4,4))
-                part.calc_ends()
-                part.draw()
-                self.netlist.append(part)
-                line_number = line_number + 1
-            # Ends
-            self.ends = []
-            self.ends_types = []
-            while line_number < len(netlist) and netlist[line_number][0:2] != 'i ':
-                end_line = netlist[line_number].split()
-                self.ends_types.append(end_line[1])
-                num_end = np.array(map(lambda x: float(x), end_line[2:]))/10.0
-                self.ends.append((num_end[0:3], num_end[3:6], num_end[6:9]))
-                line_number = line_number + 1
-
-            # Instructions
-            sizes = {'f': 'full', 'r': 'fullr', 'q': 'quarter', 'h': 'halfh'}
-            while line_number < len(netlist):
-                line = netlist[line_number]
-                for size in sizes.keys():
-                    sizei = line.find(' ' + size)
-                    if line[sizei+2] != ' ' and line[sizei+2] != '\n':
-                        sizei = -1
-                    if sizei >= 0:
-                        break
-                line_start = line[:sizei].split()[1:]
-                line_floats = map(lambda x: float(x), line_start[:10])
-                inst = {'vcenter': np.array(line_floats[0:3]),
-                        'vout': np.array(line_floats[3:6]),
-                        'vup': np.array(line_floats[6:9]),
-                        'pixperunit': line_floats[9]}
-                inst['new_parts'] = map(lambda x: int(x), line_start[10:])
-                inst['size'] = sizes[size]
-                # Parse defaults
-                line = line[sizei+2:].strip()
-                if line:
-                    line_split = line.split()
-                    default_index = 0
-                    while default_index < len(line_split):
-                        ls_index = default_index + 1
-                        while ls_index < len(line_split) and line_split[ls_index][-1] != ':':
-                            ls_index = ls_index + 1
-                        inst[line_split[default_index][:-1]] = eval(' '.join(line_split[default_index+1:ls_index]))
-                        default_index = ls_index
-                # Convert draw_old_parts_from to submodel
-                if inst.has_key('draw_old_parts_from'):
-                    if inst['draw_old_parts_from'] == 0: # a pop
-                        inst['submodel'] = -1
-                    else:
-                        inst['submodel'] = 1
-                    del inst['draw_old_parts_from']
-                self.instructions.append(inst)
-                line_number = line_number + 1
-
-        elif netlist[0].strip() == 'v1.0': # Latest style netlist
-            #lines = netlist.split('\n')
-            line_number = 1
-            sf = 1.0/pieces.sf
-            # Pieces
+            numbers = []
             while line_number < len(netlist) and netlist[line_number][0:3] != 'end' and netlist[line_number][0:2] != 'i ':
                 part_line = netlist[line_number].split()
                 try:
-                    part = eval('pieces.' + part_line[0] + '()')
-                except:
+                    part = new_piece(part_line[0])
+                except KeyError:
                     print 'Warning: ' + part_line[0] + ' missing'
                     part = None
                 if part:
@@ -1003,71 +3148,41 @@ class module(object):
                     if len_configs > 0:
                         for config_index in range(len_configs):
                             part.configure[config_index] = part_line[1+config_index]
-                    part.matrix = (np.array(map(lambda x: float(x), part_line[1+len_configs:]))/sf).reshape((4,4))
-                    part.calc_ends()
-                    part.draw()
+                    numbers.append(' '.join(part_line[1+len_configs:]))
                     self.netlist.append(part)
                 line_number = line_number + 1
+            matrices = (np.fromstring(' '.join(numbers), sep=' ')/sf).reshape((-1, 4, 4))
+            for part, matrix in zip(self.netlist[len_netlist:], matrices):
+                part.matrix = matrix
+            calc_parts_ends(self.netlist[len_netlist:])
             # Ends
-            self.ends = []
             self.ends_types = []
+            numbers = []
             while line_number < len(netlist) and netlist[line_number][0:2] != 'i ':
                 end_line = netlist[line_number].split()
                 self.ends_types.append(end_line[1])
-                num_end = np.array(map(lambda x: float(x), end_line[2:]))/sf
-                self.ends.append((num_end[0:3], num_end[3:6], num_end[6:9]))
+                numbers.append(' '.join(end_line[2:]))
                 line_number = line_number + 1
+            self.ends = map(lambda x: (x[0:3], x[3:6], x[6:9]), (np.fromstring(' '.join(numbers), sep=' ')/sf).reshape((-1, 9)))
 
             # Instructions
-            sizes = {'f': 'full', 'r': 'fullr', 'q': 'quarter', 'h': 'halfh'}
-            title_line = line_number
-            for c, itype in (('i', self.individual_instructions),
-                             ('g', self.group_instructions)):
-                while line_number < len(netlist) and netlist[line_number][0:2] == c + ' ':
-                    line = netlist[line_number].strip()
-                    for size in sizes.keys():
-                        sizei = line.find(' ' + size)
-                        if sizei + 2 < len(line) and line[sizei+2] != ' ':
-                            sizei = -1
-                        if sizei >= 0:
-                            break
-                    line_start = line[:sizei].split()[1:]
-                    line_floats = map(lambda x: float(x), line_start[:10])
-                    inst = {'vcenter': np.array(line_floats[0:3]),
-                            'vout': np.array(line_floats[3:6]),
-                            'vup': np.array(line_floats[6:9]),
-                            'pixperunit': line_floats[9]}
-                    inst['new_parts'] = map(lambda x: int(x), line_start[10:])
-                    inst['size'] = sizes[size]
-                    # Parse defaults
-                    line = line[sizei+2:].strip()
-                    if line:
-                        line_split = line.split()
-                        default_index = 0
-                        while default_index < len(line_split):
-                            ls_index = default_index + 1
-                            while ls_index < len(line_split) and line_split[ls_index][-1] != ':':
-                                ls_index = ls_index + 1
-                            inst[line_split[default_index][:-1]] = eval(' '.join(line_split[default_index+1:ls_index]))
-                            default_index = ls_index
-                    # Convert draw_old_parts_from to submodel
-                    if inst.has_key('draw_old_parts_from'):
-                        if inst['draw_old_parts_from'] == 0: # a pop
-                            inst['submodel'] = -1
-                        else:
-                            inst['submodel'] = 1
-                        del inst['draw_old_parts_from']
-                    itype.append(inst)
+            if sf == 10.0:
+                while line_number < len(netlist):
+                    self.instructions.append(parse_instruction(netlist[line_number]))
                     line_number = line_number + 1
-            if len(self.individual_instructions) > 0 and self.individual_instructions[0].has_key('hold_pose'):
-                self.hold_pose = 1
-
+            else:
+                for c, itype in (('i', self.individual_instructions),
+                                 ('g', self.group_instructions)):
+                    while line_number < len(netlist) and netlist[line_number][0:2] == c + ' ':
+                        itype.append(parse_instruction(netlist[line_number]))
+                        line_number = line_number + 1
+                if len(self.individual_instructions) > 0 and self.individual_instructions[0].has_key('hold_pose'):
+                    self.hold_pose = 1
+
+        self.index_ends()
+        self.log_load(len_netlist, ends_state)
         self.instructions = self.individual_instructions
         self.generate_instruction_start()
-
-        self.capture_background()
-
-        self.history_push()
     
     def generate_instruction_start(self):
         count = 0
@@ -1143,13 +3258,12 @@ class module(object):
         bad_angle = 0
         xted_ports = []
         if len(self.netlist) == 0: # Remove the start_ends, if needed
-            self.ends = []
+            self.replace_ends([], self.ends_types)
             new_ports = range(len(part.ends))
         else:
             new_ports = []
-            self_ends = np.array(self.ends)
             for port_index, part_port in enumerate(part.ends):
-                aligned_index = self.ends_aligned(part_port, self_ends)
+                aligned_index = self.find_end(part_port)
                 if aligned_index > 0: # aligned and good angle
                     xted_ports.append(aligned_index-1)
                 else:
@@ -1172,18 +3286,19 @@ class module(object):
             xted_ports.sort()
             count = 0
             for xted_port in xted_ports: # remove the xted ends
-                del self.ends[xted_port - count]
-                del self.ends_types[xted_port - count]
+                self.delete_end(xted_port - count)
                 count = count + 1
             for new_port in new_ports: # add the new ends
-                self.ends.append(part.ends[new_port])
-                self.ends_types.append(part.ends_types[new_port])
+                self.append_end(part.ends[new_port], part.ends_types[new_port])
 
             if self.port >= len(self.ends_types):
                 self.port = 0
 
             if not only_move:
+                self.changes.append(('parts', len(self.netlist), [], [part]))
                 self.netlist.append(part)
+                self.batches.add(part)
+                self.center_points.splice(len(self.netlist) - 1, 0, part.center)
 
             if record:
                 self.history_push()
@@ -1218,9 +3333,8 @@ class module(object):
         # Fix Ends
         rm_ports = []
         add_ports = []
-        self_ends = np.array(self.ends)
         for port_index, part_port in enumerate(part.ends):
-            aligned_index = self.ends_aligned(part_port, self_ends, same_dir=1)
+            aligned_index = self.find_end(part_port, same_dir=1)
             if aligned_index > 0:
                 rm_ports.append(aligned_index-1)
             else:
@@ -1228,25 +3342,27 @@ class module(object):
         rm_ports.sort()
         count = 0
         for rm_port in rm_ports:
-            del self.ends[rm_port - count]
-            del self.ends_types[rm_port - count]
+            self.delete_end(rm_port - count)
             count = count + 1
         for add_port in add_ports: # The inverted end is added
             end = part.ends[add_port].copy()
             end[1] = end[0] + end[0] - end[1]
-            self.ends.append(end)
             if part.ends_types[add_port] == 'j':
-                self.ends_types.append('s')
+                self.append_end(end, 's')
             else:
-                self.ends_types.append('j')
+                self.append_end(end, 'j')
 
         if not only_move:
             # Remove part
+            self.changes.append(('parts', part_index, [part], []))
             del self.netlist[part_index]
+            self.batches.remove(part)
+            self.center_points.splice(part_index, 1, [])
             if self.port >= len(self.ends_types):
                 self.port = 0
             
             # Fix Instructions
+            self.log_instructions()
             for instructions in [self.individual_instructions,
                                  self.group_instructions]:
                 for instruction_index in range(len(instructions)):
@@ -1307,97 +3423,82 @@ class module(object):
         #pdelta = delta*pieces.lenp5
         pdelta = 0.5*delta*pieces.lenp5 # possible with new scales
 
-        glPushMatrix()
-        glLoadIdentity()
-        glTranslatef(pdelta[0], pdelta[1], pdelta[2])
-        
+        m = vector_math.translation_matrix(pdelta)
         for count in self.selected:
-            glPushMatrix()
-            glMultMatrixf(self.netlist[count].matrix)
-            self.netlist[count].matrix = glGetFloatv(GL_MODELVIEW_MATRIX)
-            glPopMatrix()
-        glPopMatrix()
+            self.log_part(self.netlist[count])
+            self.netlist[count].matrix = vector_math.multiply(m, self.netlist[count].matrix)
+            self.batches.move(self.netlist[count])
 
     def rotate_selected(self, angle, about, offset):
         """
         Rotate the selected parts in a temporary way
         """
-        glPushMatrix()
-        glLoadIdentity()
-        glTranslatef(offset[0], offset[1], offset[2])
-        glRotatef(angle, about[0], about[1], about[2])
-        glTranslatef(-offset[0], -offset[1], -offset[2])
-
+        m = vector_math.compose(vector_math.translation_matrix(offset),
+                                vector_math.rotation_matrix(angle, about),
+                                vector_math.translation_matrix(-np.asarray(offset)))
         for count in self.selected:
-            glPushMatrix()
-            glMultMatrixf(self.netlist[count].matrix)
-            self.netlist[count].matrix = glGetFloatv(GL_MODELVIEW_MATRIX)
-            glPopMatrix()
-        glPopMatrix()
+            self.log_part(self.netlist[count])
+            self.netlist[count].matrix = vector_math.multiply(m, self.netlist[count].matrix)
+            self.batches.move(self.netlist[count])
 
     def mirror_selected(self, axis, offset):
         """
         Mirror the selected parts in a temporary way
         """
-        if axis == 0: # x
-            m = np.array([[-1.0, 0.0, 0.0, 0.0],
-                          [0.0, 1.0, 0.0, 0.0],
-                          [0.0, 0.0, 1.0, 0.0],
-                          [0.0, 0.0, 0.0, 1.0]])
-        elif axis == 1: # y
-            m = np.array([[1.0, 0.0, 0.0, 0.0],
-                          [0.0, -1.0, 0.0, 0.0],
-                          [0.0, 0.0, 1.0, 0.0],
-                          [0.0, 0.0, 0.0, 1.0]])
-        else: # z
-            m = np.array([[1.0, 0.0, 0.0, 0.0],
-                          [0.0, 1.0, 0.0, 0.0],
-                          [0.0, 0.0, -1.0, 0.0],
-                          [0.0, 0.0, 0.0, 1.0]])
-        glPushMatrix()
-        glLoadIdentity()
-        glTranslatef(offset[0], offset[1], offset[2])
-        glMultMatrixf(m)
-        glTranslatef(-offset[0], -offset[1], -offset[2])
-
+        m = vector_math.compose(vector_math.translation_matrix(offset),
+                                vector_math.mirror_matrix(min(axis, 2)),
+                                vector_math.translation_matrix(-np.asarray(offset)))
         for count in self.selected:
-            glPushMatrix()
-            glMultMatrixf(self.netlist[count].matrix)
-            self.netlist[count].matrix = glGetFloatv(GL_MODELVIEW_MATRIX)
-            glPopMatrix()
-        glPopMatrix()
+            self.log_part(self.netlist[count])
+            self.netlist[count].matrix = vector_math.multiply(m, self.netlist[count].matrix)
+            self.batches.move(self.netlist[count])
 
     def write_move(self):
         """
         Write (make it fixed) the move, rotate, or mirror.
 
-        This is simple and works, but for moving many connecting
-        parts, it performs many redundant calculations.  I had a more
-        complex write_move, but it was buggy.
+        All the selected parts are unhooked from their old ends,
+        their new ends are calculated together, and then they are
+        hooked up again.
         """
         for count in self.selected:
             self.remove_part(count, only_move = 1, record = 0)
-            self.netlist[count].calc_ends()
+        moved = map(lambda x: self.netlist[x], self.selected)
+        for part in moved:
+            self.log_part(part)
+        calc_parts_ends(moved)
+        for count in self.selected:
+            self.center_points.splice(count, 1, self.netlist[count].center)
+        for count in self.selected:
             self.connect(self.netlist[count], None, None, capture = 0, only_move = 1, record = 0)
         self.history_push()
 
+    def merge(self, module_add):
+        """
+        Merges the parts and open ends of another module into this one
+        """
+        self.changes.append(('parts', len(self.netlist), [], module_add.netlist[:]))
+        self.netlist = self.netlist + module_add.netlist
+        self.batches.splice([], module_add.netlist)
+        self.index_centers(len(self.netlist) - len(module_add.netlist))
+        for end, end_type in zip(module_add.ends, module_add.ends_types):
+            self.append_end(end, end_type)
+        self.merge_common()
+
     def merge_common(self):
         """
         Merge any common ports in self.ends
         """
         xted_ports = []
-        self_ends = np.array(self.ends)
-        for count1, end1 in enumerate(self_ends):
-            aligned_index = self.ends_aligned(end1, self_ends[count1:])
+        for count1, end1 in enumerate(self.ends):
+            aligned_index = self.find_end(end1, start = count1)
             if aligned_index > 0:
-                count2 = count1 + aligned_index - 1
                 xted_ports.append(count1)
-                xted_ports.append(count2)
+                xted_ports.append(aligned_index - 1)
         xted_ports.sort()
         xted_ports.reverse()
         for xted_port in xted_ports:
-            del self.ends[xted_port]
-            del self.ends_types[xted_port]
+            self.delete_end(xted_port)
 
         # Correct self.port index
         if self.port >= len(self.ends_types):
@@ -1408,26 +3509,74 @@ class module(object):
         Determines the connectivity of a module.
         """
 
-        # Make blank xtions
+        # Flatten every part end
+        part_ends = []
+        part_indices = []
+        end_indices = []
+        for p1i, p1 in enumerate(self.netlist):
+            len_ends = len(p1.ends)
+            if len_ends > 0:
+                part_ends.append(np.reshape(p1.ends, (len_ends, 3, 3)))
+                part_indices.extend([p1i]*len_ends)
+                end_indices.extend(range(len_ends))
+        if len(part_ends) > 0:
+            ends = np.concatenate(part_ends)
+        else:
+            ends = np.zeros((0, 3, 3))
+        part_indices = np.array(part_indices, np.intp)
+
+        # Find the candidate pairs: coincident tips on later parts
+        # with opposed directions
+        a, b = tip_pairs(ends[:,0])
+        later = part_indices[b] > part_indices[a]
+        a = a[later]
+        b = b[later]
+        opposed = np.all(np.abs((ends[a,0] - ends[a,1]) - (ends[b,1] - ends[b,0])) <= xabstol, -1)
+        a = a[opposed]
+        b = b[opposed]
+        dp = np.sum((ends[a,0] - ends[a,2])*(ends[b,0] - ends[b,2]), -1)
+        good = ((-1.0 - xabstol < dp) & (dp < -1.0 + xabstol)) | \
+            ((-xabstol < dp) & (dp < xabstol)) | \
+            ((1.0 - xabstol < dp) & (dp < 1.0 + xabstol))
+        order = np.lexsort((b, a)) # ends are flattened in part order
+        a = a[order].tolist()
+        b = b[order].tolist()
+        good = good[order].tolist()
+
+        # Sweep in part order.  As in the pairwise search, an end takes
+        # the first later part with an aligned end, a part whose first
+        # aligned end is at a bad angle is skipped, and ends already
+        # connected on the later part may be reconnected.
+        xted = [-1]*len(ends)
+        count = 0
+        len_pairs = len(a)
+        while count < len_pairs:
+            e1 = a[count]
+            if xted[e1] < 0:
+                p2i = -1
+                while count < len_pairs and a[count] == e1:
+                    e2 = b[count]
+                    if part_indices[e2] != p2i: # first aligned end on p2
+                        p2i = part_indices[e2]
+                        if good[count]:
+                            xted[e1] = e2
+                            xted[e2] = e1
+                            break
+                        print 'bad_angle', ends[e1], ends[e2]
+                    count = count + 1
+            while count < len_pairs and a[count] == e1:
+                count = count + 1
+
+        # Make xtions
         xtions = []
         for p1 in self.netlist:
             xtion = []
             for count in range(len(p1.ends)):
                 xtion.append(())
             xtions.append(xtion)
-
-        len_netlist = len(self.netlist)
-        for p1i in range(len_netlist):
-            p1 = self.netlist[p1i]
-            for e1i, e1 in enumerate(p1.ends):
-                if xtions[p1i][e1i] == ():
-                    for p2i in range(p1i + 1, len_netlist):
-                        p2 = self.netlist[p2i]
-                        aligned_index = self.ends_aligned(e1, p2.ends)
-                        if aligned_index > 0:
-                            xtions[p1i][e1i] = [p2i, aligned_index-1]
-                            xtions[p2i][aligned_index-1] = [p1i, e1i]
-                            break
+        for e1, e2 in enumerate(xted):
+            if e2 >= 0:
+                xtions[part_indices[e1]][end_indices[e1]] = [int(part_indices[e2]), end_indices[e2]]
 
         return xtions
 
@@ -1440,14 +3589,12 @@ class module(object):
         
         # Re-derive self.ends
         xtions = self.connectivity()
-        self.ends = []
-        self.ends_types = []
+        self.replace_ends([], [])
         for p1i in range(len(self.netlist)):
             p1 = self.netlist[p1i]
             for e1i, e1 in enumerate(p1.ends):
                 if xtions[p1i][e1i] == (): # No connection
-                    self.ends.append(e1)
-                    self.ends_types.append(p1.ends_types[e1i])
+                    self.append_end(e1, p1.ends_types[e1i])
 
     def find_regions(self):
         """
@@ -1460,24 +3607,15 @@ class module(object):
         """
 
         xtions = self.connectivity()
-        regions = [] # a list of lists of part_indices.  Each list defines a region
-        region_lookups = {} # a dictionary of part_index: region_index
+        sets = region_sets()
         for part_index in range(len(self.netlist)):
             part = self.netlist[part_index]
-            try:
-                region_indexf = region_lookups[part_index]
-            except KeyError: # Region doesn't exist; create it
-                regions.append([part_index])
-                region_indexf = len(regions)-1
-                region_lookups[part_index] = region_indexf
+            if not sets.has_key(part_index): # Region doesn't exist; create it
+                sets.add(part_index)
 
             if len(part.axis) > 0: # a joinrot
-                try:
-                    region_indexr = region_lookups[~part_index]
-                except KeyError: # Region doesn't exist; create it
-                    regions.append([~part_index])
-                    region_indexr = len(regions)-1
-                    region_lookups[~part_index] = region_indexr
+                if not sets.has_key(~part_index): # Region doesn't exist; create it
+                    sets.add(~part_index)
 
             for end_index in range(len(part.ends)):
                 xtion = xtions[part_index][end_index]
@@ -1486,30 +3624,20 @@ class module(object):
                     xtions[xted_part_index][xted_end_index] = [] # Keep the connection back from being processed
                     xted_part = self.netlist[xted_part_index]
                     if end_index in part.axis: # an axis
-                        region_index = region_indexr
-                        writeback = -1
+                        region_index = sets.find(~part_index)
                     else:
-                        region_index = region_indexf
-                        writeback = 1
+                        region_index = sets.find(part_index)
                     if xted_end_index in xted_part.axis: # a joinrot
                         key = ~xted_part_index
                     else:
                         key = xted_part_index
-                    if region_lookups.has_key(key):
-                        merge_region_index = region_lookups[key]
+                    if sets.has_key(key):
+                        merge_region_index = sets.find(key)
                         if merge_region_index != region_index:
-                            regions[merge_region_index] = regions[merge_region_index] + regions[region_index]
-                            for key in regions[region_index]:
-                                region_lookups[key] = merge_region_index
-                            regions[region_index] = []
-                            if writeback == -1:
-                                region_indexr = merge_region_index
-                            else:
-                                region_indexf = merge_region_index
+                            sets.union(merge_region_index, region_index)
                     else:
-                        regions[region_index].append(key)
-                        region_lookups[key] = region_index
-        regions = filter(lambda x: len(x) > 0, regions)
+                        sets.add(key, region_index)
+        regions = sets.regions()
         #print 'regions', regions
         self.regions = regions
         region_lookups = {}
@@ -1526,22 +3654,18 @@ class module(object):
         if len(regions) == 1:
             self.region_axes = []
         else:
-            fast_regions = map(lambda x: np.array(x), regions)
-            for region_index1, region1 in enumerate(fast_regions):
-                joinrot_indices = np.nonzero(region1 < 0)[0]
-                for part_index in region1[joinrot_indices]:
-                    part_index = absinvert(part_index)
-                    for region_index2, region2 in enumerate(fast_regions):
-                        if region_index2 != region_index1:
-                            matching_indices = np.nonzero(region2 == part_index)[0]
-                            if len(matching_indices) > 0: # regions are connected
-                                if region_index1 < region_index2:
-                                    key = (region_index1, region_index2)
-                                else:
-                                    key = (region_index2, region_index1)
-                                part = self.netlist[part_index]
-                                region_axes[key] = part.ends[part.axis[0]] # Okay to keep over-writing, because they should all be the same.
-                                break
+            for region_index1, region1 in enumerate(regions):
+                for joinrot_index in region1:
+                    if joinrot_index < 0:
+                        part_index = absinvert(joinrot_index)
+                        region_index2 = region_lookups[part_index]
+                        if region_index2 != region_index1: # regions are connected
+                            if region_index1 < region_index2:
+                                key = (region_index1, region_index2)
+                            else:
+                                key = (region_index2, region_index1)
+                            part = self.netlist[part_index]
+                            region_axes[key] = part.ends[part.axis[0]] # Okay to keep over-writing, because they should all be the same.
 
         self.region_axes = region_axes
 
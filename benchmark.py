@@ -0,0 +1,238 @@
+#! /usr/bin/python
+
+"""
+Description
+-----------
+Crossbeams Modeller benchmark.  Times the module analysis routines
+on the bundled examples, tiled up to larger models.
+
+usage: python benchmark.py [tiles ...]
+
+Each example is loaded and tiled tiles times along x, far enough
+apart that the copies do not touch.  The default tiles are 1 4 16.
+
+Then times the outline kernel (vector_math.outline_mask) against the
+offset loop it replaced, at screen and print sizes, on depth images of
+random boxes standing in for a drawn model.
+
+Last, times finding the parts in a zoomed-in view of each tiled
+example with the bounding volume hierarchy (base_pieces.bounds_tree),
+counting the parts drawn and culled.
+
+Then times reading a drawing (pieces.read_raw) against the copies it
+replaced, on made-up .raw files, with the memory each holds.
+
+See cbmodel.py for a description of the package and its history.
+
+Author
+------
+Charles Sharman
+
+License
+-------
+Distributed under the GNU GENERAL PUBLIC LICENSE Version 3.  View
+LICENSE for details.
+"""
+
+import sys
+import os
+import glob
+import time
+import copy
+import tempfile
+import shutil
+
+import numpy as np
+
+import pieces
+import base_pieces
+import vector_math
+
+share_directory = os.path.dirname(os.path.abspath(__file__))
+
+def load(filename):
+    """
+    Returns a module read from filename
+    """
+    model = base_pieces.module()
+    model.load_file(filename)
+    return model
+
+def tile(model, tiles):
+    """
+    Returns a module of tiles copies of model placed side by side
+    along x
+    """
+    tips = np.concatenate(map(lambda x: x.ends[:,0], model.netlist))
+    spacing = np.ceil((np.max(tips[:,0]) - np.min(tips[:,0]))/pieces.lenp5 + 2.0)*pieces.lenp5
+    tiled = base_pieces.module()
+    for count in range(tiles):
+        for part in model.netlist:
+            part = copy.deepcopy(part)
+            part.matrix[3,0] = part.matrix[3,0] + count*spacing
+            tiled.netlist.append(part)
+    base_pieces.calc_parts_ends(tiled.netlist)
+    return tiled
+
+def timed(function, *args):
+    """
+    Returns the seconds function(*args) takes
+    """
+    start = time.time()
+    function(*args)
+    return time.time() - start
+
+def benchmark(filename, tiles):
+    model = tile(load(filename), tiles)
+    print '%-24s %3d %6d %12.3f %12.3f' % (os.path.basename(filename), tiles, len(model.netlist),
+                                           timed(model.connectivity),
+                                           timed(model.find_regions))
+
+def depth_image(height, width, boxes = 60):
+    """
+    Returns a depth image of random boxes over a 1.0 background
+    """
+    random = np.random.RandomState(0)
+    depth = np.ones((height, width), np.float32)
+    for count in range(boxes):
+        y, x = random.randint(height/6, 5*height/6), random.randint(width/6, 5*width/6)
+        dy, dx = random.randint(2, height/10), random.randint(2, width/10)
+        box = depth[max(0, y-dy):y+dy,max(0, x-dx):x+dx]
+        box[:] = np.minimum(box, random.uniform(0.2, 0.9) + np.linspace(0.0, 1e-4, box.shape[1]).astype(np.float32))
+    return depth
+
+def outline_loop(depth, radius, shadow):
+    """
+    Returns the outline mask the way draw_part_outlines used to, by
+    shifting the whole image by every offset
+    """
+    outline = (depth < 1.0).astype(np.uint8)
+    shadow_depth = depth + shadow
+    ol = np.zeros(outline.shape, np.uint8)
+    sh = np.ones(outline.shape, np.float32)
+    ymax, xmax = outline.shape
+    for x, y in vector_math.offsets(radius, radius - 1):
+        y1 = max(0, y)
+        y2 = min(ymax, ymax + y)
+        x1 = max(0, x)
+        x2 = min(xmax, xmax + x)
+        y3 = max(0, -y)
+        y4 = min(ymax, ymax - y)
+        x3 = max(0, -x)
+        x4 = min(xmax, xmax - x)
+        ol[y1:y2,x1:x2] = ol[y1:y2,x1:x2] | outline[y3:y4,x3:x4]
+        sh[y1:y2,x1:x2] = np.minimum(sh[y1:y2,x1:x2], shadow_depth[y3:y4,x3:x4])
+    return ol & (sh < depth)
+
+def outline_benchmark(name, width, height, radius):
+    depth = depth_image(height, width)
+    shadow = 0.01
+    same = (outline_loop(depth, radius, shadow) == vector_math.outline_mask(depth, radius, shadow)).all()
+    print '%-8s %5dx%-5d %6d %8.3f %8.3f %5s' % (name, width, height, radius,
+                                              timed(outline_loop, depth, radius, shadow),
+                                              timed(vector_math.outline_mask, depth, radius, shadow),
+                                              same)
+
+def view_planes(center, out, up, width, height):
+    """
+    Returns the planes of the view cbmodel sets up (gluLookAt from
+    center + out, glOrtho of width x height and depth 800)
+    """
+    back = vector_math.normalize(out)
+    right = vector_math.normalize(np.cross(up, back))
+    up = np.cross(back, right)
+    eye = center + out
+    model = np.identity(4)
+    model[:3,0] = right
+    model[:3,1] = up
+    model[:3,2] = back
+    model[3,:3] = -np.dot(np.array([right, up, back]), eye)
+    projection = np.diag([2.0/width, 2.0/height, -1.0/400.0, 1.0])
+    return vector_math.frustum_planes(model, projection)
+
+def cull_benchmark(filename, tiles, width = 60.0, height = 40.0):
+    model = tile(load(filename), tiles)
+    start = time.time()
+    tree = base_pieces.bounds_tree(*base_pieces.part_bounds(model.netlist))
+    build = time.time() - start
+    planes = view_planes(model.netlist[0].center, np.array([1.0, 1.0, 1.0]), np.array([0.0, 0.0, 1.0]), width, height)
+    start = time.time()
+    drawn = np.count_nonzero(tree.visible(planes))
+    print '%-24s %3d %6d %8.3f %8.4f %6d %6d' % (os.path.basename(filename), tiles, len(model.netlist),
+                                                build, time.time() - start,
+                                                drawn, len(model.netlist) - drawn)
+
+def resident():
+    """
+    Returns the bytes of memory resident, or 0 if unknown
+    """
+    try:
+        return int(open('/proc/self/statm').read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, AttributeError):
+        return 0
+
+def raw_copies(name):
+    """
+    Returns the arrays drawing name used to make: the file, normals
+    and vertices
+    """
+    full_name = os.path.join(pieces.share_directory, 'ogl_drawings', name + '.raw')
+    rawdata = np.fromfile(full_name, np.float32)
+    rawdata = np.reshape(rawdata, (len(rawdata)/3, 3))
+    normals = np.repeat(rawdata[::4], 3, 0)
+    vertices = np.delete(rawdata, np.s_[::4], 0)
+    return rawdata, normals, vertices
+
+def raw_benchmark(triangles):
+    """
+    Reads a drawing of random triangles both ways.  Memory is what is
+    resident while the results are held.
+    """
+    directory = tempfile.mkdtemp()
+    save_directory = pieces.share_directory
+    try:
+        os.mkdir(os.path.join(directory, 'ogl_drawings'))
+        np.random.RandomState(0).rand(triangles*12).astype(np.float32).tofile(os.path.join(directory, 'ogl_drawings', 'test.raw'))
+        pieces.share_directory = directory
+        results = []
+        for function in (raw_copies, pieces.read_raw):
+            before = resident()
+            start = time.time()
+            arrays = function('test')
+            results.append((time.time() - start, (resident() - before)/1e6))
+            del arrays
+        same = np.all(np.hstack(raw_copies('test')[1:]) == pieces.read_raw('test'))
+    finally:
+        pieces.share_directory = save_directory
+        shutil.rmtree(directory)
+    print '%-8d %8.3f %8.1f %8.3f %8.1f %5s' % (triangles, results[0][0], results[0][1],
+                                              results[1][0], results[1][1], same)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        tile_counts = map(lambda x: int(x), sys.argv[1:])
+    else:
+        tile_counts = [1, 4, 16]
+    pieces.init(share_directory)
+    print '%-24s %3s %6s %12s %12s' % ('model', 'x', 'parts', 'connectivity', 'find_regions')
+    for filename in sorted(glob.glob(os.path.join(share_directory, 'examples', '*.cbm'))):
+        for tiles in tile_counts:
+            benchmark(filename, tiles)
+
+    # Screen outlines are 2 pixels; print (300dpi, dim_scale 3) up to 6
+    print
+    print '%-8s %11s %6s %8s %8s %5s' % ('outline', 'size', 'radius', 'loop', 'kernel', 'same')
+    outline_benchmark('screen', 850, 600, 2)
+    outline_benchmark('frame', 1223, 1598, 6)
+    outline_benchmark('cover', 2475, 3225, 6)
+
+    print
+    print '%-24s %3s %6s %8s %8s %6s %6s' % ('cull', 'x', 'parts', 'build', 'visible', 'drawn', 'culled')
+    for filename in sorted(glob.glob(os.path.join(share_directory, 'examples', '*.cbm'))):
+        for tiles in tile_counts:
+            cull_benchmark(filename, tiles)
+
+    print
+    print '%-8s %8s %8s %8s %8s %5s' % ('raw', 'copies', 'MB', 'mapped', 'MB', 'same')
+    for triangles in (10000, 100000, 1000000):
+        raw_benchmark(triangles)
@@ -0,0 +1,100 @@
+#!/usr/bin/python
+
+"""
+Description
+-----------
+cbbatch reports on Crossbeams models without the GUI.  The piece
+modules import PyOpenGL, but nothing is drawn, so no display is
+needed.
+
+usage: cbbatch [-s] file.cbm ...
+
+Models may be text (.cbm) or binary (.cbb).
+
+For each model, prints the inventory, mass, price, and dimensions.
+With -s, prints a single tab-separated summary line per model
+instead: file, pieces, mass (g), price ($), and the three dimensions
+(cm).
+
+See cbmodel.py for a description of the package and its history.
+
+Author
+------
+Charles Sharman
+
+License
+-------
+Distributed under the GNU GENERAL PUBLIC LICENSE Version 3.  View
+LICENSE for details.
+"""
+
+import sys
+import os
+
+share_directory = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../share/cbmodel/'))
+if not os.path.exists(share_directory):
+    share_directory = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(share_directory)
+
+import base_pieces
+import pieces
+
+def load(filename):
+    """
+    Returns a module read from filename, without drawing it
+    """
+    model = base_pieces.module()
+    model.load_file(filename)
+    return model
+
+def report(filename, model):
+    """
+    Prints the full report of a model
+    """
+    print filename
+    print 'Quantity Piece'
+    inventory = sorted(model.inventory(), key = lambda x: x[1])
+    for quantity, name in inventory:
+        print '%8d %s' % (quantity, name)
+    print 'Total %d' % sum(map(lambda x: x[0], inventory))
+    mass = model.mass()
+    print 'Mass: %.1fg' % mass
+    print 'Weight: %.1foz' % (mass / 454.0 * 16.0)
+    print 'Price: $%.2f' % model.price()
+    print 'Dimensions: %.1fcm x %.1fcm x %.1fcm' % model.dimensions()
+    print
+
+def summary(filename, model):
+    """
+    Prints a one-line summary of a model
+    """
+    fields = [filename,
+              str(sum(map(lambda x: x[0], model.inventory()))),
+              '%.1f' % model.mass(),
+              '%.2f' % model.price()]
+    fields.extend(map(lambda x: '%.1f' % x, model.dimensions()))
+    print '\t'.join(fields)
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if len(args) > 0 and args[0] == '-s':
+        output = summary
+        args = args[1:]
+    else:
+        output = report
+    if len(args) == 0:
+        print 'usage: cbbatch [-s] file.cbm ...'
+        sys.exit(1)
+
+    pieces.init(share_directory)
+    errors = 0
+    for filename in args:
+        try:
+            model = load(filename)
+        except (IOError, IndexError, ValueError, SyntaxError), error:
+            sys.stderr.write('cbbatch: can\'t read ' + filename + ': ' + str(error) + '\n')
+            errors = errors + 1
+            continue
+        output(filename, model)
+    if errors:
+        sys.exit(1)
@@ -183,6 +183,7 @@ import os
 import time
 import math
 import copy
+import collections
 import ConfigParser
 
 from OpenGL.GL import *
@@ -190,12 +191,10 @@ from OpenGL.GLE import *
 from OpenGL.GLU import *
 from OpenGL.GLUT import *
 
-import pygtk, gtk, gtk.gtkgl, pango, cairo, pangocairo
+import pygtk, gtk, gtk.gtkgl, pango, cairo, pangocairo, gobject
 
 import numpy as np
 
-import PIL.Image as Image
-
 # Global Variables
 try:
     bundled_directory = sys._MEIPASS # Needed for OSX bundles
@@ -232,66 +231,7 @@ import instructions
 
 version = '1.03' # Change also in setup.py, cbmodel.tex
 
-piece_aliases = [('anglep5xp5', 'angle1x1', '1x1'),
-                 ('angle1xp5', 'angle2x1', '2x1'),
-                 ('angle1x1', 'angle2x2', '2x2'),
-                 ('angle1p5x1p5', 'angle3x3', '3x3'),
-                 ('angle2x1', 'angle4x2', '4x2'),
-                 ('angle2x2', 'angle4x4', '4x4'),
-                 ('arc1x1', 'arc2x2', '2x2'),
-                 ('arc1p5x1p5', 'arc3x3', '3x3'),
-                 ('arc2x1', 'arc4x2', '4x2'),
-                 ('arc2x2', 'arc4x4', '4x4'),
-                 ('gear_axle1s', 'axle_g1', 'g1'),
-                 ('gear_axle2s', 'axle_g2', 'g2'),
-                 ('gear1', 'gear1', '1'),
-                 ('gear3s', 'gear3s', '3s'),
-                 ('gear3l', 'gear3l', '3l'),
-                 ('gear_bevel', 'gear_b', 'b'),
-                 ('gear_rack', 'rack', 'rack'),
-                 ('gear_rack_spur', 'gear_r', 'r'),
-                 ('join1', 'join1', '1'),
-                 ('join2', 'join2', '2'),
-                 ('join2flat', 'join2f', '2f'),
-                 ('join3', 'join3', '3'),
-                 ('join3flat', 'join3f', '3f'),
-                 ('join4', 'join4', '4'),
-                 ('join4flat', 'join4f', '4f'),
-                 ('join5', 'join5', '5'),
-                 ('join6', 'join6', '6'),
-                 ('joinrot11', 'rotate2s', '2s'),
-                 ('joinrot12', 'rotate3fd', '3fd'),
-                 ('joinrot21', 'rotate3s', '3s'),
-                 ('joinrot22', 'rotate4d', '4d'),
-                 ('joinrot2flat1', 'rotate3fs', '3fs'),
-                 ('joinrot2flat2', 'rotate4fd', '4fd'),
-                 ('joinrot3flat1', 'rotate4s', '4s'),
-                 ('joinrot3flat2', 'rotate5d', '5d'),
-                 ('joinrot4flat1', 'rotate5s', '5s'),
-                 ('joinrot4flat2', 'rotate6d', '6d'),
-                 ('pivotm1', 'couple2s', '2s'),
-                 ('pivot', 'couple22', '22'),
-                 ('pivot111', 'couple222', '222'),
-                 ('pivot00', 'couple11', '11'), 
-                 ('pivot01', 'couple12', '12'),
-                 ('pivot0m1', 'couple1s', '1s'),
-                 ('pivotm1m1', 'coupless', 'ss'),
-                 ('pivot0', 'couple211', '211'),
-                 ('pivot0_', 'couple1', '1'),
-                 ('straightp5', 'straight1', '1'),
-                 ('straight1m1', 'axle_s', 's'),
-                 ('straight1', 'straight2', '2'),
-                 ('straight1p5', 'straight3', '3'),
-                 ('straight2', 'straight4', '4'),
-                 ('wheel_axle1s1w', 'axle_w1', 'w1'),
-                 ('wheel_axle2s2w', 'axle_w2', 'w2'),
-                 ('wheel_axle1s3w', 'axle_w3', 'w3'),
-                 ('wheelp5', 'wheel1', '1'),
-                 ('wheel1', 'wheel2', '2'),
-                 ('coupler', 'couple', 'couple'),
-                 ('stiffen', 'stiff', 'stiff')]
-
-class MainScreen(object):
+class MainScreen(instructions.Screen):
     """
     Does everything for screen display and interaction with the module
     """
@@ -385,53 +325,6 @@ class MainScreen(object):
                  'viewstandard("right")': 'period',
                  'viewstandard("left")': '<Shift>greater'}
 
-    # Colors
-    #SCREEN_COLOR = ((0.0, 0.0, 0.0), (1.0, 0.25, 0.25)) # BG, FG
-    #PRINT_COLOR = ((1.0, 1.0, 1.0), (0.75, 0.0, 0.0)) # BG, FG
-    #SCREEN_COLOR = ((0.0, 0.0, 0.0), (0.871, 0.504, 0.055)) # BG, FG
-    #PRINT_COLOR = ((1.0, 1.0, 1.0), (0.871, 0.504, 0.055)) # BG, FG
-    #SCREEN_COLOR = ((0.0, 0.0, 0.0), (0.875, 0.549, 0.098)) # BG, FG
-    #PRINT_COLOR = ((1.0, 1.0, 1.0), (0.875, 0.549, 0.098)) # BG, FG
-
-    SCREEN_COLOR = ((0.0, 0.0, 0.0), (1.0, 1.0, 1.0), (1.0, 0.8, 0.0)) # BG, FG, Highlights
-    #PRINT_COVER_COLOR = ((0.0, 0.0, 0.0), (1.0, 1.0, 1.0), (1.0, 0.8, 0.0)) # BG, FG, Highlights
-    PRINT_COVER_COLOR = ((1.0, 1.0, 1.0), (0.0, 0.0, 0.0), (1.0, 0.8, 0.0)) # BG, FG, Highlights
-    #PRINT_BODY_COLOR = ((0.828, 0.879, 0.938), (0.875, 0.549, 0.098)) # BG, FG
-    PRINT_BODY_COLOR = ((1.0, 1.0, 1.0), (0.0, 0.0, 0.0), (1.0, 0.8, 0.0)) # BG, FG, Highlights
-
-    PIECE_COLORS = {'total': (1.0, 1.0, 1.0),
-                    'straight': (1.0, 1.0, 1.0),
-                    'angle': (1.0, 1.0, 1.0),
-                    'arc': (1.0, 1.0, 1.0),
-                    'part': (0.0, 1.0, 0.0),
-                    'edit': (0.45, 0.675, 0.9),
-                    'outline': (0.0, 0.0, 0.0),
-                    'newpart': (0.45, 0.675, 0.9),
-                    'futurepart': (0.33, 0.33, 0.33),
-                    'tire': (0.33, 0.33, 0.33),
-                    'wheel': (1.0, 1.0, 1.0),
-                    'clip': (1.0, 1.0, 1.0),
-                    'gear': (1.0, 1.0, 1.0),
-                    'shaft': (0.5, 0.5, 0.5),
-                    'region0': (1.0, 0.5, 0.5),
-                    'region1': (0.5, 1.0, 0.5),
-                    'region2': (0.5, 0.5, 1.0),
-                    'region3': (0.8, 0.8, 0.4),
-                    'region4': (0.8, 0.4, 0.8),
-                    'region5': (0.4, 0.8, 0.8)}
-
-    # Sizes/Scales
-    SCREEN_SCALE = 100
-    PS_SCALE = 3.0 # Print to Screen Scale DPI = PS_SCALE*SCREEN_SCALE
-    IMAGE_SCALE = 300/(PS_SCALE*SCREEN_SCALE) # Image to Print Scale
-    PAPER_SIZE = (8.5, 11.0) # inches
-    #PAPER_SIZE = (9.06, 11.0) # scaled for 8.5x14 booklet printouts
-    MARGIN_SIZE = 0.125 # inches
-    SEP_SIZE = 0.05 # Internal separation between frames
-    FRAME_MARGIN_SIZE = 0.075 # inches
-    COVER_SIZE = (PAPER_SIZE[0]-2*MARGIN_SIZE, PAPER_SIZE[1]-2*MARGIN_SIZE)
-    FRAME_SIZE = ((PAPER_SIZE[0]-2*MARGIN_SIZE-SEP_SIZE)/2, (PAPER_SIZE[1]-2*MARGIN_SIZE-SEP_SIZE)/2)
-
     # Cursors
     REGULAR_CURSOR = gtk.gdk.Cursor(gtk.gdk.LEFT_PTR)
     WAIT_CURSOR = gtk.gdk.Cursor(gtk.gdk.WATCH)
@@ -446,6 +339,7 @@ class MainScreen(object):
                 self.key_table[key] = self.nonumpad[key]
 
         pieces.init(share_directory)
+        self.share_directory = share_directory
         self.background_color = self.SCREEN_COLOR[0]
         self.annotate_color = self.SCREEN_COLOR[1]
         self.highlight_color = self.SCREEN_COLOR[2]
@@ -471,25 +365,7 @@ class MainScreen(object):
         
         self.lowerleft = (20.0, 20.0)
 
-        # Do aliases
-        self.piece_list = filter(lambda x: type(eval('pieces.' + x)) == type(pieces.stick) and issubclass(eval('pieces.' + x), pieces.stick), dir(pieces))
-        self.piece_list.remove('stick')
-        self.piece_list.remove('axle')
-        self.name2alias = {}
-        self.alias2name = {}
-        self.name2simple = {}
-        for name in self.piece_list:
-            self.name2alias[name] = name
-            self.alias2name[name] = name
-            self.name2simple[name] = name
-        for name, alias, simple in piece_aliases:
-            self.name2alias[name] = alias
-            self.alias2name[alias] = name
-            self.name2simple[name] = simple
-        pieces.aliases = self.name2alias
-        local_alias = map(lambda x: (self.name2alias[x], x), self.piece_list)
-        local_alias.sort()
-        self.piece_list = map(lambda x: x[1], local_alias)
+        self.make_aliases()
 
         self.total = base_pieces.module()
         self.last_joint = 'join2'
@@ -502,10 +378,18 @@ class MainScreen(object):
         self.omit_logo = 0
         self.ps_scale = 1 # start in draft mode
         self.draw_center = 0 # don't show a box at piece centers
+        self.warm_queue = collections.deque() # (name, configure) to make display lists for when idle
+        self.warm_count = 0 # length of self.warm_queue when queued
+        self.warmed = set() # (name, configure or None, detail) with display lists made
 
         # Main
         config_name = self.config_name()
         if config_name:
+            # Shapes captured in earlier sessions (see tessellation_cache)
+            shape_cache = os.path.join(os.path.dirname(config_name), 'cbmodel_shapes')
+            if os.path.basename(config_name).startswith('.'):
+                shape_cache = os.path.join(os.path.dirname(config_name), '.cbmodel_shapes')
+            base_pieces.tessellations.load(shape_cache)
             config = ConfigParser.RawConfigParser()
             config.read(self.config_name())
             if config.has_section('Keys'):
@@ -518,6 +402,11 @@ class MainScreen(object):
                     self.project_directory = try_dir
                 else:
                     print 'Warning: Couldn\'t find directory ' + try_dir
+            if config.has_option('State', 'history_length'):
+                try:
+                    base_pieces.module.HISTORY_LENGTH = max(0, config.getint('State', 'history_length'))
+                except ValueError:
+                    print 'Warning: history_length must be a number'
         self.vcenter = self.start_vcenter
         self.vout = self.start_vout
         self.vup = self.start_vup
@@ -1156,6 +1045,20 @@ class MainScreen(object):
         keyval, keymod = self.key_lookup('render()')
         options_detail_render.add_accelerator('activate', accel_group, keyval, keymod, gtk.ACCEL_VISIBLE)
         options_detail_container.append(options_detail_render)
+
+        options_detail_container.append(gtk.SeparatorMenuItem())
+
+        options_detail_auto = gtk.CheckMenuItem('Automatic')
+        options_detail_auto.set_tooltip_text('Draws pieces small on the screen with less detail, and tiny pieces as simple shapes')
+        options_detail_auto.set_active(False)
+        options_detail_auto.connect('toggled', self.set_auto_detail)
+        options_detail_container.append(options_detail_auto)
+
+        options_detail_gpu_outlines = gtk.CheckMenuItem('GPU Outlines')
+        options_detail_gpu_outlines.set_tooltip_text('Draws outlines with a shader on the graphics card, fast enough for modelling')
+        options_detail_gpu_outlines.set_active(False)
+        options_detail_gpu_outlines.connect('toggled', self.set_outline_shader)
+        options_detail_container.append(options_detail_gpu_outlines)
         
         options_size = gtk.MenuItem('Window Size')
         options_size_container = gtk.Menu()
@@ -1214,6 +1117,12 @@ class MainScreen(object):
         options_draw_centers.connect('toggled', self.set_draw_center)
         options_container.append(options_draw_centers)
 
+        options_pick_visible = gtk.CheckMenuItem('Pick Visible')
+        options_pick_visible.set_tooltip_text('Selects the piece or port drawn under the pointer, rather than the one with the nearest center')
+        options_pick_visible.set_active(True)
+        options_pick_visible.connect('toggled', self.set_id_picking)
+        options_container.append(options_pick_visible)
+
         options_keys_numpad = gtk.MenuItem('Navigation with Numpad')
         options_keys_numpad.set_tooltip_text('Overwrites user settings to use Numeric Keypad keys for navigation')
         options_keys_numpad.connect('activate', self.set_keys, 'numpad')
@@ -1412,27 +1321,14 @@ class MainScreen(object):
         glPixelStorei(GL_UNPACK_LSB_FIRST, GL_FALSE)
         return retval
 
-    def make_image(self, name, filename=None):
+    def wait_cursor(self, wait = 1):
         """
-        Creates an image from file and puts it into the self.images dictionary
+        Shows the wait cursor (wait = 1) or the regular cursor
         """
-        global share_directory
-
-        if not filename:
-            filename = name
-        fullname = os.path.join(share_directory, filename + '.png')
-        try:
-            im = Image.open(fullname)
-        except IOError:
-            self.status_bar.set_text('Warning: Can\'t find ' + fullname)
-            retval = None
-        if im:
-            xsize, ysize = im.size
-            im_print = im.resize((int(xsize/self.IMAGE_SCALE), int(ysize/self.IMAGE_SCALE)), Image.BILINEAR)
-            im_screen = im.resize((int(xsize/(self.PS_SCALE*self.IMAGE_SCALE)), int(ysize/(self.PS_SCALE*self.IMAGE_SCALE))), Image.BILINEAR)
-            retval = {'im_print': im_print,
-                      'im_screen': im_screen}
-        return retval
+        if wait:
+            self.glarea.window.set_cursor(self.WAIT_CURSOR)
+        else:
+            self.glarea.window.set_cursor(self.REGULAR_CURSOR)
 
     def key_lookup(self, func_call):
         """
@@ -1468,37 +1364,86 @@ class MainScreen(object):
             gldrawable = gtk.gtkgl.widget_get_gl_drawable(self.glarea)
         if not gldrawable.gl_begin(glcontext):return
 
-        glClearDepth(1.0)
-        glEnable(GL_DEPTH_TEST)
-        glClearColor(self.background_color[0], self.background_color[1], self.background_color[2], 0.0) 
-
-        glShadeModel(GL_SMOOTH)
-
-        # lighting
-        # Default Lighting Good Enough
-        glLightfv(GL_LIGHT0, GL_POSITION, (0.0, 0.0, 1.0, 0.0)) # infinite
-        glLightfv(GL_LIGHT0, GL_DIFFUSE, (1.0, 1.0, 1.0, 1.0))
-        #glLightfv(GL_LIGHT0, GL_AMBIENT, (0.0, 0.0, 0.0, 1.0))
-        glLightfv(GL_LIGHT0, GL_SPECULAR, (1.0, 1.0, 1.0, 1.0))
+        self.init_gl()
 
-        # Brighter white
-        glLightfv(GL_LIGHT0, GL_AMBIENT, (0.5, 0.5, 0.5, 1.0))
-
-        glEnable(GL_LIGHT0)
-        glEnable(GL_LIGHTING)
-        glColorMaterial(GL_FRONT, GL_DIFFUSE)
-        glEnable(GL_COLOR_MATERIAL) # before
-        #glDisable(GL_COLOR_MATERIAL) # allows specification of material
-
-        glLoadIdentity()
-        gleSetJoinStyle(TUBE_NORM_EDGE | TUBE_JN_ROUND | TUBE_JN_CAP | TUBE_CONTOUR_CLOSED)
-        #gleSetNumSides(32)
+        gldrawable.gl_end()
 
-        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
-        glDisable(GL_LINE_SMOOTH)
-        glLineWidth(2.0)
+        if widget:
+            self.warm_up()
 
-        gldrawable.gl_end()
+    def warm_up(self):
+        """
+        Queues the piece types in the module, then every other piece,
+        to have their display lists made while idle, so the first
+        drawing of each doesn't stall.  Each type is queued once, and
+        types already made at this detail aren't queued.
+        """
+        queue = collections.OrderedDict()
+        for part in self.total.netlist:
+            queue[(part.name, tuple(part.configure))] = 1
+        for name in self.piece_list:
+            queue[(name, None)] = 1
+        queue = filter(lambda x: (x[0], x[1], pieces.detail) not in self.warmed, queue.keys())
+        if not self.warm_queue and queue:
+            gobject.idle_add(self.warm_up_step)
+        self.warm_queue = collections.deque(queue)
+        self.warm_count = len(queue)
+
+    def warm_up_step(self):
+        """
+        Makes display lists for queued piece types for a moment, then
+        returns, so events are still handled.  Pieces are drawn with
+        color and depth writes off, so nothing shows, and the matrix is
+        restored after each, so picking between frames isn't thrown off.
+        """
+        glcontext = gtk.gtkgl.widget_get_gl_context(self.glarea)
+        gldrawable = gtk.gtkgl.widget_get_gl_drawable(self.glarea)
+        if not self.warm_queue or not gldrawable.gl_begin(glcontext):
+            self.warm_queue = collections.deque()
+            return False
+
+        save_auto_detail = base_pieces.auto_detail
+        base_pieces.auto_detail = 0 # make the lists for pieces.detail
+        pieces.list_drawings = 1
+        glPushAttrib(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+        glColorMask(GL_FALSE, GL_FALSE, GL_FALSE, GL_FALSE)
+        glDepthMask(GL_FALSE)
+        start = time.time()
+        try:
+            while self.warm_queue and time.time() - start < 0.05:
+                name, configure = self.warm_queue.popleft()
+                if (name, configure, pieces.detail) in self.warmed:
+                    continue
+                part = base_pieces.new_piece(name)
+                part.name = name
+                if configure == None:
+                    self.warmed.add((name, None, pieces.detail))
+                else:
+                    part.configure = list(configure)
+                key = (name, tuple(part.configure), pieces.detail)
+                if key not in self.warmed: # The default configure may be warm
+                    self.warmed.add(key)
+                    glPushMatrix() # Some shapes rotate without restoring
+                    try:
+                        part.draw_shape()
+                    finally:
+                        glPopMatrix()
+        finally:
+            glPopAttrib()
+            pieces.list_drawings = 0
+            base_pieces.auto_detail = save_auto_detail
+            gldrawable.gl_end()
+
+        # Progress replaces only the mode, not other messages
+        message = 'Preparing pieces'
+        text = self.status_bar.get_text()
+        if self.warm_queue:
+            if text == self.mode or text.startswith(message):
+                self.status_bar.set_text(message + ' %d%%' % (100*(self.warm_count - len(self.warm_queue))/self.warm_count))
+            return True
+        if text.startswith(message):
+            self.status_bar.set_text(self.mode)
+        return False
 
     def opengl_draw(self, widget, event):
         """
@@ -1513,14 +1458,7 @@ class MainScreen(object):
             gldrawable = gtk.gtkgl.widget_get_gl_drawable(self.glarea)
         if not gldrawable.gl_begin(glcontext):return
 
-        glLoadIdentity()
-        veye = self.vcenter + self.vout
-        gluLookAt(veye[0], veye[1], veye[2], \
-        self.vcenter[0], self.vcenter[1], self.vcenter[2], \
-        self.vup[0], self.vup[1], self.vup[2]) # reference point currently fixed
-        model = glGetDoublev(GL_MODELVIEW_MATRIX)
-        projection = glGetDoublev(GL_PROJECTION_MATRIX)
-        viewport = glGetIntegerv(GL_VIEWPORT)
+        model, projection, viewport = self.look()
 
         pieces.default_material()
 
@@ -1530,6 +1468,8 @@ class MainScreen(object):
             # draw() line and uncomment the redraw() line.
             self.total.draw(self.vout, self.vup, self.creationmode)
             #self.total.redraw(self.vout, self.vup, self.creationmode)
+        elif self.redisplay == 'update': # Only where parts changed
+            self.total.update(self.vout, self.vup, self.creationmode)
         else:
             self.total.redraw(self.vout, self.vup, self.creationmode)
 
@@ -1538,15 +1478,7 @@ class MainScreen(object):
                 self.part.calc_draw(base_pieces.colors['part'])
 
         elif self.creationmode == 'instructions' or self.creationmode == 'group':
-            self.part_labels = []
-            for part_index in self.total.selected:
-                part = self.total.netlist[part_index]
-                p = [gluProject(part.center[0], part.center[1], part.center[2], model, projection, viewport), part.label(), part.help_text(), part.inset_files()]
-                self.part_labels.append(p)
-            self.annotate.annotate_opengl()
-            # Restore the Raster Position
-            p = np.array(gluUnProject(0.001, 0.001, 0.001, model, projection, viewport)) # 0.0 for x/y/z sometimes caused clipping
-            glRasterPos3fv(p)
+            self.annotate_frame(model, projection, viewport)
 
         if self.mode == 'border_select' and self.beginx != None:
             glColor3fv(self.highlight_color)
@@ -1585,20 +1517,18 @@ class MainScreen(object):
             glColor3fv(self.highlight_color)
             glDisable(GL_LIGHTING)
             glPointSize(5)
-            glBegin(GL_POINTS)
             if self.creationmode == 'instructions' or self.creationmode == 'group':
                 if self.total.frame < self.total.instruction_start:
-                    for center in self.total.region_centers:
-                        glVertex3fv(center)
+                    centers = self.total.region_centers
                 else:
-                    for part_index in range(len(self.total.netlist)):
-                        if self.total.part_flags[part_index] != 3:
-                            glVertex3fv(self.total.netlist[part_index].center + pieces.base_rad * 2.0 * self.vout)
-                            
+                    centers = self.total.centers[self.total.part_flags != 3] + pieces.base_rad * 2.0 * self.vout
             else:
-                for part in self.total.netlist:
-                    glVertex3fv(part.center + pieces.base_rad * 2.0 * self.vout)
-            glEnd()
+                centers = self.total.centers + pieces.base_rad * 2.0 * self.vout
+            if len(centers) > 0:
+                glEnableClientState(GL_VERTEX_ARRAY)
+                glVertexPointerd(centers)
+                glDrawArrays(GL_POINTS, 0, len(centers))
+                glDisableClientState(GL_VERTEX_ARRAY)
             glEnable(GL_LIGHTING)
 
         # Shouldn't be part of opengl_draw, but easier to put here
@@ -1634,61 +1564,13 @@ class MainScreen(object):
             w = widget.allocation.width
             h = widget.allocation.height
 
-        self.SCR = (w, h)
-        #print 'SCR', self.SCR
-
-        aspect = float(w)/float(h)
-        glViewport(0, 0, w, h)
-        ppu = self.ps_scale*self.pixperunit
-        #if self.image_type == 'print':
-        #    ppu = self.ps_scale*self.pixperunit
-        #else:
-        #    ppu = self.pixperunit
-        x = 0.5*float(w)/ppu
-        y = 0.5*float(h)/ppu
-        #print 'New Dimensions: (' + repr(x) + ', ' + repr(y) + ')', self.ps_scale
-        glMatrixMode(GL_PROJECTION)
-        glLoadIdentity()
-        #glFrustum(-x, x, -y, y, 50.0, 400.0)
-        glOrtho(-x, x, -y, y, -400.0, 400.0)
-        base_pieces.depth_scale = 1.0/800.0 # determined by glOrtho
-        glMatrixMode(GL_MODELVIEW)
-        self.lowerleft = (x, y)
-        self.mpan = max(w, h) / 10.0
+        self.reshape(w, h)
 
         gldrawable.gl_end()
         self.redisplay = 'redraw'
         self.glarea.queue_draw() # Needed for gtk
         self.reshape_called = 1
     
-    def window_size_full(self, widget = None):
-        """
-        Sets the opengl screen size to COVER_SIZE
-        """
-        self.winsize = 'full'
-        self.window_size(widget, (int(self.COVER_SIZE[0]*self.SCREEN_SCALE), int(self.COVER_SIZE[1]*self.SCREEN_SCALE)))
-
-    def window_size_fullr(self, widget = None):
-        """
-        Sets the opengl screen size to COVER_SIZE rotate 90 degrees
-        """
-        self.winsize = 'fullr'
-        self.window_size(widget, (int(self.COVER_SIZE[1]*self.SCREEN_SCALE), int(self.COVER_SIZE[0]*self.SCREEN_SCALE)))
-
-    def window_size_quarter(self, widget = None):
-        """
-        Sets the opengl screen size to a quarter of COVER_SIZE
-        """
-        self.winsize = 'quarter'
-        self.window_size(widget, (int(self.FRAME_SIZE[0]*self.SCREEN_SCALE), int(self.FRAME_SIZE[1]*self.SCREEN_SCALE)))
-
-    def window_size_halfh(self, widget = None):
-        """
-        Sets the opengl screen size to half a COVER_SIZE
-        """
-        self.winsize = 'halfh'
-        self.window_size(widget, (int(self.COVER_SIZE[0]*self.SCREEN_SCALE), int(self.FRAME_SIZE[1]*self.SCREEN_SCALE)))
-
     def window_size(self, widget, size):
         """
         Sets the opengl screen size to size
@@ -1743,10 +1625,6 @@ class MainScreen(object):
             self.redisplay = 'redraw'
             self.glarea.queue_draw()
 
-    def set_pixperunit(self, value):
-        self.pixperunit = value
-        base_pieces.pixperunit = value
-
     def set_draw_outline(self, widget = None, value = 0):
         """
         Turns on or off drawing of outlines around the opengl image
@@ -1755,6 +1633,17 @@ class MainScreen(object):
             value = int(widget.get_active())
         base_pieces.draw_outline = value
 
+    def set_outline_shader(self, widget = None, value = 0):
+        """
+        Turns on or off drawing outlines with a shader
+        """
+        if widget:
+            value = int(widget.get_active())
+        base_pieces.outline_shader = value
+        if base_pieces.draw_outline:
+            self.redisplay = 'redraw'
+            self.glarea.queue_draw()
+
     def set_draw_center(self, widget = None, value = 0):
         """
         Turns on or off center of piece drawing
@@ -1763,6 +1652,14 @@ class MainScreen(object):
             value = int(widget.get_active())
         self.draw_center = value
 
+    def set_id_picking(self, widget = None, value = 1):
+        """
+        Turns on or off picking what is drawn under the pointer
+        """
+        if widget:
+            value = int(widget.get_active())
+        base_pieces.id_picking = value
+
     def set_keys(self, widget = None, value = 'numpad'):
         dialog = gtk.MessageDialog(self.win, 0, gtk.MESSAGE_WARNING, gtk.BUTTONS_OK_CANCEL, 'Your key mappings will permanently change.  You must restart the program to have the key changes take effect.')
         dialog.show_all()
@@ -1813,17 +1710,6 @@ class MainScreen(object):
         dialog.run()
         dialog.destroy()
 
-    def alias_inventory(self, indices = None):
-        """
-        Converts a piece inventory to the known (alias) names
-        """
-        inventory = self.total.inventory(indices)
-        ainv = []
-        for quantity, name in inventory:
-            ainv.append((self.name2alias[name], quantity))
-        ainv.sort()
-        return ainv
-
     def view_inventory(self, widget):
         """
         Displays a dialog of the inventory in the module
@@ -1905,7 +1791,7 @@ class MainScreen(object):
         Changes between creation and instruction mode
         """
         if self.creationmode != mode:
-            self.glarea.window.set_cursor(self.WAIT_CURSOR)
+            self.wait_cursor(1)
             self.total.selected = []
             self.total.group_index = -1
             if self.creationmode == 'instructions':
@@ -1968,7 +1854,7 @@ class MainScreen(object):
 
             else:
                 print 'Error: Unrecognized mode', mode
-            self.glarea.window.set_cursor(self.REGULAR_CURSOR)
+            self.wait_cursor(0)
 
     def clear_instructions(self, widget):
         """
@@ -2283,6 +2169,15 @@ class MainScreen(object):
                 self.toggle_frame(None, frame - self.total.frame, 1)
         dialog.destroy()
 
+    def set_marks(self, mirror_pos, magnify_pos):
+        """
+        Shows the mirror and cross hair icons at mirror_pos and
+        magnify_pos, () hiding them, and checks their menu items
+        """
+        self.instructions_show_mirror.set_active(len(mirror_pos) > 0)
+        self.instructions_show_magnify.set_active(len(magnify_pos) > 0)
+        instructions.Screen.set_marks(self, mirror_pos, magnify_pos)
+
     def toggle_frame(self, widget = None, next = 1, save_current = 1):
         """
         Moves to the previous or next frame in instructions mode,
@@ -2371,98 +2266,7 @@ class MainScreen(object):
                         self.total.instructions[local_frame]['new_parts'] = filter(lambda x: x not in self.total.selected, self.total.instructions[local_frame]['new_parts'])
                         local_frame = local_frame + 1
 
-            # Change Frame
-            self.total.frame = max(0, self.total.frame + next)
-
-            # Create old_parts
-            old_parts = []
-            for frame_index in range(self.total.instruction_start, self.total.frame):
-                old_parts = old_parts + self.total.instructions[frame_index]['new_parts']
-            self.total.old_parts = old_parts
-
-            # Load New Frame
-            if self.total.frame < len(self.total.instructions):
-                inst = self.total.instructions[self.total.frame]
-                self.vcenter = inst['vcenter']
-                self.vout = inst['vout']
-                self.vup = inst['vup']
-                #self.pixperunit = inst['pixperunit']
-                self.set_pixperunit(inst['pixperunit'])
-                self.total.selected = inst['new_parts']
-                winsize = inst['size']
-                if inst.has_key('submodel'):
-                    self.total.submodel = inst['submodel']
-                else:
-                    self.total.submodel = 0
-                if inst.has_key('show_mirror'):
-                    self.instructions_show_mirror.set_active(True)
-                    self.mirror_pos = inst['show_mirror']
-                else:
-                    self.instructions_show_mirror.set_active(False)
-                    self.mirror_pos = ()
-                if inst.has_key('show_magnify'):
-                    self.instructions_show_magnify.set_active(True)
-                    self.magnify_pos = inst['show_magnify']
-                else:
-                    self.instructions_show_magnify.set_active(False)
-                    self.magnify_pos = ()
-                if inst.has_key('fixed'):
-                    fixed = min(max(0, inst['fixed']), len(self.total.regions)-1) # Must handle a change from last time
-                    self.total.set_region_fixed(fixed)
-                if inst.has_key('rotates'):
-                    delta = len(self.total.region_rotates) - len(inst['rotates']) # Must handle a change from last time
-                    if delta <= 0:
-                        self.total.region_rotates = inst['rotates'][:len(self.total.region_rotates)]
-                    else:
-                        self.total.region_rotates = inst['rotates'] + [0]*delta
-                if inst.has_key('group'):
-                    self.start_group = 1
-                else:
-                    self.start_group = 0
-
-            else: # Anything that should be reset per frame goes here
-                if self.total.frame == 0:
-                    winsize = 'full'
-                else:
-                    winsize = self.winsize
-                self.total.selected = []
-                self.total.submodel = 0
-                self.mirror_pos = ()
-                self.magnify_pos = ()
-                self.instructions_show_mirror.set_active(False)
-                self.instructions_show_magnify.set_active(False)
-                self.start_group = 0
-
-            # Create submodel_stack
-            self.total.generate_submodel_stack()
-
-            if self.creationmode == 'group':
-                self.total.generate_groups()
-                group_index = self.total.calc_group_index()
-                prefix = 'Group ' + str(group_index+1) + ' '
-                #print self.total.group_pieces
-                suffix = str(self.total.total_inventory(self.total.group_pieces[group_index]))
-            else:
-                prefix = ''
-                suffix = ''
-
-            if winsize == 'full':
-                self.window_size_full()
-            elif winsize == 'fullr':
-                self.window_size_fullr()
-            elif winsize == 'quarter':
-                self.window_size_quarter()
-            elif winsize == 'halfh':
-                self.window_size_halfh()
-            else:
-                self.window_size(None, (1, 1))
-
-            if self.total.frame == 0:
-                self.status_bar.set_text(prefix + 'Title Page')
-            elif self.total.frame < self.total.instruction_start:
-                self.status_bar.set_text(prefix + 'Pose ' + str(self.total.frame))
-            else:
-                self.status_bar.set_text(prefix + 'Frame ' + str(self.total.frame - self.total.instruction_start + 1) + ' ' + suffix)
+            self.load_frame(next)
 
     def instructions_draft(self, widget = None, value = 1):
         """
@@ -2475,49 +2279,6 @@ class MainScreen(object):
         else:
             self.ps_scale = 3
 
-    def page_layouts(self):
-        """
-        Returns the page layout of each page in the instruction set as
-        a list.  Excludes front and back covers.  len(page_layouts())+2
-        returns the number of pages.
-        """
-        sizes = reduce(lambda x, y: x + y,
-                       map(lambda z: z['size'][0],
-                           self.total.instructions))
-        if self.creationmode == 'group':
-            last_frame = len(self.total.instructions) - 1
-            local_sizes = [sizes[:self.total.instruction_start]]
-            groups = self.total.groups + [last_frame+1]
-            for group_index in range(len(groups)-1):
-                start_index = groups[group_index]
-                end_index = groups[group_index+1]
-                local_sizes.append(sizes[start_index:end_index])
-        else:
-            local_sizes = [sizes[:self.total.instruction_start],
-                           sizes[self.total.instruction_start:]]
-        #print 'local_sizes', local_sizes
-        frame_index = 1
-        retval = []
-        for sizes in local_sizes:
-            while frame_index < len(sizes):
-                layouts = ['f', 'qqqq', 'qqh', 'hqq', 'hh', 'qh', 'qqq', 'hq',
-                           'qq', 'q', 'h']
-                for layout in layouts:
-                    if sizes[frame_index:frame_index+len(layout)] == layout:
-                        frame_index = frame_index + len(layout)
-                        retval.append(layout)
-                        break
-            frame_index = 0
-
-        return retval
-
-    def page_count(self):
-        """
-        Returns the number of pages in the instruction set including
-        front and back cover.
-        """
-        return len(self.page_layouts()) + 2
-
     def generate_instructions(self, widget, filename=None, scale=1.0, pages=['front', 'joining', 'frames', 'combined', 'back'], custom_inventory={}):
         """
         Generates an instruction set
@@ -2564,10 +2325,23 @@ class MainScreen(object):
             detail = max_detail
 
         pieces.detail = detail
+        if self.glarea.flags() & gtk.REALIZED:
+            self.warm_up()
         
         self.redisplay = 'redraw'
         self.glarea.queue_draw()
 
+    def set_auto_detail(self, widget = None, value = 0):
+        """
+        Turns on or off choosing each piece's detail by its size on
+        the screen
+        """
+        if widget:
+            value = int(widget.get_active())
+        base_pieces.auto_detail = value
+        self.redisplay = 'redraw'
+        self.glarea.queue_draw()
+
     def solid(self, widget = None):
         """
         Chooses solid detail
@@ -2762,6 +2536,9 @@ class MainScreen(object):
 
                 if response == gtk.RESPONSE_CANCEL:
                     part.configure = config_save
+                else:
+                    self.total.statistics = None
+                    self.total.batches.reconfigure(part)
 
                 dialog.destroy()
                 self.redisplay = 'redraw'
@@ -2783,6 +2560,7 @@ class MainScreen(object):
             self.total.move_selected(-self.delta)
         elif self.mode == 'duplicate':
             self.total.netlist = self.total.netlist[:self.dup_parts_index]
+            self.total.index_centers(self.dup_parts_index)
             self.total.selected = []
         elif self.mode == 'rotate':
             self.total.rotate_selected(-self.delta[0], self.delta[1], self.delta[2]) # Rotate Back
@@ -2840,7 +2618,7 @@ class MainScreen(object):
             self.status_bar.set_text(str(len(self.total.selected)))
             self.part_add_pieces.set_active(True)
             self.name = self.validate_part(self.piece_list[self.current_piece])
-            self.redisplay = 'redraw'
+            self.redisplay = 'update'
             self.glarea.queue_draw()
 
     def grab(self, widget = None):
@@ -2868,6 +2646,7 @@ class MainScreen(object):
             self.dup_parts_index = len(self.total.netlist)
             for index in self.total.selected:
                 self.total.netlist.append(copy.deepcopy(self.total.netlist[index]))
+            self.total.index_centers(self.dup_parts_index)
             self.total.selected = range(self.dup_parts_index, self.dup_parts_index + len(self.total.selected))
             self.beginx, self.beginy = self.glarea.get_pointer()
             self.last_time = 0
@@ -2884,7 +2663,9 @@ class MainScreen(object):
         winy = viewport[3] - viewport[1] - y
         pt_near = np.array(gluUnProject(x, winy, 0.0, model, projection, viewport))
         pt_far = np.array(gluUnProject(x, winy, 1.0, model, projection, viewport))            
-        nearest_part_index = np.argmin(self.distance3d(np.array(map(lambda x: x.center, self.total.netlist)), pt_near, pt_far))
+        nearest_part_index = self.pick(x, winy)
+        if nearest_part_index is None:
+            nearest_part_index = np.argmin(self.distance3d(self.total.centers, pt_near, pt_far))
         nearest_part = self.total.netlist[nearest_part_index]
 
         nearest_end_index = np.argmin(self.distance3d(np.array(map(lambda x: x[0], nearest_part.ends)), pt_near, pt_far))
@@ -2956,7 +2737,7 @@ class MainScreen(object):
         self.total.history_undo()
         self.name = self.validate_part(self.piece_list[self.current_piece])
 
-        self.redisplay = 'redraw'
+        self.redisplay = 'update'
         self.glarea.queue_draw()
     
     def redo(self, widget = None):
@@ -2967,7 +2748,7 @@ class MainScreen(object):
         self.total.history_redo()
         self.name = self.validate_part(self.piece_list[self.current_piece])
 
-        self.redisplay = 'redraw'
+        self.redisplay = 'update'
         self.glarea.queue_draw()
 
     def fix_model(self, widget = None):
@@ -2986,6 +2767,11 @@ class MainScreen(object):
         self.vup = self.start_vup
         #self.pixperunit = self.start_pixperunit
         self.set_pixperunit(self.start_pixperunit)
+        glcontext = gtk.gtkgl.widget_get_gl_context(self.glarea)
+        gldrawable = gtk.gtkgl.widget_get_gl_drawable(self.glarea)
+        if gldrawable.gl_begin(glcontext):
+            self.total.release()
+            gldrawable.gl_end()
         self.total = base_pieces.module()
         self.name = self.validate_part(self.piece_list[self.current_piece])
         self.current_filename = ''
@@ -2994,17 +2780,6 @@ class MainScreen(object):
         self.instructions_hold_pose.set_active(False)
         self.opengl_reshape(self.glarea, None)
 
-    def screen_capture(self):
-        """
-        Capture the screen for image storage
-        """
-        #while gtk.events_pending(): # didn't help on graphics acceleration redraw
-        #    gtk.main_iteration()
-        rawdata = self.total.screen_capture()
-        xlen, ylen = rawdata.shape
-        im = Image.fromstring('RGBA', (xlen, ylen), rawdata.tostring(), 'raw', 'RGBA', 0, -1)
-        return im
-
     def write_file(self, widget = None, saveas = True):
         """
         Write the module to a file
@@ -3026,6 +2801,7 @@ class MainScreen(object):
             filter = gtk.FileFilter()
             filter.set_name('Crossbeams Model')
             filter.add_pattern('*.cbm')
+            filter.add_pattern('*' + base_pieces.binary_extension)
             dialog.add_filter(filter)
 
             response = dialog.run()
@@ -3038,21 +2814,18 @@ class MainScreen(object):
                 self.project_directory = dialog.get_current_folder()
             dialog.destroy()
             base, ext = os.path.splitext(self.current_filename)
-            if (ext != '.jst') or (ext != '.cbm'):
+            if not base_pieces.is_binary(self.current_filename):
                 ext = '.cbm'
             self.current_filename = base + ext
             self.update_title()
-            fp = None
             try:
-                fp = open(self.current_filename, 'w')
+                self.total.write_file(self.current_filename)
             except IOError:
                 dialog2 = gtk.MessageDialog(self.win, 0, gtk.MESSAGE_WARNING, gtk.BUTTONS_OK, 'Can\'t write ' + self.current_filename + '.  Check directory existence, permissions, or disk space.')
                 dialog2.show_all()
                 response = dialog2.run()
                 dialog2.destroy()
-            if fp:
-                fp.write(self.total.write_netlist())
-                fp.close()
+            else:
                 self.status_bar.set_text('Write complete.  ' + str(self.total.total_inventory()) + ' pieces.')
 
         else:
@@ -3142,6 +2915,7 @@ class MainScreen(object):
             filter = gtk.FileFilter()
             filter.set_name('Crossbeams Model')
             filter.add_pattern('*.cbm')
+            filter.add_pattern('*' + base_pieces.binary_extension)
             dialog.add_filter(filter)
 
             filter = gtk.FileFilter()
@@ -3167,15 +2941,13 @@ class MainScreen(object):
                 if fp:
                     self.total.selected = []
                     select_start = len(self.total.netlist)
-                    module_add = base_pieces.module()
-                    module_add.read_netlist(fp.readlines())
                     fp.close()
-                    self.total.netlist = self.total.netlist + module_add.netlist
-                    self.total.ends = self.total.ends + module_add.ends
-                    self.total.ends_types = self.total.ends_types + module_add.ends_types
-                    self.total.merge_common()
+                    module_add = base_pieces.module()
+                    module_add.read_file(name)
+                    self.total.merge(module_add)
 
                     self.total.selected = range(select_start, select_start+len(module_add.netlist))
+                    self.warm_up()
 
             else:
                 dialog.destroy()
@@ -3194,6 +2966,7 @@ class MainScreen(object):
         filter = gtk.FileFilter()
         filter.set_name('Crossbeams Model')
         filter.add_pattern('*.cbm')
+        filter.add_pattern('*' + base_pieces.binary_extension)
         dialog.add_filter(filter)
 
         filter = gtk.FileFilter()
@@ -3225,11 +2998,13 @@ class MainScreen(object):
                 self.current_filename = name
                 self.project_directory = dir
                 self.update_title()
-                self.total.read_netlist(fp.readlines())
                 fp.close()
+                self.total.read_file(name)
                 if len(self.total.ends) > 0:
                     self.name = self.validate_part(self.piece_list[self.current_piece])
                 self.status_bar.set_text('Read complete.  ' + str(self.total.total_inventory()) + ' pieces.')
+                if self.glarea.flags() & gtk.REALIZED:
+                    self.warm_up()
                 self.glarea.queue_draw()
 
         else:
@@ -3454,6 +3229,22 @@ class MainScreen(object):
         # quit
         gtk.main_quit()
 
+    def pick(self, x, winy, ends = 0, unselectable = []):
+        """
+        Returns the index of the part (or open end if ends) drawn at
+        x, winy, or None if there's none or it can't be picked
+        """
+        glcontext = gtk.gtkgl.widget_get_gl_context(self.glarea)
+        gldrawable = gtk.gtkgl.widget_get_gl_drawable(self.glarea)
+        index = None
+        if gldrawable.gl_begin(glcontext):
+            if ends:
+                index = self.total.pick_end(x, winy)
+            else:
+                index = self.total.pick_part(x, winy, self.creationmode, unselectable)
+            gldrawable.gl_end()
+        return index
+
     def distance3d(self, pts, pt_near, pt_far):
         """
         Calculates the minimum distance from pt in pts to the line
@@ -3504,7 +3295,7 @@ class MainScreen(object):
                 self.name = self.validate_part(self.piece_list[self.current_piece])
                 self.mode = 'grab complete %.1fs' % (time2-time1)
                 self.status_bar.set_text(self.mode)
-                self.redisplay = 'redraw'
+                self.redisplay = 'update'
                 self.glarea.queue_draw()
                 self.mode = 'normal'
             else:
@@ -3515,8 +3306,9 @@ class MainScreen(object):
             if event.button == 1 and vector_math.mag(self.delta) > 0.1:
                 dup_parts = self.total.netlist[self.dup_parts_index:]
                 self.total.netlist = self.total.netlist[:self.dup_parts_index]
+                self.total.index_centers(self.dup_parts_index)
+                base_pieces.calc_parts_ends(dup_parts)
                 for dup_part in dup_parts:
-                    dup_part.calc_ends()
                     self.total.connect(dup_part, self.vout, self.vup, capture = 0)
                 self.name = self.validate_part(self.piece_list[self.current_piece])
                 self.mode = 'duplicate complete'
@@ -3536,7 +3328,7 @@ class MainScreen(object):
                 self.name = self.validate_part(self.piece_list[self.current_piece])
                 self.mode = 'rotate done %.1fs' % (time2-time1)
                 self.status_bar.set_text(self.mode)
-                self.redisplay = 'redraw'
+                self.redisplay = 'update'
                 self.glarea.queue_draw()
                 self.mode = 'normal'
             else:
@@ -3559,7 +3351,7 @@ class MainScreen(object):
                 self.name = self.validate_part(self.piece_list[self.current_piece])
                 self.mode = 'mirror complete %.1fs' % (time2 - time1)
                 self.status_bar.set_text(self.mode)
-                self.redisplay = 'redraw'
+                self.redisplay = 'update'
                 self.glarea.queue_draw()
                 self.mode = 'normal'
             else:
@@ -3577,7 +3369,9 @@ class MainScreen(object):
             if event.button == 1 and not (event.state & gtk.gdk.CONTROL_MASK): # Left or Primary Button
                 if self.creationmode == 'modelling':
                     if len(self.total.ends) > 0:
-                        nearest_end_index = np.argmin(self.distance3d(np.array(map(lambda x: x[0], self.total.ends)), pt_near, pt_far))
+                        nearest_end_index = self.pick(x, winy, ends = 1)
+                        if nearest_end_index is None:
+                            nearest_end_index = np.argmin(self.distance3d(self.total.end_tips, pt_near, pt_far))
                         self.total.port = nearest_end_index
                         msg = 'port at (' + reduce(lambda y, z: y + ', ' + z, map(lambda x: '%.1f' % x, (self.total.ends[self.total.port][0]/pieces.sf).tolist())) + ')'
                         self.status_bar.set_text(msg)
@@ -3638,12 +3432,17 @@ class MainScreen(object):
                     creation_selection_allowed = (self.total.frame >= self.total.instruction_start) and (self.total.submodel != -1) and (len(self.total.netlist) > len(unselectable))
 
                 if (len(self.total.netlist) > 0) and (self.creationmode == 'modelling' or creation_selection_allowed):
-                    nearest_part_indices = np.argsort(self.distance3d(np.array(map(lambda x: x.center, self.total.netlist)), pt_near, pt_far))
-                    count = 0
-                    if self.creationmode == 'instructions' or self.creationmode == 'group':
-                        while nearest_part_indices[count] in unselectable:
-                            count = count + 1
-                    netlist_index = nearest_part_indices[count]
+                    if self.creationmode == 'modelling':
+                        netlist_index = self.pick(x, winy)
+                    else:
+                        netlist_index = self.pick(x, winy, unselectable = unselectable)
+                    if netlist_index is None: # Nothing drawn there; use the nearest center
+                        nearest_part_indices = np.argsort(self.distance3d(self.total.centers, pt_near, pt_far))
+                        count = 0
+                        if self.creationmode == 'instructions' or self.creationmode == 'group':
+                            while nearest_part_indices[count] in unselectable:
+                                count = count + 1
+                        netlist_index = nearest_part_indices[count]
                     if multiple == 0:
                         self.total.selected = [netlist_index]
                     else:
@@ -3686,14 +3485,15 @@ class MainScreen(object):
             winy = viewport[3] - viewport[1] - y
             winbeginy = viewport[3] - viewport[1] - self.beginy
 
-            start_selection = self.total.selected[:]
-            for count, piece_index in enumerate(self.total.netlist):
-                px, py, pz = gluProject(piece_index.center[0], piece_index.center[1], piece_index.center[2], model, projection, viewport)
-                if self.beginx <= px <= x and winy <= py <= winbeginy:
-                    if count not in start_selection:
-                        unselectable = self.total.old_parts + self.total.hidden_parts
-                        if (self.creationmode == 'modelling') or (count not in unselectable):
-                            self.total.selected.append(count)
+            window = vector_math.project(self.total.centers, model, projection, viewport)
+            px = window[:,0]
+            py = window[:,1]
+            inside = (self.beginx <= px) & (px <= x) & (winy <= py) & (py <= winbeginy)
+            inside[np.array(self.total.selected, np.intp)] = False
+            if self.creationmode != 'modelling':
+                unselectable = self.total.old_parts + self.total.hidden_parts
+                inside[np.array(unselectable, np.intp)] = False
+            self.total.selected.extend(np.nonzero(inside)[0].tolist())
 
             self.mode = 'normal'
             self.status_bar.set_text(self.mode)
@@ -3715,7 +3515,7 @@ class MainScreen(object):
 
             pt_near = np.array(gluUnProject(x, winy, 0.0, model, projection, viewport))
             pt_far = np.array(gluUnProject(x, winy, 1.0, model, projection, viewport))
-            nearest_part_index = np.argmin(self.distance3d(np.array(map(lambda x: x.center, self.total.netlist)), pt_near, pt_far))
+            nearest_part_index = np.argmin(self.distance3d(self.total.centers, pt_near, pt_far))
             self.magnify_pos = [nearest_part_index] # Stays as len 1 until draw
             #center = self.total.netlist[nearest_part_index].center
             #snap_pos = gluProject(center[0], center[1], center[2], model, projection, viewport)
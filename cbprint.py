@@ -0,0 +1,338 @@
+#!/usr/bin/python
+
+"""
+Description
+-----------
+cbprint writes the pdf instructions of Crossbeams models without the
+GUI, so instructions can be made on machines without a display.
+
+usage: cbprint [-g] [-d] [-r] [-v] [-o output.pdf] file.cbm ...
+
+Models may be text (.cbm) or binary (.cbb).  Each model's
+instructions are written beside it, as file.pdf, or to output.pdf
+when one model is given.
+
+  -g  write the group instructions, as file_group.pdf
+  -d  draft: draw frames at screen rather than print resolution
+  -r  render pieces from their drawings, if installed
+  -v  print each frame as it's drawn
+
+Frames are drawn in a framebuffer object of an opengl context made
+through EGL, which needs no window system: Mesa's surfaceless
+platform, or else the default display.  reportlab must be installed.
+
+See cbmodel.py for a description of the package and its history.
+
+Author
+------
+Charles Sharman
+
+License
+-------
+Distributed under the GNU GENERAL PUBLIC LICENSE Version 3.  View
+LICENSE for details.
+"""
+
+import sys
+import os
+import copy
+import ctypes
+
+# PyOpenGL picks its platform on first import
+if 'PYOPENGL_PLATFORM' not in os.environ:
+    os.environ['PYOPENGL_PLATFORM'] = 'egl'
+
+share_directory = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../share/cbmodel/'))
+if not os.path.exists(share_directory):
+    share_directory = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(share_directory)
+
+from OpenGL import EGL
+from OpenGL.GL import *
+from OpenGL.error import GLError
+
+import numpy as np
+
+import base_pieces
+import pieces
+import instructions
+
+EGL_PLATFORM_SURFACELESS_MESA = 0x31DD # EGL_MESA_platform_surfaceless
+
+def egl_context():
+    """
+    Makes an opengl context with no window and makes it current.
+    Returns (display, context), or None if EGL can't.
+    """
+    displays = []
+    try:
+        from OpenGL.EGL.EXT.platform_base import eglGetPlatformDisplayEXT
+        if eglGetPlatformDisplayEXT:
+            displays.append(lambda: eglGetPlatformDisplayEXT(EGL_PLATFORM_SURFACELESS_MESA, None, None))
+    except ImportError:
+        pass
+    displays.append(lambda: EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY))
+
+    attributes = (EGL.EGLint*3)(EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT, EGL.EGL_NONE)
+    for get_display in displays:
+        try:
+            display = get_display()
+            if not display:
+                continue
+            major, minor = EGL.EGLint(), EGL.EGLint()
+            if not EGL.eglInitialize(display, ctypes.pointer(major), ctypes.pointer(minor)):
+                continue
+            config = EGL.EGLConfig() # No config, if none fits (EGL_KHR_no_config_context)
+            count = EGL.EGLint()
+            EGL.eglChooseConfig(display, attributes, ctypes.pointer(config), 1, ctypes.pointer(count))
+            if count.value < 1:
+                config = EGL.EGLConfig()
+            if not EGL.eglBindAPI(EGL.EGL_OPENGL_API):
+                continue
+            context = EGL.eglCreateContext(display, config, EGL.EGL_NO_CONTEXT, None)
+            if not context:
+                continue
+            if EGL.eglMakeCurrent(display, EGL.EGL_NO_SURFACE, EGL.EGL_NO_SURFACE, context):
+                return display, context
+        except GLError: # EGLError; its message can't always be printed
+            pass
+    return None
+
+class status(object):
+    """
+    Stands in for cbmodel's status bar
+    """
+
+    def __init__(self, verbose = 0):
+        self.verbose = verbose
+
+    def set_text(self, text):
+        if self.verbose:
+            print text
+
+class PrintScreen(instructions.Screen):
+    """
+    Draws instruction frames offscreen, into a framebuffer object the
+    size of the frame, for instructions.generate_instructions
+    """
+
+    def __init__(self, verbose = 0):
+        self.share_directory = share_directory
+        self.status_bar = status(verbose)
+        self.background_color = self.SCREEN_COLOR[0]
+        self.annotate_color = self.SCREEN_COLOR[1]
+        self.highlight_color = self.SCREEN_COLOR[2]
+        base_pieces.colors = self.PIECE_COLORS
+        pieces.colors = self.PIECE_COLORS
+        self.annotate = instructions.Annotate(self, share_directory)
+        self.make_aliases()
+
+        self.total = base_pieces.module()
+        self.creationmode = 'modelling'
+        self.image_type = 'screen'
+        self.omit_logo = 0
+        self.ps_scale = 3
+        self.set_pixperunit(10.0)
+        self.vcenter = np.array([0.0, 0.0, 0.0])
+        self.vout = np.array([0.0, 0.0, 1.0])
+        self.vup = np.array([0.0, 1.0, 0.0])
+        self.winsize = 'full'
+        self.start_group = 0
+        self.mirror_pos = ()
+        self.magnify_pos = ()
+        self.part_labels = []
+
+        self.fbo = 0
+        self.renderbuffers = []
+        self.size = None # (width, height) of self.fbo
+        self.allocate(1, 1)
+        self.init_gl()
+        self.reshape(1, 1)
+
+    def allocate(self, width, height):
+        """
+        Makes a width x height framebuffer object to draw frames in,
+        with a depth buffer the module's framebuffer objects can blit
+        """
+        if self.fbo:
+            glDeleteFramebuffers(1, [self.fbo])
+            glDeleteRenderbuffers(len(self.renderbuffers), self.renderbuffers)
+        self.fbo = glGenFramebuffers(1)
+        self.renderbuffers = glGenRenderbuffers(2)
+        glBindFramebuffer(GL_FRAMEBUFFER, self.fbo)
+        for renderbuffer, internal_format, attachment in zip(self.renderbuffers,
+                                                             (GL_RGBA8, GL_DEPTH24_STENCIL8),
+                                                             (GL_COLOR_ATTACHMENT0, GL_DEPTH_STENCIL_ATTACHMENT)):
+            glBindRenderbuffer(GL_RENDERBUFFER, renderbuffer)
+            glRenderbufferStorage(GL_RENDERBUFFER, internal_format, width, height)
+            glFramebufferRenderbuffer(GL_FRAMEBUFFER, attachment, GL_RENDERBUFFER, renderbuffer)
+        glBindRenderbuffer(GL_RENDERBUFFER, 0)
+        if glCheckFramebufferStatus(GL_FRAMEBUFFER) != GL_FRAMEBUFFER_COMPLETE:
+            raise GLError(err = 0, description = 'incomplete offscreen framebuffer')
+        glDrawBuffer(GL_COLOR_ATTACHMENT0)
+        glReadBuffer(GL_COLOR_ATTACHMENT0)
+        base_pieces.window_fbo = self.fbo
+        base_pieces.window_buffer = GL_COLOR_ATTACHMENT0
+        self.size = (width, height)
+
+    def window_size(self, widget, size):
+        """
+        Sets the offscreen size to size and draws the frame
+        """
+        if not size:
+            size = self.SCR[:]
+        x = int(self.ps_scale*size[0])
+        y = int(self.ps_scale*size[1])
+        if self.size != (x, y):
+            self.allocate(x, y)
+        self.reshape(x, y)
+        self.draw()
+
+    def window_color(self, widget, color, redraw = 1):
+        """
+        Sets the offscreen colors to a given color
+        """
+        glClearColor(color[0][0], color[0][1], color[0][2], 0.0)
+        self.background_color = color[0]
+        self.annotate_color = color[1]
+        self.highlight_color = color[2]
+
+    def draw(self):
+        """
+        Draws the module like cbmodel's opengl_draw.  Annotating the
+        screen needs pango fonts, so only print frames are annotated.
+        """
+        model, projection, viewport = self.look()
+
+        pieces.default_material()
+
+        self.total.redraw(self.vout, self.vup, self.creationmode)
+
+        if self.image_type == 'print' and (self.creationmode == 'instructions' or self.creationmode == 'group'):
+            self.annotate_frame(model, projection, viewport)
+        glFinish()
+
+    def toggle_frame(self, widget = None, next = 1, save_current = 1):
+        """
+        Moves to the previous or next frame in instructions mode.
+        Frames aren't edited offscreen, so there's nothing to save.
+        """
+        if self.creationmode == 'instructions' or self.creationmode == 'group':
+            self.load_frame(next)
+
+    def read_file(self, filename, mode = 'instructions'):
+        """
+        Reads a module from filename and enters mode ('instructions'
+        or 'group') at the title page.  Returns the number of frames.
+        """
+        self.total = base_pieces.module()
+        self.total.load_file(filename)
+        self.total.selected = []
+        self.total.group_index = -1
+        self.creationmode = mode
+        if mode == 'group':
+            self.total.instructions = self.total.group_instructions
+            if len(self.total.instructions) <= 0 and len(self.total.individual_instructions) > 0:
+                self.total.instructions = copy.deepcopy(self.total.individual_instructions[:1]) # Copy the title page if group_instructions are empty
+        else:
+            self.total.instructions = self.total.individual_instructions
+        if len(self.total.instructions) > 0:
+            self.total.generate_instruction_start()
+            self.total.frame = 0
+            self.annotate.set_type('screen')
+            self.total.find_regions()
+            self.toggle_frame(None, 0, 0)
+            if self.total.hold_pose:
+                self.total.hold_pose_matrices()
+                self.total.pose_centers()
+        return len(self.total.instructions)
+
+    def generate_instructions(self, filename, scale=1.0, pages=['front', 'joining', 'frames', 'combined', 'back'], custom_inventory={}):
+        """
+        Generates an instruction set, like cbmodel's
+        generate_instructions
+        """
+        save_draw_outline = base_pieces.draw_outline
+        base_pieces.draw_outline = 1
+        save_color_scheme = (self.background_color, self.annotate_color, self.highlight_color)
+        base_pieces.draw_future_parts = 0
+        self.image_type = 'print'
+        base_pieces.generate_pdf = 1
+        base_pieces.dim_scale = self.ps_scale
+
+        try:
+            instructions.generate_instructions(self, share_directory, filename, scale, pages, custom_inventory)
+        finally:
+            base_pieces.draw_future_parts = 1
+            self.image_type = 'screen'
+            base_pieces.generate_pdf = 0
+            base_pieces.dim_scale = 1.0
+            self.window_color(None, save_color_scheme)
+            base_pieces.draw_outline = save_draw_outline
+
+if __name__ == '__main__':
+    usage = 'usage: cbprint [-g] [-d] [-r] [-v] [-o output.pdf] file.cbm ...'
+    args = sys.argv[1:]
+    mode = 'instructions'
+    ps_scale = 3
+    detail = 1
+    verbose = 0
+    output = None
+    while len(args) > 0 and args[0].startswith('-'):
+        if args[0] == '-g':
+            mode = 'group'
+        elif args[0] == '-d':
+            ps_scale = 1
+        elif args[0] == '-r':
+            detail = 2
+        elif args[0] == '-v':
+            verbose = 1
+        elif args[0] == '-o' and len(args) > 1:
+            output = args[1]
+            args = args[1:]
+        else:
+            print usage
+            sys.exit(1)
+        args = args[1:]
+    if len(args) == 0 or (output and len(args) > 1):
+        print usage
+        sys.exit(1)
+
+    if not instructions.pdfcanvas:
+        sys.stderr.write('cbprint: reportlab is needed to write pdf instructions\n')
+        sys.exit(1)
+    if not egl_context():
+        sys.stderr.write('cbprint: can\'t make an offscreen opengl context through EGL\n')
+        sys.exit(1)
+
+    pieces.init(share_directory)
+    if detail > 1 and not os.path.exists(os.path.join(share_directory, 'ogl_drawings/')):
+        sys.stderr.write('cbprint: no drawings installed, drawing solid pieces\n')
+        detail = 1
+    pieces.detail = detail
+    screen = PrintScreen(verbose)
+    screen.ps_scale = ps_scale
+    errors = 0
+    for filename in args:
+        try:
+            frames = screen.read_file(filename, mode)
+        except (IOError, IndexError, ValueError, SyntaxError), error:
+            sys.stderr.write('cbprint: can\'t read ' + filename + ': ' + str(error) + '\n')
+            errors = errors + 1
+            continue
+        if frames <= 0:
+            sys.stderr.write('cbprint: ' + filename + ' has no ' + mode + '\n')
+            errors = errors + 1
+            continue
+        if output:
+            pdf_name = output
+        else:
+            base, ext = os.path.splitext(filename)
+            if mode == 'group':
+                pdf_name = base + '_group.pdf'
+            else:
+                pdf_name = base + '.pdf'
+        screen.generate_instructions(pdf_name)
+        print pdf_name
+    if errors:
+        sys.exit(1)
@@ -4,7 +4,7 @@
 Description
 -----------
 Crossbeams Modeller pdf instructions generator.  Heavily integrated
-with the MainScreen class of cbmodel.
+with the MainScreen class of cbmodel, which builds on Screen here.
 
 See cbmodel.py for a description of the package and its history.
 
@@ -23,6 +23,7 @@ import math
 import numpy as np
 
 from OpenGL.GL import *
+from OpenGL.GLE import *
 from OpenGL.GLU import *
 
 import PIL.Image as Image
@@ -30,6 +31,8 @@ import PIL.ImageDraw as ImageDraw
 import PIL.ImageChops as ImageChops
 
 import vector_math
+import base_pieces
+import pieces
 
 try:
     import reportlab.pdfgen.canvas as pdfcanvas
@@ -48,6 +51,66 @@ def warning(num_pieces):
         warning = 'WARNING: Small parts.  Age 16+.  Not a toy.  Handle responsibly.  U.S. Patent 9,086,087.'
     return warning
 
+# (name, alias, simple name) of the pieces sold under another name
+piece_aliases = [('anglep5xp5', 'angle1x1', '1x1'),
+                 ('angle1xp5', 'angle2x1', '2x1'),
+                 ('angle1x1', 'angle2x2', '2x2'),
+                 ('angle1p5x1p5', 'angle3x3', '3x3'),
+                 ('angle2x1', 'angle4x2', '4x2'),
+                 ('angle2x2', 'angle4x4', '4x4'),
+                 ('arc1x1', 'arc2x2', '2x2'),
+                 ('arc1p5x1p5', 'arc3x3', '3x3'),
+                 ('arc2x1', 'arc4x2', '4x2'),
+                 ('arc2x2', 'arc4x4', '4x4'),
+                 ('gear_axle1s', 'axle_g1', 'g1'),
+                 ('gear_axle2s', 'axle_g2', 'g2'),
+                 ('gear1', 'gear1', '1'),
+                 ('gear3s', 'gear3s', '3s'),
+                 ('gear3l', 'gear3l', '3l'),
+                 ('gear_bevel', 'gear_b', 'b'),
+                 ('gear_rack', 'rack', 'rack'),
+                 ('gear_rack_spur', 'gear_r', 'r'),
+                 ('join1', 'join1', '1'),
+                 ('join2', 'join2', '2'),
+                 ('join2flat', 'join2f', '2f'),
+                 ('join3', 'join3', '3'),
+                 ('join3flat', 'join3f', '3f'),
+                 ('join4', 'join4', '4'),
+                 ('join4flat', 'join4f', '4f'),
+                 ('join5', 'join5', '5'),
+                 ('join6', 'join6', '6'),
+                 ('joinrot11', 'rotate2s', '2s'),
+                 ('joinrot12', 'rotate3fd', '3fd'),
+                 ('joinrot21', 'rotate3s', '3s'),
+                 ('joinrot22', 'rotate4d', '4d'),
+                 ('joinrot2flat1', 'rotate3fs', '3fs'),
+                 ('joinrot2flat2', 'rotate4fd', '4fd'),
+                 ('joinrot3flat1', 'rotate4s', '4s'),
+                 ('joinrot3flat2', 'rotate5d', '5d'),
+                 ('joinrot4flat1', 'rotate5s', '5s'),
+                 ('joinrot4flat2', 'rotate6d', '6d'),
+                 ('pivotm1', 'couple2s', '2s'),
+                 ('pivot', 'couple22', '22'),
+                 ('pivot111', 'couple222', '222'),
+                 ('pivot00', 'couple11', '11'), 
+                 ('pivot01', 'couple12', '12'),
+                 ('pivot0m1', 'couple1s', '1s'),
+                 ('pivotm1m1', 'coupless', 'ss'),
+                 ('pivot0', 'couple211', '211'),
+                 ('pivot0_', 'couple1', '1'),
+                 ('straightp5', 'straight1', '1'),
+                 ('straight1m1', 'axle_s', 's'),
+                 ('straight1', 'straight2', '2'),
+                 ('straight1p5', 'straight3', '3'),
+                 ('straight2', 'straight4', '4'),
+                 ('wheel_axle1s1w', 'axle_w1', 'w1'),
+                 ('wheel_axle2s2w', 'axle_w2', 'w2'),
+                 ('wheel_axle1s3w', 'axle_w3', 'w3'),
+                 ('wheelp5', 'wheel1', '1'),
+                 ('wheel1', 'wheel2', '2'),
+                 ('coupler', 'couple', 'couple'),
+                 ('stiffen', 'stiff', 'stiff')]
+
 # Routines that may be useful as imports are placed here
 
 def color255(color):
@@ -669,7 +732,7 @@ def generate_instructions(screen, share_directory, filename, scale=1.0, pages=['
             frame_index = frame_index + len(layout)
             layout_index = layout_index + 1
 
-    screen.glarea.window.set_cursor(screen.WAIT_CURSOR)
+    screen.wait_cursor(1)
 
     #pdfmetrics.registerFont(ttfonts.TTFont('Trebuchet_MS_Bold', '/usr/share/fonts/truetype/msttcorefonts/Trebuchet_MS_Bold.ttf'))
     #pdfmetrics.registerFont(ttfonts.TTFont('Trebuchet_MS', '/usr/share/fonts/truetype/msttcorefonts/Trebuchet_MS.ttf'))
@@ -874,7 +937,7 @@ def generate_instructions(screen, share_directory, filename, scale=1.0, pages=['
     pdf.save()
     screen.annotate.set_type('screen')
 
-    screen.glarea.window.set_cursor(screen.REGULAR_CURSOR)
+    screen.wait_cursor(0)
     screen.status_bar.set_text('Instructions done')
 
 class Annotate(object):
@@ -1395,3 +1458,383 @@ class Annotate(object):
                               position[1] + height - self.screen.MARGIN_SIZE),
                              insets)
         glEnable(GL_LIGHTING)
+
+class Screen(object):
+    """
+    What instructions need from a screen, apart from its window.
+    cbmodel's MainScreen adds the window and modelling; cbprint's
+    PrintScreen draws offscreen.
+    """
+
+    # Colors
+    #SCREEN_COLOR = ((0.0, 0.0, 0.0), (1.0, 0.25, 0.25)) # BG, FG
+    #PRINT_COLOR = ((1.0, 1.0, 1.0), (0.75, 0.0, 0.0)) # BG, FG
+    #SCREEN_COLOR = ((0.0, 0.0, 0.0), (0.871, 0.504, 0.055)) # BG, FG
+    #PRINT_COLOR = ((1.0, 1.0, 1.0), (0.871, 0.504, 0.055)) # BG, FG
+    #SCREEN_COLOR = ((0.0, 0.0, 0.0), (0.875, 0.549, 0.098)) # BG, FG
+    #PRINT_COLOR = ((1.0, 1.0, 1.0), (0.875, 0.549, 0.098)) # BG, FG
+
+    SCREEN_COLOR = ((0.0, 0.0, 0.0), (1.0, 1.0, 1.0), (1.0, 0.8, 0.0)) # BG, FG, Highlights
+    #PRINT_COVER_COLOR = ((0.0, 0.0, 0.0), (1.0, 1.0, 1.0), (1.0, 0.8, 0.0)) # BG, FG, Highlights
+    PRINT_COVER_COLOR = ((1.0, 1.0, 1.0), (0.0, 0.0, 0.0), (1.0, 0.8, 0.0)) # BG, FG, Highlights
+    #PRINT_BODY_COLOR = ((0.828, 0.879, 0.938), (0.875, 0.549, 0.098)) # BG, FG
+    PRINT_BODY_COLOR = ((1.0, 1.0, 1.0), (0.0, 0.0, 0.0), (1.0, 0.8, 0.0)) # BG, FG, Highlights
+
+    PIECE_COLORS = {'total': (1.0, 1.0, 1.0),
+                    'straight': (1.0, 1.0, 1.0),
+                    'angle': (1.0, 1.0, 1.0),
+                    'arc': (1.0, 1.0, 1.0),
+                    'part': (0.0, 1.0, 0.0),
+                    'edit': (0.45, 0.675, 0.9),
+                    'outline': (0.0, 0.0, 0.0),
+                    'newpart': (0.45, 0.675, 0.9),
+                    'futurepart': (0.33, 0.33, 0.33),
+                    'tire': (0.33, 0.33, 0.33),
+                    'wheel': (1.0, 1.0, 1.0),
+                    'clip': (1.0, 1.0, 1.0),
+                    'gear': (1.0, 1.0, 1.0),
+                    'shaft': (0.5, 0.5, 0.5),
+                    'region0': (1.0, 0.5, 0.5),
+                    'region1': (0.5, 1.0, 0.5),
+                    'region2': (0.5, 0.5, 1.0),
+                    'region3': (0.8, 0.8, 0.4),
+                    'region4': (0.8, 0.4, 0.8),
+                    'region5': (0.4, 0.8, 0.8)}
+
+    # Sizes/Scales
+    SCREEN_SCALE = 100
+    PS_SCALE = 3.0 # Print to Screen Scale DPI = PS_SCALE*SCREEN_SCALE
+    IMAGE_SCALE = 300/(PS_SCALE*SCREEN_SCALE) # Image to Print Scale
+    PAPER_SIZE = (8.5, 11.0) # inches
+    #PAPER_SIZE = (9.06, 11.0) # scaled for 8.5x14 booklet printouts
+    MARGIN_SIZE = 0.125 # inches
+    SEP_SIZE = 0.05 # Internal separation between frames
+    FRAME_MARGIN_SIZE = 0.075 # inches
+    COVER_SIZE = (PAPER_SIZE[0]-2*MARGIN_SIZE, PAPER_SIZE[1]-2*MARGIN_SIZE)
+    FRAME_SIZE = ((PAPER_SIZE[0]-2*MARGIN_SIZE-SEP_SIZE)/2, (PAPER_SIZE[1]-2*MARGIN_SIZE-SEP_SIZE)/2)
+
+    def make_aliases(self):
+        """
+        Makes the piece list, sorted by alias, and the alias lookups
+        """
+        self.piece_list = filter(lambda x: type(eval('pieces.' + x)) == type(pieces.stick) and issubclass(eval('pieces.' + x), pieces.stick), dir(pieces))
+        self.piece_list.remove('stick')
+        self.piece_list.remove('axle')
+        self.name2alias = {}
+        self.alias2name = {}
+        self.name2simple = {}
+        for name in self.piece_list:
+            self.name2alias[name] = name
+            self.alias2name[name] = name
+            self.name2simple[name] = name
+        for name, alias, simple in piece_aliases:
+            self.name2alias[name] = alias
+            self.alias2name[alias] = name
+            self.name2simple[name] = simple
+        pieces.aliases = self.name2alias
+        local_alias = map(lambda x: (self.name2alias[x], x), self.piece_list)
+        local_alias.sort()
+        self.piece_list = map(lambda x: x[1], local_alias)
+
+    def set_pixperunit(self, value):
+        self.pixperunit = value
+        base_pieces.pixperunit = value
+
+    def wait_cursor(self, wait = 1):
+        """
+        Shows work is (wait = 1) or isn't underway.  Without a window,
+        there's nothing to show.
+        """
+        pass
+
+    def make_image(self, name, filename=None):
+        """
+        Creates an image from file and puts it into the self.images dictionary
+        """
+        if not filename:
+            filename = name
+        fullname = os.path.join(self.share_directory, filename + '.png')
+        try:
+            im = Image.open(fullname)
+        except IOError:
+            self.status_bar.set_text('Warning: Can\'t find ' + fullname)
+            retval = None
+        if im:
+            xsize, ysize = im.size
+            im_print = im.resize((int(xsize/self.IMAGE_SCALE), int(ysize/self.IMAGE_SCALE)), Image.BILINEAR)
+            im_screen = im.resize((int(xsize/(self.PS_SCALE*self.IMAGE_SCALE)), int(ysize/(self.PS_SCALE*self.IMAGE_SCALE))), Image.BILINEAR)
+            retval = {'im_print': im_print,
+                      'im_screen': im_screen}
+        return retval
+
+    def alias_inventory(self, indices = None):
+        """
+        Converts a piece inventory to the known (alias) names
+        """
+        inventory = self.total.inventory(indices)
+        ainv = []
+        for quantity, name in inventory:
+            ainv.append((self.name2alias[name], quantity))
+        ainv.sort()
+        return ainv
+
+    def init_gl(self):
+        """
+        Sets the opengl state the module is drawn with
+        """
+        glClearDepth(1.0)
+        glEnable(GL_DEPTH_TEST)
+        glClearColor(self.background_color[0], self.background_color[1], self.background_color[2], 0.0) 
+
+        glShadeModel(GL_SMOOTH)
+
+        # lighting
+        # Default Lighting Good Enough
+        glLightfv(GL_LIGHT0, GL_POSITION, (0.0, 0.0, 1.0, 0.0)) # infinite
+        glLightfv(GL_LIGHT0, GL_DIFFUSE, (1.0, 1.0, 1.0, 1.0))
+        #glLightfv(GL_LIGHT0, GL_AMBIENT, (0.0, 0.0, 0.0, 1.0))
+        glLightfv(GL_LIGHT0, GL_SPECULAR, (1.0, 1.0, 1.0, 1.0))
+
+        # Brighter white
+        glLightfv(GL_LIGHT0, GL_AMBIENT, (0.5, 0.5, 0.5, 1.0))
+
+        glEnable(GL_LIGHT0)
+        glEnable(GL_LIGHTING)
+        glColorMaterial(GL_FRONT, GL_DIFFUSE)
+        glEnable(GL_COLOR_MATERIAL) # before
+        #glDisable(GL_COLOR_MATERIAL) # allows specification of material
+
+        glLoadIdentity()
+        gleSetJoinStyle(TUBE_NORM_EDGE | TUBE_JN_ROUND | TUBE_JN_CAP | TUBE_CONTOUR_CLOSED)
+        #gleSetNumSides(32)
+
+        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+        glDisable(GL_LINE_SMOOTH)
+        glLineWidth(2.0)
+
+    def reshape(self, w, h):
+        """
+        Sets the opengl viewport and projection for a w x h screen
+        """
+        self.SCR = (w, h)
+        #print 'SCR', self.SCR
+
+        glViewport(0, 0, w, h)
+        ppu = self.ps_scale*self.pixperunit
+        #if self.image_type == 'print':
+        #    ppu = self.ps_scale*self.pixperunit
+        #else:
+        #    ppu = self.pixperunit
+        x = 0.5*float(w)/ppu
+        y = 0.5*float(h)/ppu
+        #print 'New Dimensions: (' + repr(x) + ', ' + repr(y) + ')', self.ps_scale
+        glMatrixMode(GL_PROJECTION)
+        glLoadIdentity()
+        #glFrustum(-x, x, -y, y, 50.0, 400.0)
+        glOrtho(-x, x, -y, y, -400.0, 400.0)
+        base_pieces.depth_scale = 1.0/800.0 # determined by glOrtho
+        glMatrixMode(GL_MODELVIEW)
+        self.lowerleft = (x, y)
+        self.mpan = max(w, h) / 10.0
+
+    def look(self):
+        """
+        Looks at vcenter from vout.  Returns the model matrix,
+        projection matrix, and viewport.
+        """
+        glLoadIdentity()
+        veye = self.vcenter + self.vout
+        gluLookAt(veye[0], veye[1], veye[2], \
+        self.vcenter[0], self.vcenter[1], self.vcenter[2], \
+        self.vup[0], self.vup[1], self.vup[2]) # reference point currently fixed
+        model = glGetDoublev(GL_MODELVIEW_MATRIX)
+        projection = glGetDoublev(GL_PROJECTION_MATRIX)
+        viewport = glGetIntegerv(GL_VIEWPORT)
+        return model, projection, viewport
+
+    def annotate_frame(self, model, projection, viewport):
+        """
+        Labels the selected parts and annotates an instructions frame
+        """
+        self.part_labels = []
+        for part_index in self.total.selected:
+            part = self.total.netlist[part_index]
+            center = self.total.centers[part_index]
+            p = [gluProject(center[0], center[1], center[2], model, projection, viewport), part.label(), part.help_text(), part.inset_files()]
+            self.part_labels.append(p)
+        self.annotate.annotate_opengl()
+        # Restore the Raster Position
+        p = np.array(gluUnProject(0.001, 0.001, 0.001, model, projection, viewport)) # 0.0 for x/y/z sometimes caused clipping
+        glRasterPos3fv(p)
+
+    def window_size_full(self, widget = None):
+        """
+        Sets the opengl screen size to COVER_SIZE
+        """
+        self.winsize = 'full'
+        self.window_size(widget, (int(self.COVER_SIZE[0]*self.SCREEN_SCALE), int(self.COVER_SIZE[1]*self.SCREEN_SCALE)))
+
+    def window_size_fullr(self, widget = None):
+        """
+        Sets the opengl screen size to COVER_SIZE rotate 90 degrees
+        """
+        self.winsize = 'fullr'
+        self.window_size(widget, (int(self.COVER_SIZE[1]*self.SCREEN_SCALE), int(self.COVER_SIZE[0]*self.SCREEN_SCALE)))
+
+    def window_size_quarter(self, widget = None):
+        """
+        Sets the opengl screen size to a quarter of COVER_SIZE
+        """
+        self.winsize = 'quarter'
+        self.window_size(widget, (int(self.FRAME_SIZE[0]*self.SCREEN_SCALE), int(self.FRAME_SIZE[1]*self.SCREEN_SCALE)))
+
+    def window_size_halfh(self, widget = None):
+        """
+        Sets the opengl screen size to half a COVER_SIZE
+        """
+        self.winsize = 'halfh'
+        self.window_size(widget, (int(self.COVER_SIZE[0]*self.SCREEN_SCALE), int(self.FRAME_SIZE[1]*self.SCREEN_SCALE)))
+
+    def set_marks(self, mirror_pos, magnify_pos):
+        """
+        Shows the mirror and cross hair icons at mirror_pos and
+        magnify_pos, () hiding them
+        """
+        self.mirror_pos = mirror_pos
+        self.magnify_pos = magnify_pos
+
+    def load_frame(self, next = 1):
+        """
+        Moves next frames in instructions mode and loads the new
+        frame, sizing the screen to it
+        """
+        # Change Frame
+        self.total.frame = max(0, self.total.frame + next)
+
+        # Create old_parts
+        old_parts = []
+        for frame_index in range(self.total.instruction_start, self.total.frame):
+            old_parts = old_parts + self.total.instructions[frame_index]['new_parts']
+        self.total.old_parts = old_parts
+
+        # Load New Frame
+        if self.total.frame < len(self.total.instructions):
+            inst = self.total.instructions[self.total.frame]
+            self.vcenter = inst['vcenter']
+            self.vout = inst['vout']
+            self.vup = inst['vup']
+            #self.pixperunit = inst['pixperunit']
+            self.set_pixperunit(inst['pixperunit'])
+            self.total.selected = inst['new_parts']
+            winsize = inst['size']
+            if inst.has_key('submodel'):
+                self.total.submodel = inst['submodel']
+            else:
+                self.total.submodel = 0
+            self.set_marks(inst.get('show_mirror', ()), inst.get('show_magnify', ()))
+            if inst.has_key('fixed'):
+                fixed = min(max(0, inst['fixed']), len(self.total.regions)-1) # Must handle a change from last time
+                self.total.set_region_fixed(fixed)
+            if inst.has_key('rotates'):
+                delta = len(self.total.region_rotates) - len(inst['rotates']) # Must handle a change from last time
+                if delta <= 0:
+                    self.total.region_rotates = inst['rotates'][:len(self.total.region_rotates)]
+                else:
+                    self.total.region_rotates = inst['rotates'] + [0]*delta
+            if inst.has_key('group'):
+                self.start_group = 1
+            else:
+                self.start_group = 0
+
+        else: # Anything that should be reset per frame goes here
+            if self.total.frame == 0:
+                winsize = 'full'
+            else:
+                winsize = self.winsize
+            self.total.selected = []
+            self.total.submodel = 0
+            self.set_marks((), ())
+            self.start_group = 0
+
+        # Create submodel_stack
+        self.total.generate_submodel_stack()
+
+        if self.creationmode == 'group':
+            self.total.generate_groups()
+            group_index = self.total.calc_group_index()
+            prefix = 'Group ' + str(group_index+1) + ' '
+            #print self.total.group_pieces
+            suffix = str(self.total.total_inventory(self.total.group_pieces[group_index]))
+        else:
+            prefix = ''
+            suffix = ''
+
+        if winsize == 'full':
+            self.window_size_full()
+        elif winsize == 'fullr':
+            self.window_size_fullr()
+        elif winsize == 'quarter':
+            self.window_size_quarter()
+        elif winsize == 'halfh':
+            self.window_size_halfh()
+        else:
+            self.window_size(None, (1, 1))
+
+        if self.total.frame == 0:
+            self.status_bar.set_text(prefix + 'Title Page')
+        elif self.total.frame < self.total.instruction_start:
+            self.status_bar.set_text(prefix + 'Pose ' + str(self.total.frame))
+        else:
+            self.status_bar.set_text(prefix + 'Frame ' + str(self.total.frame - self.total.instruction_start + 1) + ' ' + suffix)
+
+    def page_layouts(self):
+        """
+        Returns the page layout of each page in the instruction set as
+        a list.  Excludes front and back covers.  len(page_layouts())+2
+        returns the number of pages.
+        """
+        sizes = reduce(lambda x, y: x + y,
+                       map(lambda z: z['size'][0],
+                           self.total.instructions))
+        if self.creationmode == 'group':
+            last_frame = len(self.total.instructions) - 1
+            local_sizes = [sizes[:self.total.instruction_start]]
+            groups = self.total.groups + [last_frame+1]
+            for group_index in range(len(groups)-1):
+                start_index = groups[group_index]
+                end_index = groups[group_index+1]
+                local_sizes.append(sizes[start_index:end_index])
+        else:
+            local_sizes = [sizes[:self.total.instruction_start],
+                           sizes[self.total.instruction_start:]]
+        #print 'local_sizes', local_sizes
+        frame_index = 1
+        retval = []
+        for sizes in local_sizes:
+            while frame_index < len(sizes):
+                layouts = ['f', 'qqqq', 'qqh', 'hqq', 'hh', 'qh', 'qqq', 'hq',
+                           'qq', 'q', 'h']
+                for layout in layouts:
+                    if sizes[frame_index:frame_index+len(layout)] == layout:
+                        frame_index = frame_index + len(layout)
+                        retval.append(layout)
+                        break
+            frame_index = 0
+
+        return retval
+
+    def page_count(self):
+        """
+        Returns the number of pages in the instruction set including
+        front and back cover.
+        """
+        return len(self.page_layouts()) + 2
+
+    def screen_capture(self):
+        """
+        Capture the screen for image storage
+        """
+        rawdata = self.total.screen_capture()
+        xlen, ylen = rawdata.shape
+        im = Image.fromstring('RGBA', (xlen, ylen), rawdata.tostring(), 'raw', 'RGBA', 0, -1)
+        return im
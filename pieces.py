@@ -57,6 +57,9 @@ share_directory = ''
 #detail0_gllists = {} # Seemed to be no benefit in calllist for lines
 detail1_gllists = {}
 detail2_gllists = {}
+detail2_buffers = {} # name: (vertex buffer object, vertex count)
+list_drawings = 0 # 0/1 set while drawing what a display list will call
+proxy_gllists = {} # detail 0, for parts small on the screen
 
 aliases = {}
 masses = {}
@@ -165,170 +168,173 @@ def default_material():
     #glMaterialfv(GL_FRONT, GL_SPECULAR, (1.0, 1.0, 1.0, 1.0))
     #glMaterialfv(GL_FRONT, GL_SHININESS, 32)
 
-def exec_raw(name):
+def read_raw(name):
     """
-    Read in a triangular representation of a piece for rendering.
-    Used a home-grown format which was much faster than stl or ogl.gz
-    reading.
+    Returns the (N,6) float32 normal and vertex of each triangle corner
+    in a drawing, ready for glInterleavedArrays(GL_N3F_V3F).  Used a
+    home-grown format which was much faster than stl or ogl.gz
+    reading: each triangle is its normal then its three vertices.  The
+    file is memory mapped and each value copied once, into place.
     """
     full_name = os.path.join(share_directory, 'ogl_drawings', name + '.raw')
     try:
-        rawdata = np.fromfile(full_name, np.float32)
+        rawdata = np.memmap(full_name, np.float32, 'r')
     except IOError:
         print 'Couldn\'t find', full_name
         sys.exit()
-    rawdata = np.reshape(rawdata, (len(rawdata)/3, 3))
-    normals = np.repeat(rawdata[::4], 3, 0)
-    vertices = np.delete(rawdata, np.s_[::4], 0)
-    glEnable(GL_VERTEX_ARRAY)
-    glEnable(GL_NORMAL_ARRAY)
-    glVertexPointerf(vertices)
-    glNormalPointerf(normals)
-    glDrawArrays(GL_TRIANGLES, 0, len(vertices))
+    triangles = np.reshape(rawdata, (len(rawdata)/12, 4, 3))
+    interleaved = np.empty((len(triangles), 3, 6), np.float32)
+    interleaved[:,:,:3] = triangles[:,:1]
+    interleaved[:,:,3:] = triangles[:,1:]
+    del triangles, rawdata # Unmaps the file
+    return np.reshape(interleaved, (-1, 6))
+
+def exec_raw(name):
+    """
+    Read in a triangular representation of a piece for rendering, and
+    draw it from client arrays
+    """
+    interleaved = read_raw(name)
+    glPushClientAttrib(GL_CLIENT_VERTEX_ARRAY_BIT)
+    glInterleavedArrays(GL_N3F_V3F, 0, interleaved)
+    glDrawArrays(GL_TRIANGLES, 0, len(interleaved))
+    glPopClientAttrib()
+
+def upload_raw(name):
+    """
+    Reads a drawing into a vertex buffer object, which every part
+    drawing it shares
+    """
+    interleaved = read_raw(name)
+    buffer = glGenBuffers(1)
+    glBindBuffer(GL_ARRAY_BUFFER, buffer)
+    glBufferData(GL_ARRAY_BUFFER, interleaved, GL_STATIC_DRAW)
+    glBindBuffer(GL_ARRAY_BUFFER, 0)
+    detail2_buffers[name] = (buffer, len(interleaved))
+
+def draw_buffer(name):
+    """
+    Draws a drawing from its vertex buffer object
+    """
+    buffer, count = detail2_buffers[name]
+    glBindBuffer(GL_ARRAY_BUFFER, buffer)
+    glPushClientAttrib(GL_CLIENT_VERTEX_ARRAY_BIT)
+    glInterleavedArrays(GL_N3F_V3F, 0, None)
+    glDrawArrays(GL_TRIANGLES, 0, count)
+    glPopClientAttrib()
+    glBindBuffer(GL_ARRAY_BUFFER, 0)
 
 def draw_drawing(name, color = None):
     """
     Draw the rendered version of a piece
     """
-    # Display lists was much faster, but the recursive call messed up
-    # the outer display list call.
-    if not detail2_gllists.has_key(name):
-        gllist = glGenLists(1)
+    if color != None:
+        glColor3fv(color)
 
+    if not bool(glGenBuffers): # No vertex buffer objects
+        # Display lists was much faster, but the recursive call messed up
+        # the outer display list call.
+        if not detail2_gllists.has_key(name):
+            gllist = glGenLists(1)
+
+            if gllist != 0:
+                glNewList(gllist, GL_COMPILE)
+
+            exec_raw(name)
+
+            if gllist != 0:
+                glEndList()
+                detail2_gllists[name] = gllist
+
+        if detail2_gllists.has_key(name):
+            glCallList(detail2_gllists[name])
+        return
+
+    if not detail2_buffers.has_key(name):
+        upload_raw(name)
+    # A display list copies in what a buffer draws, so lists calling
+    # a drawing many times call a list of it instead.  That list is
+    # made only for drawings drawn while list_drawings is set.
+    if glGetIntegerv(GL_LIST_INDEX) != 0:
+        if detail2_gllists.has_key(name):
+            glCallList(detail2_gllists[name])
+            return
+    elif list_drawings and not detail2_gllists.has_key(name):
+        gllist = glGenLists(1)
         if gllist != 0:
             glNewList(gllist, GL_COMPILE)
-
-        time1 = time.time()
-        #print 'Generating drawing', name,
-        exec_raw(name)
-        time2 = time.time()
-        #print 'in %.1fs' % (time2-time1)
-
-        if gllist != 0:
+            draw_buffer(name)
             glEndList()
             detail2_gllists[name] = gllist
-
-    if color != None:
-        glColor3fv(color)
-    glCallList(detail2_gllists[name])
-
-def draw_end(end, end_type):
+    draw_buffer(name)
+
+# The six directions an end points, each with the rotation taking z
+# to it, and the up direction calling for a further quarter turn
+end_axes = np.array([[1.0, 0.0, 0.0], [-1.0, 0.0, 0.0], [0.0, 1.0, 0.0],
+                     [0.0, -1.0, 0.0], [0.0, 0.0, 1.0], [0.0, 0.0, -1.0]])
+end_turns = ((90.0, 0.0, 1.0, 0.0), (-90.0, 0.0, 1.0, 0.0), (-90.0, 1.0, 0.0, 0.0),
+             (90.0, 1.0, 0.0, 0.0), (0.0, 1.0, 0.0, 0.0), (180.0, 1.0, 0.0, 0.0))
+end_ups = np.array([[0.0, 0.0, 1.0], [0.0, 0.0, 1.0], [1.0, 0.0, 0.0],
+                    [1.0, 0.0, 0.0], [1.0, 0.0, 0.0], [1.0, 0.0, 0.0]])
+end_rotations = np.array(map(lambda x: (vector_math.rotation_matrix(x[0], x[1:]),
+                                        vector_math.compose(vector_math.rotation_matrix(x[0], x[1:]),
+                                                            vector_math.rotation_matrix(90.0, (0.0, 0.0, 1.0)))),
+                             end_turns)) # (6, 2, 4, 4)
+end_gllists = {} # end type: display list of its shape
+end_radius = 9.0*sf # holds an open end's shape about its tip (see draw_end_shape)
+
+def end_matrices(ends):
     """
-    Draws an open end on every stick and joint.
+    Returns the (N,4,4) matrices (OpenGL layout) placing an end shape
+    at each end, from the lookup over the six directions.
     Warning: only works for orthogonal joints.
     """
-
-    # Transform the end
-    glPushMatrix()
-    glTranslatef(end[0][0], end[0][1], end[0][2])
-    vout = end[0] - end[1]
-    vup = end[0] - end[2]
-    align_trans = [[np.array([1.0, 0.0, 0.0]), (90.0, 0.0, 1.0, 0.0), np.array([0.0, 0.0, 1.0])],
-                   [np.array([-1.0, 0.0, 0.0]), (-90.0, 0.0, 1.0, 0.0), np.array([0.0, 0.0, 1.0])],
-                   [np.array([0.0, 1.0, 0.0]), (-90.0, 1.0, 0.0, 0.0), np.array([1.0, 0.0, 0.0])],
-                   [np.array([0.0, -1.0, 0.0]), (90.0, 1.0, 0.0, 0.0), np.array([1.0, 0.0, 0.0])],
-                   [np.array([0.0, 0.0, 1.0]), (0.0, 1.0, 0.0, 0.0), np.array([1.0, 0.0, 0.0])],
-                   [np.array([0.0, 0.0, -1.0]), (180.0, 1.0, 0.0, 0.0), np.array([1.0, 0.0, 0.0])]]
-    for align_tran in align_trans:
-        if np.allclose(vout, align_tran[0], atol=base_pieces.xabstol):
-            ap = align_tran[1]
-            sv = align_tran[2]
-            break
-    glRotatef(ap[0], ap[1], ap[2], ap[3])
-    if np.allclose(sv, abs(vup), atol=base_pieces.xabstol):
-        glRotatef(90.0, 0.0, 0.0, 1.0)
-    #glScalef(sf, sf, sf)
-
-    # Draw the end
-
+    ends = np.asarray(ends, np.float32)
+    vout = ends[:,0] - ends[:,1]
+    vup = np.abs(ends[:,0] - ends[:,2])
+    direction = np.argmax(np.dot(vout, np.transpose(end_axes)), 1)
+    turned = np.all(np.abs(vup - end_ups[direction]) <= base_pieces.xabstol, 1)
+    matrices = end_rotations[direction, turned.astype(np.intp)]
+    matrices[:,3,:3] = ends[:,0]
+    return matrices
+
+def stick_end_triangles():
+    """
+    Returns the (N,3) vertices and normals of the triangles of an open
+    stick end: a cross extruded along z
+    """
+    xw = 6.4*sf/2 # width/2
+    xt = 1.6*sf/2 # thickness/2
+    xl = 4.4*sf # length
+    xsection = np.array([[-xw, xt], [-xt, xt], [-xt, xw], [xt, xw], [xt, xt], [xw, xt], [xw, -xt], [xt, -xt], [xt, -xw], [-xt, -xw], [-xt, -xt], [-xw, -xt]])
+    vertices = []
+    normals = []
+    for point1, point2 in zip(xsection, np.roll(xsection, -1, 0)):
+        side = point2 - point1
+        normal = [-side[1], side[0], 0.0]/vector_math.mag(side)
+        corners = [[point1[0], point1[1], 0.0], [point1[0], point1[1], xl],
+                   [point2[0], point2[1], xl], [point2[0], point2[1], 0.0]]
+        vertices.extend([corners[0], corners[1], corners[2], corners[0], corners[2], corners[3]])
+        normals.extend(6*[normal])
+    for x, y in ((xw, xt), (xt, xw)): # the cap, as two bars
+        corners = [[-x, -y, xl], [-x, y, xl], [x, y, xl], [x, -y, xl]]
+        vertices.extend([corners[0], corners[1], corners[2], corners[0], corners[2], corners[3]])
+        normals.extend(6*[[0.0, 0.0, 1.0]])
+    return np.array(vertices, np.float32), np.array(normals, np.float32)
+
+def draw_end_shape(end_type):
+    """
+    Draws the shape of an open end, pointing along z from the origin
+    """
     if end_type == 's':
-        xw = 6.4*sf/2 # width/2
-        xt = 1.6*sf/2 # thickness/2
-        xl = 4.4*sf # length
-        #xsection = np.array([[-xw, xt], [-xt, xt], [-xt, xw], [xt, xw], [xt, xt], [xw, xt], [xw, -xt], [xt, -xt], [xt, -xw], [-xt, -xw], [-xt, -xt], [-xw, -xt]])
-        glBegin(GL_QUADS)
-        glNormal3f(0.0, 1.0, 0.0)
-        glVertex3f(-xw, xt, 0.0)
-        glVertex3f(-xw, xt, xl)
-        glVertex3f(-xt, xt, xl)
-        glVertex3f(-xt, xt, 0.0)
-
-        glNormal3f(-1.0, 0.0, 0.0)
-        glVertex3f(-xt, xt, 0.0)
-        glVertex3f(-xt, xt, xl)
-        glVertex3f(-xt, xw, xl)
-        glVertex3f(-xt, xw, 0.0)
-
-        glNormal3f(0.0, 1.0, 0.0)
-        glVertex3f(-xt, xw, 0.0)
-        glVertex3f(-xt, xw, xl)
-        glVertex3f(xt, xw, xl)
-        glVertex3f(xt, xw, 0.0)
-
-        glNormal3f(1.0, 0.0, 0.0)
-        glVertex3f(xt, xw, 0.0)
-        glVertex3f(xt, xw, xl)
-        glVertex3f(xt, xt, xl)
-        glVertex3f(xt, xt, 0.0)
-
-        glNormal3f(0.0, 1.0, 0.0)
-        glVertex3f(xt, xt, 0.0)
-        glVertex3f(xt, xt, xl)
-        glVertex3f(xw, xt, xl)
-        glVertex3f(xw, xt, 0.0)
-
-        glNormal3f(1.0, 0.0, 0.0)
-        glVertex3f(xw, xt, 0.0)
-        glVertex3f(xw, xt, xl)
-        glVertex3f(xw, -xt, xl)
-        glVertex3f(xw, -xt, 0.0)
-
-        glNormal3f(0.0, -1.0, 0.0)
-        glVertex3f(xw, -xt, 0.0)
-        glVertex3f(xw, -xt, xl)
-        glVertex3f(xt, -xt, xl)
-        glVertex3f(xt, -xt, 0.0)
-
-        glNormal3f(1.0, 0.0, 0.0)
-        glVertex3f(xt, -xt, 0.0)
-        glVertex3f(xt, -xt, xl)
-        glVertex3f(xt, -xw, xl)
-        glVertex3f(xt, -xw, 0.0)
-
-        glNormal3f(0.0, -1.0, 0.0)
-        glVertex3f(xt, -xw, 0.0)
-        glVertex3f(xt, -xw, xl)
-        glVertex3f(-xt, -xw, xl)
-        glVertex3f(-xt, -xw, 0.0)
-
-        glNormal3f(-1.0, 0.0, 0.0)
-        glVertex3f(-xt, -xw, 0.0)
-        glVertex3f(-xt, -xw, xl)
-        glVertex3f(-xt, -xt, xl)
-        glVertex3f(-xt, -xt, 0.0)
-
-        glNormal3f(0.0, -1.0, 0.0)
-        glVertex3f(-xt, -xt, 0.0)
-        glVertex3f(-xt, -xt, xl)
-        glVertex3f(-xw, -xt, xl)
-        glVertex3f(-xw, -xt, 0.0)
-
-        glNormal3f(-1.0, 0.0, 0.0)
-        glVertex3f(-xw, -xt, 0.0)
-        glVertex3f(-xw, -xt, xl)
-        glVertex3f(-xw, xt, xl)
-        glVertex3f(-xw, xt, 0.0)
-
-        glNormal3f(0.0, 0.0, 1.0)
-        glVertex3f(-xw, -xt, xl)
-        glVertex3f(-xw, xt, xl)
-        glVertex3f(xw, xt, xl)
-        glVertex3f(xw, -xt, xl)
-        glVertex3f(-xt, -xw, xl)
-        glVertex3f(-xt, xw, xl)
-        glVertex3f(xt, xw, xl)
-        glVertex3f(xt, -xw, xl)
-        glEnd()
+        vertices, normals = stick_end_triangles()
+        glPushClientAttrib(GL_CLIENT_VERTEX_ARRAY_BIT)
+        glEnableClientState(GL_VERTEX_ARRAY)
+        glEnableClientState(GL_NORMAL_ARRAY)
+        glVertexPointerf(vertices)
+        glNormalPointerf(normals)
+        glDrawArrays(GL_TRIANGLES, 0, len(vertices))
+        glPopClientAttrib()
 
     elif end_type == 'j':
         w = 2.8*sf
@@ -339,8 +345,45 @@ def draw_end(end, end_type):
 
     else:
         print 'Unknown end type', end_type
-        
-    glPopMatrix()
+
+def call_end_shape(end_type):
+    """
+    Draws the shape of an open end from its display list, made the
+    first time outside another list
+    """
+    if not end_gllists.has_key(end_type) and glGetIntegerv(GL_LIST_INDEX) == 0:
+        gllist = glGenLists(1)
+        if gllist != 0:
+            glNewList(gllist, GL_COMPILE)
+            draw_end_shape(end_type)
+            glEndList()
+            end_gllists[end_type] = gllist
+    if end_gllists.has_key(end_type):
+        glCallList(end_gllists[end_type])
+    else:
+        draw_end_shape(end_type)
+
+def draw_end(end, end_type):
+    """
+    Draws an open end on every stick and joint.
+    Warning: only works for orthogonal joints.
+    """
+    draw_ends([end], [end_type])
+
+def draw_ends(ends, ends_types, before = None):
+    """
+    Draws open ends in one pass, placing them all at once.  Calls
+    before(index) before drawing each, if given.
+    """
+    if len(ends) == 0:
+        return
+    for index, matrix in enumerate(end_matrices(ends)):
+        if before:
+            before(index)
+        glPushMatrix()
+        glMultMatrixf(matrix)
+        call_end_shape(ends_types[index])
+        glPopMatrix()
 
 def draw_pipe(ro, ri, h, num_sections = 16):
     """
@@ -359,6 +402,28 @@ def draw_pipe(ro, ri, h, num_sections = 16):
     gleExtrusion(xsection, normal, (0.0, 1.0, 0.0), ((0.0, 0.0, -h/2-1.0), (0.0, 0.0, -h/2), (0.0, 0.0, h/2), (0.0, 0.0, h/2+1.0)), None)
     return inner_edge
 
+def draw_capsule(start, stop, radius, slices = 8):
+    """
+    Draws a cylinder with round ends from start to stop.  Few slices
+    are needed, since it stands in for a part small on the screen.
+    """
+    axis = stop - start
+    length = vector_math.mag(axis)
+    about = vector_math.cross(np.array([0.0, 0.0, 1.0]), axis)
+    glPushMatrix()
+    glTranslatef(start[0], start[1], start[2])
+    if vector_math.mag(about) > base_pieces.xabstol: # Turn z to the axis
+        glRotatef(math.degrees(math.atan2(vector_math.mag(about), axis[2])), about[0], about[1], about[2])
+    elif axis[2] < 0.0:
+        glRotatef(180.0, 1.0, 0.0, 0.0)
+    quadric = gluNewQuadric()
+    gluCylinder(quadric, radius, radius, length, slices, 1)
+    gluSphere(quadric, radius, slices, slices/2)
+    glTranslatef(0.0, 0.0, length)
+    gluSphere(quadric, radius, slices, slices/2)
+    gluDeleteQuadric(quadric)
+    glPopMatrix()
+
 def draw_hub(cored = 0):
     """
     Draws a joint hub.  Uses a stitch line to make holes.
@@ -620,9 +685,10 @@ class stick(base_pieces.piece):
     """
     A base class for all sticks
     """
+    bound_reach = join_len # past the ends: end shapes and joint hubs
+
     def draw_ends(self):
-        for end, end_type in zip(self.unaligned_ends, self.ends_types):
-            draw_end(end, end_type)
+        draw_ends(self.unaligned_ends, self.ends_types)
 
 class straightp5(stick):
 
@@ -687,6 +753,8 @@ class axle(stick):
     """
     A base class for axles
     """
+    bound_reach = 33.0*sf # past the ends: the largest wheel or gear
+
 
     def inset_files(self):
         retval = self.name
@@ -2977,6 +3045,7 @@ class pivot0_(stick):
     ends_types = ['s']
     icon_extent = 3.0
     combination = ['coupler', 'gear_axle1s']
+    bound_reach = panel_space + join_len # past the end: the second axle, panel_space over
 
     def label(self):
         return self.combination[:]
@@ -3291,3 +3360,10 @@ class pivot0(stick):
             draw_drawing('coupler')
             glPopMatrix()
 
+
+# Piece classes by name, so files can be read without eval
+registry = {}
+for name, value in globals().items():
+    if isinstance(value, type) and issubclass(value, base_pieces.piece):
+        registry[name] = value
+del name, value
@@ -6,6 +6,8 @@ from distutils.core import setup
 if sys.argv[1] != 'install':
     from distutils.file_util import copy_file
     copy_file('cbmodel.py', 'cbmodel')
+    copy_file('cbbatch.py', 'cbbatch')
+    copy_file('cbprint.py', 'cbprint')
 
 docs = ['README', 'LICENSE', 'cbmodel.pdf']
 shares = ['instructions.py', 'base_pieces.py', 'pieces.py', 'vector_math.py', 'logo_white.png', 'logo_black.png', 'symbol.png', 'mirror.png', 'xhair.png', 'scale.png', 'warning.png', 'masses.csv', 'prices.csv']
@@ -39,6 +41,6 @@ model, enter the Instruction environment and generate step-by-step
 Instructions for others to duplicate your work.''',
       url = 'https://crossbeamstoy.com',
       data_files = data_files,
-      scripts = ['cbmodel'],
+      scripts = ['cbmodel', 'cbbatch', 'cbprint'],
       requires = ['numpy', 'OpenGL', 'gtk', 'gtk.gtkgl', 'PIL', 'reportlab']
       )
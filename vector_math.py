@@ -87,3 +87,209 @@ def offsets(r2, r1 = -1):
     #print mesh
     coords = np.transpose(np.nonzero(mesh)) - np.array([r2, r2])
     return coords
+
+def outline_mask(depth, radius, shadow, block = 8):
+    """
+    Returns a uint8 mask of the pixels in a depth image (1.0 is
+    background) with a pixel from offsets(radius, radius - 1) in front
+    of them by more than shadow.
+
+    Shifting the whole image by every offset costs a full-image pass
+    per offset.  Instead, the image is cut into blocks, and a few
+    passes find the blocks whose neighborhood reaches further forward
+    than their farthest pixel by shadow.  Only the pixels in those
+    blocks, near depth edges, check the offsets.
+    """
+    height, width = depth.shape
+    rows = -(-height//block)
+    columns = -(-width//block)
+    padded = np.empty((rows*block + 2*radius, columns*block + 2*radius), depth.dtype)
+    padded.fill(np.inf)
+    padded[radius:radius+height,radius:radius+width] = depth
+    blocks = padded[radius:radius+rows*block,radius:radius+columns*block].reshape((rows, block, columns, block))
+
+    # The nearest depth within radius of each block, plus shadow
+    nearest = blocks.min(1).min(2)
+    reach = -(-radius//block)
+    grid = np.empty((rows + 2*reach, columns + 2*reach), depth.dtype)
+    grid.fill(np.inf)
+    grid[reach:reach+rows,reach:reach+columns] = nearest
+    for y in range(2*reach + 1):
+        for x in range(2*reach + 1):
+            nearest = np.minimum(nearest, grid[y:y+rows,x:x+columns])
+    nearest = nearest + shadow
+
+    # Candidate pixels
+    block_y, block_x = np.nonzero(nearest < blocks.max(1).max(2))
+    nearest = nearest[block_y, block_x]
+    index, y, x = np.nonzero(blocks[block_y,:,block_x,:] > nearest[:,np.newaxis,np.newaxis])
+    y = block_y[index]*block + y
+    x = block_x[index]*block + x
+    inside = (y < height) & (x < width)
+    y = y[inside]
+    x = x[inside]
+
+    # Check their offsets
+    padded_width = padded.shape[1]
+    index = (y + radius)*padded_width + x + radius
+    values = padded.ravel()
+    near = np.empty(len(index), depth.dtype)
+    near.fill(np.inf)
+    for offset_x, offset_y in offsets(radius, radius - 1):
+        near = np.minimum(near, values[index + offset_y*padded_width + offset_x])
+    mask = np.zeros((height, width), np.uint8)
+    mask[y, x] = near + shadow < depth[y, x]
+    return mask
+
+def project(points, model, projection, viewport):
+    """
+    Returns the (N,3) window coordinates of (N,3) points, as gluProject
+    gives for each.  Points gluProject can't project (w = 0) come out
+    nan.
+    """
+    points = np.asarray(points, np.float64)
+    model = np.asarray(model, np.float64)
+    projection = np.asarray(projection, np.float64)
+    # Matrices are in the OpenGL layout, so points are row vectors
+    clip = np.dot(np.dot(points, model[:3]) + model[3], projection)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        normalized = clip[:,:3]/clip[:,3:4]
+    normalized[clip[:,3] == 0.0] = np.nan
+    window = np.empty_like(normalized)
+    window[:,0] = viewport[0] + (1.0 + normalized[:,0])*viewport[2]/2.0
+    window[:,1] = viewport[1] + (1.0 + normalized[:,1])*viewport[3]/2.0
+    window[:,2] = (1.0 + normalized[:,2])/2.0
+    return window
+
+def frustum_planes(model, projection):
+    """
+    Returns the (6,4) planes (normal, offset) bounding what the model
+    and projection matrices (OpenGL layout) show.  Normals are unit
+    length and point into the view.  A degenerate view gives planes
+    that aren't finite.
+    """
+    matrix = np.dot(np.asarray(model, np.float64), np.asarray(projection, np.float64))
+    x, y, z, w = np.transpose(matrix) # Clip coordinates as planes
+    planes = np.array([w + x, w - x, w + y, w - y, w + z, w - z])
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return planes/mag(planes[:,:3])[:,np.newaxis]
+
+def pick_matrix(box, viewport):
+    """
+    Returns the matrix (OpenGL layout) gluPickMatrix multiplies the
+    projection by to show only the window box (x, y, width, height)
+    """
+    x, y, width, height = map(float, box)
+    matrix = np.identity(4)
+    matrix[0,0] = viewport[2]/width
+    matrix[1,1] = viewport[3]/height
+    matrix[3,0] = (viewport[2] - 2*(x + width/2.0 - viewport[0]))/width
+    matrix[3,1] = (viewport[3] - 2*(y + height/2.0 - viewport[1]))/height
+    return matrix
+
+def spheres_visible(planes, centers, radii):
+    """
+    Returns a boolean mask of the spheres (N,3 centers, N radii) at
+    least partly inside planes, from frustum_planes
+    """
+    distances = np.dot(centers, np.transpose(planes[:,:3])) + planes[:,3]
+    return np.all(distances >= -np.asarray(radii)[:,np.newaxis], 1)
+
+# 4x4 transforms.  These reproduce the OpenGL matrix stack without a
+# context.  Matrices are float32 and in the layout glGetFloatv
+# returns (the transpose of the usual math layout), so they can be
+# passed straight to glMultMatrixf.  Sines, cosines and products are
+# taken in float32 and summed in the same order as Mesa's, so results
+# match a read-back from Mesa; other drivers agree within float32
+# rounding.
+
+def multiply(matrix1, matrix2):
+    """
+    Returns the matrix left after glMultMatrixf(matrix2) on matrix1
+    """
+    m1 = np.asarray(matrix1, np.float32)
+    m2 = np.asarray(matrix2, np.float32)
+    return m1[0]*m2[:,0:1] + m1[1]*m2[:,1:2] + m1[2]*m2[:,2:3] + m1[3]*m2[:,3:4]
+
+def compose(*matrices):
+    """
+    Returns the matrix left after glLoadIdentity followed by
+    glMultMatrixf of each matrix in turn
+    """
+    matrix = np.identity(4, np.float32)
+    for m in matrices:
+        matrix = multiply(matrix, m)
+    return matrix
+
+def translation_matrix(delta):
+    """
+    Returns the matrix glTranslatef(delta[0], delta[1], delta[2]) applies
+    """
+    matrix = np.identity(4, np.float32)
+    matrix[3,:3] = np.asarray(delta[:3], np.float32)
+    return matrix
+
+def rotation_matrix(angle, about):
+    """
+    Returns the matrix glRotatef(angle, about[0], about[1], about[2])
+    applies
+    """
+    angle = np.float32(angle)
+    x, y, z = np.asarray(about[:3], np.float32)
+    radians = np.float32(float(angle)*math.pi/180.0) # Mesa takes sinf and cosf of a float
+    s = np.sin(radians)
+    c = np.cos(radians)
+    m = np.identity(4, np.float32) # math layout; transposed on return
+    if x == 0.0 and y == 0.0 and z != 0.0: # about z
+        m[0,0] = c
+        m[1,1] = c
+        if z < 0.0:
+            m[0,1] = s
+            m[1,0] = -s
+        else:
+            m[0,1] = -s
+            m[1,0] = s
+    elif x == 0.0 and y != 0.0 and z == 0.0: # about y
+        m[0,0] = c
+        m[2,2] = c
+        if y < 0.0:
+            m[0,2] = -s
+            m[2,0] = s
+        else:
+            m[0,2] = s
+            m[2,0] = -s
+    elif x != 0.0 and y == 0.0 and z == 0.0: # about x
+        m[1,1] = c
+        m[2,2] = c
+        if x < 0.0:
+            m[1,2] = s
+            m[2,1] = -s
+        else:
+            m[1,2] = -s
+            m[2,1] = s
+    else:
+        r = np.sqrt(x*x + y*y + z*z)
+        if r <= np.float32(1.0e-4): # No rotation
+            return m
+        x = x/r
+        y = y/r
+        z = z/r
+        one_c = np.float32(1.0) - c
+        m[0,0] = one_c*(x*x) + c
+        m[0,1] = one_c*(x*y) - z*s
+        m[0,2] = one_c*(z*x) + y*s
+        m[1,0] = one_c*(x*y) + z*s
+        m[1,1] = one_c*(y*y) + c
+        m[1,2] = one_c*(y*z) - x*s
+        m[2,0] = one_c*(z*x) - y*s
+        m[2,1] = one_c*(y*z) + x*s
+        m[2,2] = one_c*(z*z) + c
+    return np.transpose(m).copy()
+
+def mirror_matrix(axis):
+    """
+    Returns the matrix that mirrors across axis (0 x, 1 y, 2 z)
+    """
+    matrix = np.identity(4, np.float32)
+    matrix[axis,axis] = -1.0
+    return matrix